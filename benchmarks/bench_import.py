@@ -0,0 +1,46 @@
+"""
+Benchmark of the import time of lib_auto_mesh.
+
+Run from the top directory of the repository:
+
+    python benchmarks/bench_import.py
+
+Each import is timed in a new Python process. matplotlib is only imported
+by lib_auto_mesh when a plot is made.
+"""
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+TOP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def timeImport(statement, number):
+    env = dict(os.environ, PYTHONPATH=os.path.join(TOP_DIR, "src"))
+    list_time = []
+    for _ in range(number):
+        start_time = time.perf_counter()
+        subprocess.run([sys.executable, "-c", statement], env=env, check=True)
+        list_time.append(time.perf_counter() - start_time)
+    return min(list_time)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--number", type=int, default=5)
+    args = parser.parse_args()
+    list_case = [
+        ("python", "pass"),
+        ("lib_auto_mesh", "import lib_auto_mesh"),
+        ("lib_auto_mesh + plots", "import lib_auto_mesh, matplotlib.pyplot"),
+    ]
+    print("%-24s %10s" % ("import", "time"))
+    for name, statement in list_case:
+        print("%-24s %7.0f ms" % (name, timeImport(statement, args.number) * 1e3))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Benchmark of loopExam against the original per-column implementation.
+
+Run from the top directory of the repository:
+
+    python benchmarks/bench_loop_exam.py
+
+The filtered images of the snapshots in tests/data and synthetic frames
+up to 4096 pixels wide are used.
+"""
+
+import os
+import sys
+import timeit
+import argparse
+
+import numpy
+
+TOP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(TOP_DIR, "src"))
+
+import lib_auto_mesh  # noqa: E402
+
+DATA_DIR = os.path.join(TOP_DIR, "tests", "data")
+
+
+def loopExamPerColumn(filtered_image):
+    """
+    The original implementation of loopExam, looping over the columns.
+    """
+    ny, nx = filtered_image.shape
+    shape_list_index = []
+    shape_list_upper = []
+    shape_list_lower = []
+    for index_x in range(nx):
+        column = filtered_image[:, index_x]
+        indices = numpy.where(column)[0]
+        if len(indices) > 0:
+            shape_list_index.append(index_x)
+            shape_list_upper.append(indices[0])
+            shape_list_lower.append(indices[-1])
+    array_index = numpy.array(shape_list_index)
+    array_upper = ny - numpy.array(shape_list_upper)
+    array_lower = ny - numpy.array(shape_list_lower)
+    return (array_index.tolist(), array_upper.tolist(), array_lower.tolist())
+
+
+def snapshotImages():
+    snapshot_dir = os.path.join(DATA_DIR, "snapshots_20141128-084026")
+    list_omega = [0, 30, 60, 90, 120, 150, 180, 210, 240, 270, 300, 330]
+    dict_image = lib_auto_mesh.readSnapshots(snapshot_dir, list_omega)
+    background = lib_auto_mesh.readBackground(
+        os.path.join(snapshot_dir, "snapshot_background.png")
+    )
+    list_filtered = []
+    for omega in list_omega:
+        difference_image = lib_auto_mesh.subtractBackground(
+            dict_image[omega], background
+        )
+        list_filtered.append(lib_auto_mesh.filterDifferenceImage(difference_image))
+    return list_filtered
+
+
+def syntheticImage(nx, ny, seed=0):
+    """
+    A pin entering from the left with a round loop at its end, plus
+    some isolated noise pixels.
+    """
+    rng = numpy.random.default_rng(seed)
+    y, x = numpy.ogrid[0:ny, 0:nx]
+    loop_x = int(0.6 * nx)
+    radius = ny // 6
+    pin = (x < loop_x) & (numpy.abs(y - ny // 2) < ny // 40)
+    loop = (x - loop_x) ** 2 + (y - ny // 2) ** 2 < radius**2
+    return pin | loop | (rng.random((ny, nx)) > 0.999)
+
+
+def timeFunction(function, list_image, number):
+    seconds = timeit.timeit(
+        lambda: [function(image) for image in list_image], number=number
+    )
+    return seconds / number / len(list_image)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--number", type=int, default=5)
+    args = parser.parse_args()
+    list_case = [("tests/data snapshots", snapshotImages())]
+    for nx, ny in [(1280, 1024), (2048, 2048), (4096, 3000)]:
+        list_case.append(("synthetic %dx%d" % (nx, ny), [syntheticImage(nx, ny)]))
+    print("%-28s %12s %12s %8s" % ("images", "per column", "vectorized", "speedup"))
+    for name, list_image in list_case:
+        for image in list_image:
+            assert loopExamPerColumn(image) == lib_auto_mesh.loopExam(image)
+        time_old = timeFunction(loopExamPerColumn, list_image, args.number)
+        time_new = timeFunction(lib_auto_mesh.loopExam, list_image, args.number)
+        print(
+            "%-28s %9.2f ms %9.2f ms %7.1fx"
+            % (name, time_old * 1e3, time_new * 1e3, time_old / time_new)
+        )
+
+
+if __name__ == "__main__":
+    main()
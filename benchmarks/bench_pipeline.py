@@ -0,0 +1,254 @@
+"""
+Benchmark of autoMesh and findDeltaToCentre on synthetic snapshots.
+
+Run from the top directory of the repository:
+
+    python benchmarks/bench_pipeline.py --output bench_pipeline.json
+
+Snapshot sets of a pin with a flat loop at its end are generated for
+several image sizes (640x480 up to 4096x3000) and noise levels and written
+as PNG files in a temporary directory. autoMesh and findDeltaToCentre are
+timed on each set, the time of each stage is taken from lib_auto_mesh.Metrics.
+The results are written to a JSON file, give the file of an earlier run
+with --compare to print the ratios of the timings.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+
+import numpy
+import imageio
+
+TOP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(TOP_DIR, "src"))
+
+import lib_auto_mesh  # noqa: E402
+
+LIST_SIZE = [(640, 480), (1280, 1024), (2048, 1536), (4096, 3000)]
+LIST_NOISE = [0, 5, 20]
+
+
+def syntheticSnapshot(nx, ny, omega, noise=0, seed=0):
+    """
+    Snapshot at omega (degrees) of a horizontal pin with a flat round loop
+    at its end, the loop is thinnest at 90 and 270 degrees. The pin is
+    slightly off the rotation axis. noise is the standard deviation of the
+    gaussian noise in grey levels.
+    """
+    rng = numpy.random.default_rng(seed)
+    y, x = numpy.ogrid[0:ny, 0:nx]
+    cos_omega = numpy.cos(numpy.radians(omega))
+    sin_omega = numpy.sin(numpy.radians(omega))
+    centre_y = ny / 2 + 0.02 * ny * sin_omega
+    loop_radius = 0.12 * nx
+    loop_x = 0.55 * nx
+    pin_half_width = max(2, ny // 60)
+    pin = (x < loop_x) & (numpy.abs(y - centre_y) < pin_half_width)
+    half_height = loop_radius * numpy.abs(cos_omega) + pin_half_width
+    loop = ((x - loop_x - loop_radius) / loop_radius) ** 2 + (
+        (y - centre_y) / half_height
+    ) ** 2 < 1
+    image = numpy.full((ny, nx), 200.0)
+    image[pin | loop] = 60.0
+    if noise > 0:
+        image += rng.normal(0, noise, (ny, nx))
+    return numpy.clip(image, 0, 255).astype(numpy.uint8)
+
+
+def writeSnapshotSet(snapshot_dir, nx, ny, noise, list_omega, seed=0):
+    """
+    Writes <snapshot_dir>/snapshot_<omega>.png and snapshot_background.png.
+    """
+    rng = numpy.random.default_rng(seed)
+    background = numpy.full((ny, nx), 200.0)
+    if noise > 0:
+        background += rng.normal(0, noise, (ny, nx))
+    imageio.imwrite(
+        os.path.join(snapshot_dir, "snapshot_background.png"),
+        numpy.clip(background, 0, 255).astype(numpy.uint8),
+    )
+    for index, omega in enumerate(list_omega):
+        imageio.imwrite(
+            os.path.join(snapshot_dir, "snapshot_%03d.png" % omega),
+            syntheticSnapshot(nx, ny, omega, noise=noise, seed=seed + index + 1),
+        )
+
+
+def timeRun(function, number):
+    """
+    Runs function number times, returns the minimum time, the result and
+    the metrics of the fastest run.
+    """
+    best = None
+    for _ in range(number):
+        metrics = lib_auto_mesh.Metrics()
+        start_time = time.perf_counter()
+        result = function(metrics)
+        seconds = time.perf_counter() - start_time
+        if best is None or seconds < best[0]:
+            best = (seconds, result, metrics.toDict())
+    return best
+
+
+def benchmarkCase(nx, ny, noise, number, working_dir):
+    snapshot_dir = tempfile.mkdtemp(prefix="snapshots_", dir=working_dir)
+    writeSnapshotSet(
+        snapshot_dir,
+        nx,
+        ny,
+        noise,
+        sorted(set(lib_auto_mesh.LIST_OMEGA_MESH + lib_auto_mesh.LIST_OMEGA_CENTRE)),
+    )
+    case = {"nx": nx, "ny": ny, "noise": noise, "timings": {}}
+    list_function = [
+        (
+            "autoMesh",
+            lambda metrics: lib_auto_mesh.autoMesh(
+                snapshot_dir,
+                working_dir,
+                working_dir,
+                loop_max_width=0.3 * nx,
+                loop_min_width=0.15 * nx,
+                metrics=metrics,
+            ),
+        ),
+        (
+            "autoMesh_pyramid4",
+            lambda metrics: lib_auto_mesh.autoMesh(
+                snapshot_dir,
+                working_dir,
+                working_dir,
+                loop_max_width=0.3 * nx,
+                loop_min_width=0.15 * nx,
+                metrics=metrics,
+                pyramid=4,
+            ),
+        ),
+        (
+            "findDeltaToCentre",
+            lambda metrics: lib_auto_mesh.findDeltaToCentre(
+                snapshot_dir, working_dir, loop_width=0.1 * nx, metrics=metrics
+            ),
+        ),
+    ]
+    for name, function in list_function:
+        seconds, result, dict_metrics = timeRun(function, number)
+        case["timings"][name] = {
+            "seconds": seconds,
+            "stages": dict_metrics["stages"],
+            "result": [toJson(value) for value in result],
+        }
+    shutil.rmtree(snapshot_dir)
+    return case
+
+
+def toJson(value):
+    if isinstance(value, numpy.generic):
+        return value.item()
+    if isinstance(value, str):
+        # The snapshot directory is temporary
+        return os.path.basename(value)
+    return value
+
+
+def gitCommit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=TOP_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compareResults(dict_old, dict_new):
+    """
+    Prints the ratio new / old of the timings of the cases in both results.
+    """
+    dict_old_case = {
+        (case["nx"], case["ny"], case["noise"]): case for case in dict_old["cases"]
+    }
+    print("%-22s %-18s %10s %10s %7s" % ("case", "function", "old", "new", "ratio"))
+    for case in dict_new["cases"]:
+        key = (case["nx"], case["ny"], case["noise"])
+        if key not in dict_old_case:
+            continue
+        for name, timing in case["timings"].items():
+            old_timing = dict_old_case[key]["timings"].get(name)
+            if old_timing is None:
+                continue
+            print(
+                "%-22s %-18s %7.0f ms %7.0f ms %6.2fx"
+                % (
+                    "%dx%d noise %d" % key,
+                    name,
+                    old_timing["seconds"] * 1e3,
+                    timing["seconds"] * 1e3,
+                    timing["seconds"] / old_timing["seconds"],
+                )
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--number", type=int, default=3)
+    parser.add_argument("--output", default="bench_pipeline.json")
+    parser.add_argument("--compare", help="results file of an earlier run")
+    parser.add_argument(
+        "--quick", action="store_true", help="only the smallest size, no noise"
+    )
+    args = parser.parse_args()
+    list_size = LIST_SIZE[:1] if args.quick else LIST_SIZE
+    list_noise = LIST_NOISE[:1] if args.quick else LIST_NOISE
+    working_dir = tempfile.mkdtemp(prefix="bench_pipeline_")
+    os.chmod(working_dir, 0o755)
+    list_case = []
+    try:
+        print("%-22s %-18s %10s" % ("case", "function", "time"))
+        for nx, ny in list_size:
+            for noise in list_noise:
+                case = benchmarkCase(nx, ny, noise, args.number, working_dir)
+                list_case.append(case)
+                for name, timing in case["timings"].items():
+                    print(
+                        "%-22s %-18s %7.0f ms"
+                        % (
+                            "%dx%d noise %d" % (nx, ny, noise),
+                            name,
+                            timing["seconds"] * 1e3,
+                        )
+                    )
+    finally:
+        lib_auto_mesh.waitForArtifacts()
+        shutil.rmtree(working_dir)
+    dict_results = {
+        "commit": gitCommit(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "number": args.number,
+        "cases": list_case,
+    }
+    with open(args.output, "w") as f:
+        json.dump(dict_results, f, indent=4)
+    print("Results written to %s" % args.output)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compareResults(json.load(f), dict_results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Benchmark of cold calls (one Python process per call) against warm calls
+to the resident auto mesh service.
+
+Run from the top directory of the repository:
+
+    python benchmarks/bench_service.py
+
+The snapshots in tests/data/snapshots_20141128-084026 are used.
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+
+TOP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(TOP_DIR, "src"))
+
+import auto_mesh_service  # noqa: E402
+
+SNAPSHOT_DIR = os.path.join(TOP_DIR, "tests", "data", "snapshots_20141128-084026")
+
+COLD_CALL = """
+import sys
+sys.path.insert(0, {src_dir!r})
+import lib_auto_mesh
+lib_auto_mesh.autoMesh({snapshot_dir!r}, {working_dir!r}, {working_dir!r},
+                       loop_max_width=0.35 * 608, loop_min_width=0.5 * 608)
+"""
+
+
+def timeColdCall(working_dir):
+    code = COLD_CALL.format(
+        src_dir=os.path.join(TOP_DIR, "src"),
+        snapshot_dir=SNAPSHOT_DIR,
+        working_dir=working_dir,
+    )
+    start_time = time.perf_counter()
+    subprocess.run([sys.executable, "-c", code], check=True)
+    return time.perf_counter() - start_time
+
+
+def timeWarmCall(client, working_dir):
+    start_time = time.perf_counter()
+    client.autoMesh(
+        snapshot_dir=SNAPSHOT_DIR,
+        workflow_working_dir=working_dir,
+        auto_mesh_working_dir=working_dir,
+        loop_max_width=0.35 * 608,
+        loop_min_width=0.5 * 608,
+    )
+    return time.perf_counter() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--number", type=int, default=5)
+    args = parser.parse_args()
+    working_dir = tempfile.mkdtemp(prefix="bench_service_")
+    list_cold = [timeColdCall(working_dir) for _ in range(args.number)]
+    with auto_mesh_service.AutoMeshClient() as client:
+        client.ping()
+        # The first call reads the background
+        timeWarmCall(client, working_dir)
+        list_warm = [timeWarmCall(client, working_dir) for _ in range(args.number)]
+    print("%-12s %10s %10s" % ("autoMesh", "min", "mean"))
+    for name, list_time in [("cold call", list_cold), ("warm call", list_warm)]:
+        print(
+            "%-12s %7.0f ms %7.0f ms"
+            % (name, min(list_time) * 1e3, sum(list_time) / len(list_time) * 1e3)
+        )
+
+
+if __name__ == "__main__":
+    main()
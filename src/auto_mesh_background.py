@@ -0,0 +1,76 @@
+"""
+Builds or updates a background model from frames without sample.
+
+The model (see lib_auto_mesh.BackgroundModel) is estimated from the given
+image files with a per pixel median or robust mean and saved as an npz
+file, to be given as the background of autoMesh, findDeltaToCentre or the
+batch mode instead of a background taken for each sample. With --update
+the frames are added to the running estimate of an existing model.
+Examples:
+
+    python src/auto_mesh_background.py --output background.npz "/data/empty/*.png"
+    python src/auto_mesh_background.py --output background.npz --update frame.png
+"""
+
+import sys
+import glob
+import logging
+import argparse
+
+import lib_auto_mesh
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("frames", nargs="+", help="image files or glob patterns")
+    parser.add_argument("--output", required=True, help="background model file")
+    parser.add_argument(
+        "--method",
+        choices=[lib_auto_mesh.BACKGROUND_MEDIAN, lib_auto_mesh.BACKGROUND_ROBUST_MEAN],
+        default=lib_auto_mesh.BACKGROUND_MEDIAN,
+    )
+    parser.add_argument(
+        "--clip", type=float, default=3.0, help="clipping of the robust mean"
+    )
+    parser.add_argument(
+        "--update",
+        action="store_true",
+        help="add the frames to the running estimate of the model",
+    )
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=20,
+        help="number of frames of the running estimate",
+    )
+    args = parser.parse_args(argv)
+    list_frame_path = []
+    for pattern in args.frames:
+        if glob.has_magic(pattern):
+            list_frame_path += sorted(glob.glob(pattern))
+        else:
+            list_frame_path.append(pattern)
+    if len(list_frame_path) == 0:
+        logging.error("No frames found")
+        return 1
+    if args.update:
+        for frame_path in list_frame_path:
+            model = lib_auto_mesh.updateBackgroundModel(
+                args.output, frame_path, window=args.window
+            )
+    else:
+        model = lib_auto_mesh.BackgroundModel.fromFrames(
+            [
+                lib_auto_mesh.readImage(frame_path, compact=True)
+                for frame_path in list_frame_path
+            ],
+            method=args.method,
+            clip=args.clip,
+        )
+        model.save(args.output)
+    print("%s: %d frames" % (args.output, model.no_frames))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,335 @@
+"""
+Batch mode: runs autoMesh or findDeltaToCentre on many snapshot directories.
+
+The snapshot directories are processed in a pool of processes, the results
+are written as JSON lines (one line per sample) as soon as they are
+available. A sample for which the analysis fails gives a line with
+"status": "error" and does not stop the batch. Example:
+
+    python src/auto_mesh_batch.py --working-dir /tmp/batch "/data/plate1/*"
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import logging
+import argparse
+import tempfile
+import traceback
+import concurrent.futures
+import concurrent.futures.process
+
+import numpy
+
+import lib_auto_mesh
+
+MODE_MESH = "mesh"
+MODE_CENTRE = "centre"
+
+LIST_MESH_KEY = [
+    "angle_min_thickness",
+    "x1_pixels",
+    "y1_pixels",
+    "dx_pixels",
+    "dy_pixels",
+    "delta_phiz",
+    "std_phiz",
+    "image_path",
+    "are_the_same_image",
+]
+# Results of autoMeshFromArrays, without the image path
+LIST_MESH_ARRAYS_KEY = [key for key in LIST_MESH_KEY if key != "image_path"]
+LIST_CENTRE_KEY = ["delta_x", "delta_y", "delta_z"]
+
+
+def listSnapshotDirs(list_pattern):
+    """
+    Returns the snapshot directories and snapshot stack files (see
+    lib_auto_mesh.isSnapshotStack) matching the names or glob patterns in
+    list_pattern, in the given order and without duplicates.
+    """
+    list_snapshot_dir = []
+    for pattern in list_pattern:
+        list_path = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        for path in list_path:
+            if path in list_snapshot_dir:
+                continue
+            if os.path.isdir(path) or lib_auto_mesh.isSnapshotStack(path):
+                list_snapshot_dir.append(path)
+    return list_snapshot_dir
+
+
+def toJson(value):
+    """
+    Converts the numpy scalars in the results to plain Python types.
+    """
+    if isinstance(value, numpy.generic):
+        return value.item()
+    return value
+
+
+def processSample(
+    snapshot_dir, working_dir, mode=MODE_MESH, collect_metrics=False, **kwargs
+):
+    """
+    Runs the analysis of one snapshot directory in its own sub directory
+    of working_dir and returns a dictionary with the results, and with the
+    lib_auto_mesh.Metrics of the analysis if collect_metrics is True. Any
+    error is returned in the dictionary instead of being raised.
+    """
+    start_time = time.perf_counter()
+    record = {"snapshot_dir": snapshot_dir}
+    if collect_metrics:
+        metrics = lib_auto_mesh.Metrics()
+        kwargs["metrics"] = metrics
+    try:
+        sample_working_dir = tempfile.mkdtemp(
+            prefix="%s_" % os.path.basename(os.path.normpath(snapshot_dir)),
+            dir=working_dir,
+        )
+        record["working_dir"] = sample_working_dir
+        if mode == MODE_MESH:
+            result = lib_auto_mesh.autoMesh(
+                snapshot_dir, sample_working_dir, sample_working_dir, **kwargs
+            )
+            list_key = LIST_MESH_KEY
+        elif mode == MODE_CENTRE:
+            result = lib_auto_mesh.findDeltaToCentre(
+                snapshot_dir, sample_working_dir, **kwargs
+            )
+            list_key = LIST_CENTRE_KEY
+        else:
+            raise ValueError("Unknown batch mode: {0}".format(mode))
+        lib_auto_mesh.waitForArtifacts()
+        record["status"] = "ok"
+        record["result"] = {key: toJson(value) for key, value in zip(list_key, result)}
+    except Exception as exception:
+        logging.warning("Analysis of %s failed: %r" % (snapshot_dir, exception))
+        record["status"] = "error"
+        record["error"] = "%s: %s" % (type(exception).__name__, exception)
+        record["traceback"] = traceback.format_exc()
+    if collect_metrics:
+        record["metrics"] = metrics.toDict()
+    record["time"] = time.perf_counter() - start_time
+    return record
+
+
+def runBatch(
+    list_snapshot_dir,
+    working_dir,
+    mode=MODE_MESH,
+    processes=None,
+    max_pending=None,
+    **kwargs
+):
+    """
+    Yields the processSample result of each snapshot directory, in the order
+    they complete. At most max_pending samples (by default twice the number
+    of processes) are submitted to the pool at a time so that the memory
+    used does not grow with the size of the batch. If a worker process
+    dies the samples of the broken pool get an error record and a new pool
+    is started for the others. If processes is 1 the samples are processed
+    in the calling process.
+    """
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if max_pending is None:
+        max_pending = 2 * processes
+    if processes == 1:
+        for snapshot_dir in list_snapshot_dir:
+            yield processSample(snapshot_dir, working_dir, mode=mode, **kwargs)
+        return
+    executor = None
+    dict_pending = {}
+    try:
+        for snapshot_dir in list_snapshot_dir:
+            while True:
+                if executor is None:
+                    executor = concurrent.futures.ProcessPoolExecutor(
+                        max_workers=processes
+                    )
+                try:
+                    future = executor.submit(
+                        processSample, snapshot_dir, working_dir, mode=mode, **kwargs
+                    )
+                    break
+                except concurrent.futures.process.BrokenProcessPool:
+                    # A worker died, the samples it took down get an error
+                    # record, the others go to a new pool
+                    logging.warning("Process pool broken, starting a new one")
+                    executor.shutdown(wait=False)
+                    executor = None
+            dict_pending[future] = snapshot_dir
+            if len(dict_pending) >= max_pending:
+                set_done, _ = concurrent.futures.wait(
+                    dict_pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in set_done:
+                    yield futureRecord(future, dict_pending.pop(future))
+        for future in concurrent.futures.as_completed(list(dict_pending)):
+            yield futureRecord(future, dict_pending.pop(future))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def futureRecord(future, snapshot_dir):
+    """
+    Returns the processSample result of future, or an error record if the
+    sample could not be processed, e.g. because its worker process was
+    killed (out of memory, crash in a C extension).
+    """
+    try:
+        return future.result()
+    except Exception as exception:
+        logging.warning("Analysis of %s failed: %r" % (snapshot_dir, exception))
+        return {
+            "snapshot_dir": snapshot_dir,
+            "status": "error",
+            "error": "%s: %s" % (type(exception).__name__, exception),
+        }
+
+
+def batchAutoMesh(
+    list_snapshot_dir,
+    working_dir,
+    output=None,
+    mode=MODE_MESH,
+    processes=None,
+    max_pending=None,
+    **kwargs
+):
+    """
+    Runs runBatch and writes each result as a JSON line to output (a text
+    stream, by default sys.stdout). Returns a summary dictionary with the
+    number of samples and errors, the elapsed time and the throughput in
+    samples per second.
+    """
+    if output is None:
+        output = sys.stdout
+    start_time = time.perf_counter()
+    no_samples = 0
+    no_errors = 0
+    for record in runBatch(
+        list_snapshot_dir,
+        working_dir,
+        mode=mode,
+        processes=processes,
+        max_pending=max_pending,
+        **kwargs
+    ):
+        no_samples += 1
+        if record["status"] != "ok":
+            no_errors += 1
+        output.write(json.dumps(record) + "\n")
+        output.flush()
+    elapsed = time.perf_counter() - start_time
+    summary = {
+        "samples": no_samples,
+        "errors": no_errors,
+        "elapsed": elapsed,
+        "samples_per_second": no_samples / elapsed if elapsed > 0 else None,
+    }
+    logging.info(
+        "Processed %d samples (%d errors) in %.1f s" % (no_samples, no_errors, elapsed)
+    )
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "snapshot_dirs",
+        nargs="+",
+        help="snapshot directories, snapshot stack files or glob patterns",
+    )
+    parser.add_argument("--working-dir", required=True)
+    parser.add_argument("--mode", choices=[MODE_MESH, MODE_CENTRE], default=MODE_MESH)
+    parser.add_argument("--output", help="JSON lines file, by default stdout")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--max-pending", type=int, default=None)
+    parser.add_argument("--prefix", default="snapshot")
+    parser.add_argument(
+        "--extension", default="png", help="snapshot file extension, e.g. npy"
+    )
+    parser.add_argument(
+        "--background-extension", help="by default the snapshot file extension"
+    )
+    parser.add_argument(
+        "--background",
+        help="background model (.npz) or image used for all the samples",
+    )
+    parser.add_argument("--loop-max-width", type=float, default=300)
+    parser.add_argument("--loop-min-width", type=float, default=150)
+    parser.add_argument("--loop-width", type=float, default=100)
+    parser.add_argument("--find-largest-mesh", action="store_true")
+    parser.add_argument("--adaptive", action="store_true")
+    parser.add_argument(
+        "--pyramid",
+        type=int,
+        choices=[1, 2, 4],
+        default=1,
+        help="downsampling factor of the coarse to fine analysis",
+    )
+    parser.add_argument(
+        "--metrics", action="store_true", help="add the stage timings to the results"
+    )
+    parser.add_argument(
+        "--artifacts",
+        choices=[
+            lib_auto_mesh.ARTIFACTS_NONE,
+            lib_auto_mesh.ARTIFACTS_SUMMARY,
+            lib_auto_mesh.ARTIFACTS_DEBUG,
+        ],
+        default=lib_auto_mesh.ARTIFACTS_NONE,
+    )
+    args = parser.parse_args(argv)
+    if args.mode == MODE_MESH:
+        kwargs = dict(
+            loop_max_width=args.loop_max_width,
+            loop_min_width=args.loop_min_width,
+            find_largest_mesh=args.find_largest_mesh,
+            adaptive=args.adaptive,
+            pyramid=args.pyramid,
+        )
+    else:
+        kwargs = dict(loop_width=args.loop_width)
+    list_snapshot_dir = listSnapshotDirs(args.snapshot_dirs)
+    os.makedirs(args.working_dir, exist_ok=True)
+    output = sys.stdout if args.output is None else open(args.output, "w")
+    try:
+        summary = batchAutoMesh(
+            list_snapshot_dir,
+            args.working_dir,
+            output=output,
+            mode=args.mode,
+            processes=args.processes,
+            max_pending=args.max_pending,
+            prefix=args.prefix,
+            extension=args.extension,
+            background_extension=args.background_extension,
+            background=args.background,
+            artifacts=args.artifacts,
+            collect_metrics=args.metrics,
+            **kwargs
+        )
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    print(
+        "%d samples, %d errors, %.1f s, %.2f samples/s"
+        % (
+            summary["samples"],
+            summary["errors"],
+            summary["elapsed"],
+            summary["samples_per_second"] or 0.0,
+        ),
+        file=sys.stderr,
+    )
+    return 1 if summary["errors"] > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
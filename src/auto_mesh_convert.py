@@ -0,0 +1,104 @@
+"""
+Converts snapshot directories to snapshot stack files.
+
+Each snapshot directory (<prefix>_<omega>.png and <prefix>_background.png)
+is written as one uncompressed npz file holding the stacked snapshots, the
+omega angles and the background, see lib_auto_mesh.saveSnapshotStack.
+autoMesh, findDeltaToCentre and the batch mode read these files in one go
+instead of one file per angle. Example:
+
+    python src/auto_mesh_convert.py --output-dir /data/stacks "/data/plate1/*"
+"""
+
+import os
+import sys
+import logging
+import argparse
+
+import lib_auto_mesh
+import auto_mesh_batch
+
+
+def stackPath(snapshot_dir, output_dir=None):
+    """
+    Returns <output_dir>/<name of snapshot_dir>.npz, by default next to
+    snapshot_dir.
+    """
+    snapshot_dir = os.path.normpath(snapshot_dir)
+    if output_dir is None:
+        output_dir = os.path.dirname(snapshot_dir)
+    return os.path.join(output_dir, os.path.basename(snapshot_dir) + ".npz")
+
+
+def convertSnapshotDirs(list_snapshot_dir, output_dir=None, overwrite=False, **kwargs):
+    """
+    Runs lib_auto_mesh.convertSnapshotDir with kwargs on each directory.
+    Existing stack files are skipped unless overwrite is True. Returns the
+    list of stack files written and the number of errors.
+    """
+    list_stack_path = []
+    no_errors = 0
+    for snapshot_dir in list_snapshot_dir:
+        stack_path = stackPath(snapshot_dir, output_dir)
+        if os.path.exists(stack_path) and not overwrite:
+            logging.info("Skipping %s, %s exists" % (snapshot_dir, stack_path))
+            continue
+        try:
+            list_omega = lib_auto_mesh.convertSnapshotDir(
+                snapshot_dir, stack_path, **kwargs
+            )
+        except Exception as exception:
+            logging.warning("Conversion of %s failed: %r" % (snapshot_dir, exception))
+            no_errors += 1
+            continue
+        logging.info(
+            "Converted %d snapshots of %s to %s"
+            % (len(list_omega), snapshot_dir, stack_path)
+        )
+        list_stack_path.append(stack_path)
+    return list_stack_path, no_errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "snapshot_dirs", nargs="+", help="snapshot directories or glob patterns"
+    )
+    parser.add_argument(
+        "--output-dir", help="by default next to the snapshot directories"
+    )
+    parser.add_argument("--prefix", default="snapshot")
+    parser.add_argument("--extension", default="png")
+    parser.add_argument(
+        "--background-extension", help="by default the snapshot file extension"
+    )
+    parser.add_argument(
+        "--float64",
+        action="store_true",
+        help="store float64 grey images instead of the integer images",
+    )
+    parser.add_argument("--overwrite", action="store_true")
+    args = parser.parse_args(argv)
+    list_snapshot_dir = [
+        snapshot_dir
+        for snapshot_dir in auto_mesh_batch.listSnapshotDirs(args.snapshot_dirs)
+        if os.path.isdir(snapshot_dir)
+    ]
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+    list_stack_path, no_errors = convertSnapshotDirs(
+        list_snapshot_dir,
+        output_dir=args.output_dir,
+        overwrite=args.overwrite,
+        prefix=args.prefix,
+        extension=args.extension,
+        background_extension=args.background_extension,
+        compact=not args.float64,
+    )
+    for stack_path in list_stack_path:
+        print(stack_path)
+    return 1 if no_errors > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,90 @@
+"""
+Replays the mesh finding on loop shapes saved by autoMesh.
+
+autoMesh(..., loop_profile_path=...) saves the loop shapes found in the
+snapshots, this command finds the mesh again from these files with other
+parameters, without reading or processing the images. One JSON line is
+written per file. Example:
+
+    python src/auto_mesh_replay.py --loop-max-width 250 "/archive/*/loops.npz"
+"""
+
+import sys
+import glob
+import json
+import time
+import logging
+import argparse
+
+import lib_auto_mesh
+import auto_mesh_batch
+
+LIST_REPLAY_KEY = [key for key in auto_mesh_batch.LIST_MESH_KEY if key != "image_path"]
+
+
+def replayFiles(list_loop_profile_path, output=None, **kwargs):
+    """
+    Runs lib_auto_mesh.replayAutoMesh with kwargs on each file and writes
+    the results as JSON lines to output (by default sys.stdout). A file
+    that fails gives a line with "status": "error". Returns the number of
+    errors.
+    """
+    if output is None:
+        output = sys.stdout
+    no_errors = 0
+    for loop_profile_path in list_loop_profile_path:
+        start_time = time.perf_counter()
+        record = {"loop_profile_path": loop_profile_path}
+        try:
+            result = lib_auto_mesh.replayAutoMesh(loop_profile_path, **kwargs)
+            record["status"] = "ok"
+            record["result"] = {
+                key: auto_mesh_batch.toJson(value)
+                for key, value in zip(LIST_REPLAY_KEY, result)
+            }
+        except Exception as exception:
+            logging.warning("Replay of %s failed: %r" % (loop_profile_path, exception))
+            no_errors += 1
+            record["status"] = "error"
+            record["error"] = "%s: %s" % (type(exception).__name__, exception)
+        record["time"] = time.perf_counter() - start_time
+        output.write(json.dumps(record) + "\n")
+    output.flush()
+    return no_errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("loop_profiles", nargs="+", help="files or glob patterns")
+    parser.add_argument("--output", help="JSON lines file, by default stdout")
+    parser.add_argument("--loop-max-width", type=float, default=300)
+    parser.add_argument("--loop-min-width", type=float, default=150)
+    parser.add_argument("--find-largest-mesh", action="store_true")
+    parser.add_argument("--nx", type=int, help="image width, for JSON files")
+    parser.add_argument("--ny", type=int, help="image height, for JSON files")
+    args = parser.parse_args(argv)
+    list_loop_profile_path = []
+    for pattern in args.loop_profiles:
+        if glob.has_magic(pattern):
+            list_loop_profile_path += sorted(glob.glob(pattern))
+        else:
+            list_loop_profile_path.append(pattern)
+    output = sys.stdout if args.output is None else open(args.output, "w")
+    try:
+        no_errors = replayFiles(
+            list_loop_profile_path,
+            output=output,
+            loop_max_width=args.loop_max_width,
+            loop_min_width=args.loop_min_width,
+            find_largest_mesh=args.find_largest_mesh,
+            nx=args.nx,
+            ny=args.ny,
+        )
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    return 1 if no_errors > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,241 @@
+"""
+Resident analysis service answering autoMesh and findDeltaToCentre requests.
+
+The service keeps lib_auto_mesh imported, the background images cached and
+a pool of threads for the per-omega analysis, so that a request does not
+pay for the import of numpy, scipy and matplotlib. The requests and the
+responses are JSON lines, either on stdin/stdout or on a local (unix)
+socket:
+
+    python src/auto_mesh_service.py --socket /tmp/auto_mesh.sock
+
+A request is {"id": 1, "method": "autoMesh", "params": {...}} where params
+are the keyword arguments of the method, the response is {"id": 1,
+"result": {...}} or {"id": 1, "error": "..."}. The methods are autoMesh,
+findDeltaToCentre, autoMeshFromSharedMemory,
+findDeltaToCentreFromSharedMemory, ping and shutdown. See AutoMeshClient.
+
+The *FromSharedMemory methods analyse frames published by the acquisition
+process in multiprocessing.shared_memory blocks, the params dict_frame and
+background_frame describe the frames, see lib_auto_mesh.sharedFrames.
+"""
+
+import io
+import os
+import sys
+import json
+import socket
+import logging
+import argparse
+import threading
+import subprocess
+import socketserver
+import concurrent.futures
+
+import lib_auto_mesh
+import auto_mesh_batch
+
+
+class AutoMeshService:
+    """
+    Handles the requests, workers is the size of the thread pool shared by
+    all the requests for the per-omega analysis.
+    """
+
+    def __init__(self, workers=None):
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.shutdown_event = threading.Event()
+
+    def handleRequest(self, request):
+        """
+        Returns the response to request (a dictionary). Errors in the
+        analysis are returned in the response.
+        """
+        response = {"id": request.get("id")}
+        try:
+            method = request.get("method")
+            params = dict(request.get("params", {}))
+            if method == "autoMesh":
+                params.setdefault("executor", self.executor)
+                result = lib_auto_mesh.autoMesh(**params)
+                list_key = auto_mesh_batch.LIST_MESH_KEY
+            elif method == "findDeltaToCentre":
+                params.setdefault("executor", self.executor)
+                result = lib_auto_mesh.findDeltaToCentre(**params)
+                list_key = auto_mesh_batch.LIST_CENTRE_KEY
+            elif method == "autoMeshFromSharedMemory":
+                params.setdefault("executor", self.executor)
+                result = lib_auto_mesh.autoMeshFromSharedMemory(**params)
+                list_key = auto_mesh_batch.LIST_MESH_ARRAYS_KEY
+            elif method == "findDeltaToCentreFromSharedMemory":
+                params.setdefault("executor", self.executor)
+                result = lib_auto_mesh.findDeltaToCentreFromSharedMemory(**params)
+                list_key = auto_mesh_batch.LIST_CENTRE_KEY
+            elif method == "ping":
+                result = ()
+                list_key = []
+            elif method == "shutdown":
+                self.shutdown_event.set()
+                result = ()
+                list_key = []
+            else:
+                raise ValueError("Unknown method: {0}".format(method))
+            response["result"] = {
+                key: auto_mesh_batch.toJson(value)
+                for key, value in zip(list_key, result)
+            }
+        except Exception as exception:
+            logging.warning("Request %r failed: %r" % (request, exception))
+            response["error"] = "%s: %s" % (type(exception).__name__, exception)
+        return response
+
+    def serveStream(self, rfile, wfile):
+        """
+        Answers the JSON line requests read from rfile until end of file or
+        a shutdown request.
+        """
+        for line in rfile:
+            if isinstance(line, bytes):
+                line = line.decode()
+            if line.strip() == "":
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as exception:
+                response = {"id": None, "error": "Invalid request: %s" % exception}
+            else:
+                response = self.handleRequest(request)
+            data = json.dumps(response) + "\n"
+            wfile.write(data if isinstance(wfile, io.TextIOBase) else data.encode())
+            wfile.flush()
+            if self.shutdown_event.is_set():
+                break
+
+    def serveSocket(self, socket_path):
+        """
+        Answers the requests on the unix socket socket_path, one thread per
+        connection, until a shutdown request.
+        """
+        service = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                service.serveStream(self.rfile, self.wfile)
+
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        with socketserver.ThreadingUnixStreamServer(socket_path, Handler) as server:
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            self.shutdown_event.wait()
+            server.shutdown()
+        os.remove(socket_path)
+
+    def close(self):
+        self.executor.shutdown()
+        lib_auto_mesh.waitForArtifacts()
+
+
+class AutoMeshClient:
+    """
+    Client of AutoMeshService, either connected to the unix socket
+    socket_path or, if socket_path is None, to a service started as a
+    sub process and talking on its stdin/stdout. Example::
+
+        with AutoMeshClient("/tmp/auto_mesh.sock") as client:
+            result = client.autoMesh(snapshot_dir=..., workflow_working_dir=...,
+                                     auto_mesh_working_dir=...)
+    """
+
+    def __init__(self, socket_path=None, workers=None):
+        self._socket = None
+        self._process = None
+        self._id = 0
+        self._lock = threading.Lock()
+        if socket_path is None:
+            command = [sys.executable, os.path.abspath(__file__)]
+            if workers is not None:
+                command += ["--workers", str(workers)]
+            self._process = subprocess.Popen(
+                command, stdin=subprocess.PIPE, stdout=subprocess.PIPE
+            )
+            self._wfile = self._process.stdin
+            self._rfile = self._process.stdout
+        else:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.connect(socket_path)
+            self._wfile = self._socket.makefile("wb")
+            self._rfile = self._socket.makefile("rb")
+
+    def call(self, method, **params):
+        """
+        Sends the request and returns the result, raises RuntimeError if
+        the service returned an error.
+        """
+        with self._lock:
+            self._id += 1
+            request = {"id": self._id, "method": method, "params": params}
+            self._wfile.write((json.dumps(request) + "\n").encode())
+            self._wfile.flush()
+            line = self._rfile.readline()
+        if not line:
+            raise RuntimeError("Connection to the auto mesh service closed")
+        response = json.loads(line)
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response["result"]
+
+    def autoMesh(self, **params):
+        return self.call("autoMesh", **params)
+
+    def findDeltaToCentre(self, **params):
+        return self.call("findDeltaToCentre", **params)
+
+    def autoMeshFromSharedMemory(self, **params):
+        return self.call("autoMeshFromSharedMemory", **params)
+
+    def findDeltaToCentreFromSharedMemory(self, **params):
+        return self.call("findDeltaToCentreFromSharedMemory", **params)
+
+    def ping(self):
+        return self.call("ping")
+
+    def shutdown(self):
+        return self.call("shutdown")
+
+    def close(self):
+        if self._process is not None:
+            self._wfile.close()
+            self._process.wait()
+            self._rfile.close()
+        else:
+            self._wfile.close()
+            self._rfile.close()
+            self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--socket", help="unix socket path, by default stdin/stdout")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args(argv)
+    service = AutoMeshService(workers=args.workers)
+    try:
+        if args.socket is None:
+            service.serveStream(sys.stdin, sys.stdout)
+        else:
+            service.serveSocket(args.socket)
+    finally:
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,36 @@
 import os
-import math
+import re
+import json
+import time
 import numpy
-import pylab
-import scipy
+import hashlib
+import zipfile
+import tempfile
+import functools
+import threading
+import contextlib
+import concurrent.futures
+from multiprocessing import shared_memory, resource_tracker
+import scipy.ndimage
 import logging
 import imageio
-import circle_fit
-import matplotlib.pyplot as pyplot
+
+# matplotlib is slow to import and only needed for the plots, it is
+# imported on first use
+
+LIST_OMEGA_MESH = (0, 30, 60, 90, 120, 150, 180, 210, 240, 270, 300, 330)
+LIST_OMEGA_CENTRE = (0, 90, 180, 270)
+LIST_OMEGA_COARSE = (0, 90, 180, 270)
+
+ARTIFACTS_NONE = "none"
+ARTIFACTS_SUMMARY = "summary"
+ARTIFACTS_DEBUG = "debug"
+
+# Arrays of a snapshot stack file, see saveSnapshotStack
+LIST_SNAPSHOT_STACK_KEY = ["omega", "images", "background"]
+
+BACKGROUND_MEDIAN = "median"
+BACKGROUND_ROBUST_MEAN = "robust_mean"
 
 
 def autoMesh(
@@ -18,7 +42,208 @@ def autoMesh(
     prefix="snapshot",
     debug=False,
     find_largest_mesh=False,
+    executor=None,
+    workers=None,
+    artifacts=None,
+    artifact_writer=None,
+    compact=False,
+    list_omega=None,
+    adaptive=False,
+    metrics=None,
+    loop_profile_path=None,
+    extension="png",
+    background_extension=None,
+    pyramid=1,
+    background=None,
 ):
+    """
+    Finds the optimal mesh and oscillation angle from the snapshots
+    <prefix>_<omega>.<extension> for the omega angles in list_omega (by
+    default LIST_OMEGA_MESH, i.e. <prefix>_000.png to <prefix>_330.png) and
+    <prefix>_background.<background_extension> in snapshot_dir, by default
+    background_extension is extension. See readImage for the formats, .npy
+    files are memory mapped. If compact is True the images are kept in
+    their integer type (uint8 or uint16) instead of float64.
+
+    snapshot_dir can also be a snapshot stack file (.npz, see
+    saveSnapshotStack and convertSnapshotDir) holding all the snapshots and
+    the background, read in one go; image_path is then the path of the
+    snapshot written to auto_mesh_working_dir as <prefix>_<omega>.png.
+
+    background, a BackgroundModel or the path of a background model (.npz,
+    see BackgroundModel.save) or image file, replaces the background of
+    snapshot_dir, so that no background needs to be taken for each sample.
+
+    If adaptive is True only the snapshots at 0, 90, 180 and 270 degrees
+    are read first, the others are only read and analysed if the thinnest
+    view of the loop is ambiguous, see AutoMeshAnalyser.
+
+    If loop_profile_path is given the loop shapes found in the images are
+    saved to it (npz file, see saveLoopProfiles) so that the mesh can be
+    found again with other parameters by replayAutoMesh. Nothing is saved
+    if all the images are identical.
+
+    If pyramid is 2 or 4 the loop is located in images downsampled by that
+    factor and its edges refined at full resolution, see
+    analyseImagePyramid for the error bound.
+    """
+    metrics = getMetrics(metrics)
+    with metrics.run("autoMesh"):
+        if list_omega is None:
+            list_omega = LIST_OMEGA_MESH
+        artifact_writer = metrics.artifactWriter(artifact_writer)
+        background, read_snapshots = openSnapshots(
+            snapshot_dir,
+            prefix=prefix,
+            compact=compact,
+            metrics=metrics,
+            extension=extension,
+            background_extension=background_extension,
+            background=background,
+        )
+        with perOmegaExecutor(executor, workers) as executor:
+            analyser = AutoMeshAnalyser(
+                background,
+                auto_mesh_working_dir,
+                loop_max_width=loop_max_width,
+                loop_min_width=loop_min_width,
+                debug=debug,
+                find_largest_mesh=find_largest_mesh,
+                executor=executor,
+                artifacts=artifacts,
+                artifact_writer=artifact_writer,
+                list_omega=list_omega,
+                adaptive=adaptive,
+                metrics=metrics,
+                loop_profile_path=loop_profile_path,
+                pyramid=pyramid,
+            )
+            (
+                angle_min_thickness,
+                x1_pixels,
+                y1_pixels,
+                dx_pixels,
+                dy_pixels,
+                delta_phiz,
+                std_phiz,
+                are_the_same_image,
+            ) = analyser.analyseImages(
+                functools.partial(read_snapshots, executor=executor)
+            )
+        if are_the_same_image:
+            # Path of the last snapshot analysed
+            omega_image = analyser.list_omega[-1]
+        else:
+            omega_image = angle_min_thickness
+        if omega_image is None:
+            image_path = None
+        elif isSnapshotStack(snapshot_dir):
+            # The stack is not an image, the snapshot is written on its own
+            image_path = snapshotPath(auto_mesh_working_dir, prefix, omega_image)
+            writeSnapshotImage(image_path, read_snapshots([omega_image])[omega_image])
+        else:
+            image_path = snapshotPath(snapshot_dir, prefix, omega_image, extension)
+        return (
+            angle_min_thickness,
+            x1_pixels,
+            y1_pixels,
+            dx_pixels,
+            dy_pixels,
+            delta_phiz,
+            std_phiz,
+            image_path,
+            are_the_same_image,
+        )
+
+
+def autoMeshFromArrays(
+    dict_image,
+    background,
+    auto_mesh_working_dir,
+    loop_max_width=300,
+    loop_min_width=150,
+    debug=False,
+    find_largest_mesh=False,
+    executor=None,
+    workers=None,
+    artifacts=None,
+    artifact_writer=None,
+    list_omega=None,
+    adaptive=False,
+    metrics=None,
+    loop_profile_path=None,
+    pyramid=1,
+):
+    """
+    Same analysis as autoMesh but on images already in memory.
+
+    dict_image maps omega (in degrees, int) to a grey scale image as a
+    2D numpy array, background is a 2D numpy array of the same shape or
+    a BackgroundModel. Returns the autoMesh results without the image path.
+    Only the angles in list_omega are used, by default all the angles of
+    dict_image. If adaptive is True the other angles are only analysed if
+    needed, see AutoMeshAnalyser.
+    If the images and the background have the same unsigned integer type
+    (e.g. uint8) the whole analysis is done in that type.
+
+    The images are analysed independently of each other. If executor
+    (a concurrent.futures executor) is given the images are analysed
+    with it, otherwise if workers > 1 a thread pool of that size is used.
+    With a process pool the background is sent along with every image.
+
+    artifacts is one of ARTIFACTS_NONE, ARTIFACTS_SUMMARY or ARTIFACTS_DEBUG,
+    by default ARTIFACTS_DEBUG if debug is True else ARTIFACTS_NONE. The plots
+    are rendered by artifact_writer (by default the module ArtifactWriter)
+    and may not yet be written when this function returns, see
+    waitForArtifacts.
+
+    If metrics (a Metrics) is given the time spent in each stage of the
+    analysis is added to it. See autoMesh for loop_profile_path and pyramid.
+    """
+    metrics = getMetrics(metrics)
+    with metrics.run("autoMeshFromArrays"):
+        if list_omega is None:
+            list_omega = sorted(dict_image)
+        with perOmegaExecutor(executor, workers) as executor:
+            analyser = AutoMeshAnalyser(
+                background,
+                auto_mesh_working_dir,
+                loop_max_width=loop_max_width,
+                loop_min_width=loop_min_width,
+                debug=debug,
+                find_largest_mesh=find_largest_mesh,
+                executor=executor,
+                artifacts=artifacts,
+                artifact_writer=artifact_writer,
+                list_omega=list_omega,
+                adaptive=adaptive,
+                metrics=metrics,
+                loop_profile_path=loop_profile_path,
+                pyramid=pyramid,
+            )
+            return analyser.analyseImages(lambda list_omega_missing: dict_image)
+
+
+def findMeshFromLoops(
+    dict_loop,
+    nx,
+    ny,
+    auto_mesh_working_dir,
+    loop_max_width=300,
+    loop_min_width=150,
+    find_largest_mesh=False,
+    artifacts=ARTIFACTS_NONE,
+    artifact_writer=None,
+    metrics=None,
+    loop_profile_path=None,
+):
+    """
+    Last step of autoMesh: checks that the loop shapes differ and finds
+    the optimal mesh. Returns the autoMesh results without the image path.
+    If loop_profile_path is given and the loop shapes differ they are saved
+    to it, see saveLoopProfiles and replayAutoMesh.
+    """
+    metrics = getMetrics(metrics)
     angle_min_thickness = None
     x1_pixels = None
     y1_pixels = None
@@ -26,305 +251,2346 @@ def autoMesh(
     dy_pixels = None
     delta_phiz = None
     std_phiz = None
-    image_path = None
-    os.chmod(auto_mesh_working_dir, 0o755)
-    background_image = os.path.join(snapshot_dir, "%s_background.png" % prefix)
-    dict_loop = {}
-    for omega in [0, 30, 60, 90, 120, 150, 180, 210, 240, 270, 300, 330]:
+    with metrics.stage("find_mesh"):
+        are_the_same_image = checkForCorrelatedImages(dict_loop)
+        if not are_the_same_image:
+            (
+                angle_min_thickness,
+                x1_pixels,
+                y1_pixels,
+                dx_pixels,
+                dy_pixels,
+                delta_phiz,
+                std_phiz,
+            ) = findOptimalMeshVectorized(
+                dict_loop,
+                None,
+                nx,
+                ny,
+                auto_mesh_working_dir,
+                loop_max_width=loop_max_width,
+                loop_min_width=loop_min_width,
+                find_largest_mesh=find_largest_mesh,
+                artifacts=artifacts,
+                artifact_writer=artifact_writer,
+            )
+    if loop_profile_path is not None and not are_the_same_image:
+        saveLoopProfiles(loop_profile_path, dict_loop, nx, ny)
+    return (
+        angle_min_thickness,
+        x1_pixels,
+        y1_pixels,
+        dx_pixels,
+        dy_pixels,
+        delta_phiz,
+        std_phiz,
+        are_the_same_image,
+    )
+
+
+def submitImageArtifacts(
+    artifact_writer,
+    auto_mesh_working_dir,
+    omega,
+    raw_img,
+    loop,
+    difference_image,
+    filtered_image,
+):
+    """
+    Submits the debug plots of the analysis of one snapshot image.
+    """
+    (list_index, list_upper, list_lower) = loop
+    artifact_writer.submit(
+        plot_img,
+        raw_img,
+        os.path.join(auto_mesh_working_dir, "rawImage_%03d.png" % omega),
+    )
+    artifact_writer.submit(
+        plot_img,
+        difference_image,
+        plot_path=os.path.join(
+            auto_mesh_working_dir, "differenceImage_%03d.png" % omega
+        ),
+    )
+    artifact_writer.submit(
+        plot_img,
+        filtered_image,
+        plot_path=os.path.join(auto_mesh_working_dir, "filteredImage_%03d.png" % omega),
+    )
+    artifact_writer.submit(
+        plotLoopShape,
+        os.path.join(auto_mesh_working_dir, "shapePlot_%03d.png" % omega),
+        list_index,
+        list_upper,
+        list_lower,
+        raw_img.shape,
+    )
+
+
+class AutoMeshAnalyser:
+    """
+    Incremental version of autoMeshFromArrays for snapshots arriving one
+    at a time while the goniometer rotates. Each image given to addImage
+    is analysed right away (in the caller thread, or with executor if
+    given) and the mesh is computed as soon as the last of the expected
+    omega angles has arrived, so that the result is available as soon as
+    the last snapshot is acquired. The images can be given in any order.
+    As long as all the images added are identical (see imageFingerprint)
+    their analysis is deferred, identical images are not analysed at all.
+
+    If adaptive is True only the angles of list_omega in LIST_OMEGA_COARSE
+    are expected at first. Once they are analysed the other angles of
+    list_omega are only requested if the thinnest view of the loop is
+    ambiguous, see isThicknessAmbiguous.
+
+    Example::
+
+        analyser = AutoMeshAnalyser(background, auto_mesh_working_dir)
+        while not analyser.isComplete():
+            for omega in analyser.getMissingOmegas():
+                analyser.addImage(omega, acquireSnapshot(omega))
+        result = analyser.getResult()
+    """
+
+    def __init__(
+        self,
+        background,
+        auto_mesh_working_dir,
+        loop_max_width=300,
+        loop_min_width=150,
+        debug=False,
+        find_largest_mesh=False,
+        executor=None,
+        artifacts=None,
+        artifact_writer=None,
+        list_omega=None,
+        adaptive=False,
+        ambiguity_tolerance=0.25,
+        metrics=None,
+        loop_profile_path=None,
+        pyramid=1,
+    ):
+        if pyramid > 1:
+            self.background = getBackgroundModel(background)
+        else:
+            self.background = getBackgroundImage(background)
+        self.pyramid = pyramid
+        self.auto_mesh_working_dir = auto_mesh_working_dir
+        self.loop_max_width = loop_max_width
+        self.loop_min_width = loop_min_width
+        self.find_largest_mesh = find_largest_mesh
+        self.executor = executor
+        self.artifacts = resolveArtifacts(artifacts, debug)
+        self.metrics = getMetrics(metrics)
+        self.loop_profile_path = loop_profile_path
+        self.artifact_writer = self.metrics.artifactWriter(artifact_writer)
+        if list_omega is None:
+            list_omega = LIST_OMEGA_MESH
+        self.list_omega_all = sorted(list_omega)
+        self.list_omega = list(self.list_omega_all)
+        self.adaptive = adaptive
+        self.ambiguity_tolerance = ambiguity_tolerance
+        if adaptive:
+            list_omega_coarse = [
+                omega for omega in self.list_omega_all if omega in LIST_OMEGA_COARSE
+            ]
+            if len(list_omega_coarse) > 0:
+                self.list_omega = list_omega_coarse
+        self.image_shape = None
+        self.result = None
+        self._dict_analysis = {}
+        self._dict_loop = {}
+        self._dict_fingerprint = {}
+        # Images not analysed as long as they are all identical
+        self._dict_deferred = {}
+        self._lock = threading.Lock()
+        os.chmod(auto_mesh_working_dir, 0o755)
+
+    def addImage(self, omega, image):
+        """
+        Adds the snapshot image taken at omega (in degrees) and starts its
+        analysis. Returns True when all the expected images have been added,
+        the result is then already computed.
+        """
+        with self.metrics.stage("fingerprint", omega):
+            fingerprint = imageFingerprint(image)
+        with self._lock:
+            if omega not in self.list_omega_all:
+                raise ValueError("Unexpected omega angle: {0}".format(omega))
+            if omega in self._dict_fingerprint:
+                raise ValueError("Image for omega {0} already added".format(omega))
+            if omega not in self.list_omega:
+                self.list_omega = sorted(self.list_omega + [omega])
+            if self.image_shape is None:
+                self.image_shape = image.shape
+            self._dict_fingerprint[omega] = fingerprint
+            # The camera sometimes returns the same image for all angles,
+            # the images are only analysed once two of them differ
+            if self._areTheSameImages():
+                self._dict_deferred[omega] = image
+            else:
+                for omega_deferred in sorted(self._dict_deferred):
+                    self._startAnalysis(
+                        omega_deferred, self._dict_deferred.pop(omega_deferred)
+                    )
+                self._startAnalysis(omega, image)
+            if len(self._getMissingOmegas()) > 0:
+                return False
+            self._resolveAnalyses()
+            if self._needsMoreOmegas():
+                self.list_omega = list(self.list_omega_all)
+                logging.info(
+                    "Thinnest view ambiguous, analysing omega %r"
+                    % self._getMissingOmegas()
+                )
+                return False
+            self._computeResult()
+            return True
+
+    def _startAnalysis(self, omega, image):
         logging.info("Analysing snapshot image at omega = %d degrees" % omega)
-        image_path = os.path.join(snapshot_dir, "%s_%03d.png" % (prefix, omega))
-        raw_img = readImage(image_path)
+        if self.executor is None:
+            analysis = analyseImage(
+                image,
+                self.background,
+                return_images=self.artifacts == ARTIFACTS_DEBUG,
+                metrics=self.metrics,
+                omega=omega,
+                pyramid=self.pyramid,
+            )
+        else:
+            analysis = self.executor.submit(
+                analyseImage,
+                image,
+                self.background,
+                return_images=self.artifacts == ARTIFACTS_DEBUG,
+                metrics=self.metrics,
+                omega=omega,
+                pyramid=self.pyramid,
+            )
+        self._dict_analysis[omega] = (image, analysis)
+
+    def analyseImages(self, get_images):
+        """
+        Adds the images returned by get_images(list_omega), a dictionary
+        omega -> image, for the missing angles until the analysis is
+        complete and returns the result.
+        """
+        while not self.isComplete():
+            list_omega = self.getMissingOmegas()
+            dict_image = get_images(list_omega)
+            for omega in list_omega:
+                self.addImage(omega, dict_image[omega])
+        return self.getResult()
+
+    def isComplete(self):
+        with self._lock:
+            return len(self._getMissingOmegas()) == 0
+
+    def getMissingOmegas(self):
+        with self._lock:
+            return self._getMissingOmegas()
+
+    def getResult(self):
+        """
+        Returns the same results as autoMeshFromArrays, waiting for the
+        analysis of the images still running. All the images must have
+        been added.
+        """
+        with self._lock:
+            if self.result is None:
+                list_omega_missing = self._getMissingOmegas()
+                if len(list_omega_missing) > 0:
+                    raise RuntimeError(
+                        "Missing snapshot images for omega {0}".format(
+                            list_omega_missing
+                        )
+                    )
+                self._resolveAnalyses()
+                self._computeResult()
+            return self.result
+
+    def _getMissingOmegas(self):
+        return [
+            omega for omega in self.list_omega if omega not in self._dict_fingerprint
+        ]
+
+    def _resolveAnalyses(self):
+        # Waits for the analyses and keeps only the loop shapes
+        for omega in sorted(self._dict_analysis):
+            image, analysis = self._dict_analysis.pop(omega)
+            if isinstance(analysis, concurrent.futures.Future):
+                analysis = analysis.result()
+            if self.artifacts == ARTIFACTS_DEBUG:
+                loop, difference_image, filtered_image = analysis
+                submitImageArtifacts(
+                    self.artifact_writer,
+                    self.auto_mesh_working_dir,
+                    omega,
+                    image,
+                    loop,
+                    difference_image,
+                    filtered_image,
+                )
+            else:
+                loop = analysis
+            self._dict_loop[omega] = loop
+
+    def _areTheSameImages(self):
+        return len(set(self._dict_fingerprint.values())) == 1
+
+    def _needsMoreOmegas(self):
+        if not self.adaptive or len(self.list_omega) == len(self.list_omega_all):
+            return False
+        if self._areTheSameImages():
+            return False
+        dict_loop = {"%d" % omega: loop for omega, loop in self._dict_loop.items()}
+        return isThicknessAmbiguous(
+            dict_loop,
+            loop_max_width=self.loop_max_width,
+            tolerance=self.ambiguity_tolerance,
+        )
+
+    def _computeResult(self):
+        if self._areTheSameImages():
+            logging.warning("All the snapshot images are identical")
+            self.result = (None,) * 7 + (True,)
+        else:
+            dict_loop = {
+                "%d" % omega: self._dict_loop[omega] for omega in self.list_omega
+            }
+            ny, nx = self.image_shape
+            self.metrics.setInfo("image_shape", [ny, nx])
+            self.result = findMeshFromLoops(
+                dict_loop,
+                nx,
+                ny,
+                self.auto_mesh_working_dir,
+                loop_max_width=self.loop_max_width,
+                loop_min_width=self.loop_min_width,
+                find_largest_mesh=self.find_largest_mesh,
+                artifacts=self.artifacts,
+                artifact_writer=self.artifact_writer,
+                metrics=self.metrics,
+                loop_profile_path=self.loop_profile_path,
+            )
+
+
+def isThicknessAmbiguous(dict_loop, loop_max_width=300, tolerance=0.25):
+    """
+    Returns True if it is not clear from the loop shapes in dict_loop at
+    which angle the loop is thinnest. The thickness of the loop is measured
+    over the last loop_max_width columns at each angle, opposite angles
+    give the same view. The result is ambiguous if the thinnest view is
+    less than tolerance (relative) thinner than the thickest view, or if
+    there are less than two different views.
+    """
+    list_index_max = []
+    for (list_index, list_upper, list_lower) in dict_loop.values():
+        if len(list_index) == 0:
+            return True
+        list_index_max.append(numpy.max(list_index))
+    mesh_xmax = min(list_index_max)
+    dict_view_thickness = {}
+    for str_omega, (list_index, list_upper, list_lower) in dict_loop.items():
+        array_index = numpy.asarray(list_index)
+        indices = numpy.where(
+            (array_index > mesh_xmax - loop_max_width) & (array_index <= mesh_xmax)
+        )
+        if len(indices[0]) == 0:
+            return True
+        thickness = numpy.max(numpy.asarray(list_upper)[indices]) - numpy.min(
+            numpy.asarray(list_lower)[indices]
+        )
+        view = int(str_omega) % 180
+        dict_view_thickness.setdefault(view, []).append(thickness)
+    if len(dict_view_thickness) < 2:
+        return True
+    list_thickness = [numpy.mean(value) for value in dict_view_thickness.values()]
+    logging.debug("Loop thickness per view: %r" % dict_view_thickness)
+    return min(list_thickness) > (1 - tolerance) * max(list_thickness)
+
+
+def findDeltaToCentre(
+    snapshot_dir,
+    auto_mesh_working_dir,
+    prefix="snapshot",
+    loop_width=100,
+    do_circle_fit=False,
+    debug=False,
+    is_vertical_axis=False,
+    executor=None,
+    workers=None,
+    artifacts=None,
+    artifact_writer=None,
+    compact=False,
+    list_omega=None,
+    metrics=None,
+    extension="png",
+    background_extension=None,
+    background=None,
+):
+    """
+    Finds the offset of the pin from the rotation axis from the snapshots
+    at the omega angles in list_omega, by default LIST_OMEGA_CENTRE. At
+    least three different angles (modulo 180 degrees) are needed. See
+    autoMesh for the snapshot file names, the snapshot stack files and
+    background.
+    """
+    metrics = getMetrics(metrics)
+    with metrics.run("findDeltaToCentre"):
+        if list_omega is None:
+            list_omega = LIST_OMEGA_CENTRE
+        background, read_snapshots = openSnapshots(
+            snapshot_dir,
+            prefix=prefix,
+            compact=compact,
+            metrics=metrics,
+            extension=extension,
+            background_extension=background_extension,
+            background=background,
+        )
+        with perOmegaExecutor(executor, workers) as executor:
+            dict_image = read_snapshots(list_omega, executor=executor)
+            return findDeltaToCentreFromArrays(
+                dict_image,
+                background,
+                auto_mesh_working_dir,
+                loop_width=loop_width,
+                do_circle_fit=do_circle_fit,
+                debug=debug,
+                is_vertical_axis=is_vertical_axis,
+                executor=executor,
+                artifacts=artifacts,
+                artifact_writer=artifact_writer,
+                metrics=metrics,
+            )
+
+
+def findDeltaToCentreFromArrays(
+    dict_image,
+    background,
+    auto_mesh_working_dir,
+    loop_width=100,
+    do_circle_fit=False,
+    debug=False,
+    is_vertical_axis=False,
+    executor=None,
+    workers=None,
+    artifacts=None,
+    artifact_writer=None,
+    list_omega=None,
+    metrics=None,
+):
+    """
+    Same analysis as findDeltaToCentre but on images already in memory,
+    see autoMeshFromArrays for the format of dict_image and background
+    and for the executor, workers and artifacts options. By default all
+    the angles of dict_image are used.
+    """
+    metrics = getMetrics(metrics)
+    with metrics.run("findDeltaToCentreFromArrays"):
+        artifact_writer = metrics.artifactWriter(artifact_writer)
+        background = getBackgroundImage(background)
+        os.chmod(auto_mesh_working_dir, 0o755)
+        image_size = background.shape
+        if list_omega is None:
+            list_omega = sorted(dict_image)
+        with perOmegaExecutor(executor, workers) as executor:
+            list_loop = mapPerOmega(
+                executor,
+                functools.partial(
+                    analyseImageAtOmega, background=background, metrics=metrics
+                ),
+                list_omega,
+                [dict_image[omega] for omega in list_omega],
+            )
+        dict_loop = {}
+        for omega, loop in zip(list_omega, list_loop):
+            logging.info("Analysed snapshot image at omega = %d degrees" % omega)
+            dict_loop["%d" % omega] = loop
+        # areTheSameImage = checkForCorrelatedImages(dict_loop)
+        ny, nx = dict_image[list_omega[0]].shape[:2]
+        metrics.setInfo("image_shape", [ny, nx])
+        with metrics.stage("find_centre"):
+            delta_x, delta_y, delta_z = findCentrePin(
+                dict_loop,
+                None,
+                nx,
+                ny,
+                auto_mesh_working_dir,
+                do_circle_fit=do_circle_fit,
+                debug=debug,
+                isVerticalAxis=is_vertical_axis,
+                image_size=image_size,
+                loop_width=loop_width,
+                artifacts=artifacts,
+                artifact_writer=artifact_writer,
+            )
+        return delta_x, delta_y, delta_z
+
+
+def findCentrePin(
+    dict_loop,
+    snapshotDir,
+    nx,
+    ny,
+    auto_mesh_working_dir,
+    loop_width=100,
+    image_size=None,
+    do_circle_fit=False,
+    debug=False,
+    isVerticalAxis=False,
+    artifacts=None,
+    artifact_writer=None,
+):
+    artifacts = resolveArtifacts(artifacts, debug)
+    artifact_writer = getArtifactWriter(artifact_writer)
+    dict_vertical = {}
+    list_horizontal = []
+    list_omega = sorted(int(str_omega) for str_omega in dict_loop)
+    list_shape = []
+    for omega in list_omega:
+        str_omega1 = "%d" % omega
+        (array_index1, array_upper1, array_lower1) = asLoopProfile(
+            dict_loop[str_omega1]
+        )
+        index_max = len(array_index1)
+        if index_max == 0:
+            raise RuntimeError("No pin found for omega {0}!".format(str_omega1))
+        index_min = index_max - int(loop_width / 3)
+        index_loop = array_index1[index_min:index_max - 1]
+        array_upper1 = array_upper1[index_min:index_max - 1]
+        array_lower1 = array_lower1[index_min:index_max - 1]
+        list_shape.append((array_index1[-1], index_loop, array_upper1, array_lower1))
+
+    if do_circle_fit:
+        # The upper and lower edges of all the angles in one fit
+        array_xc, array_yc, array_r = fitCircles(
+            [numpy.concatenate([shape[1], shape[1]]) for shape in list_shape],
+            [numpy.concatenate([shape[2], shape[3]]) for shape in list_shape],
+        )
+    for index, omega in enumerate(list_omega):
+        index_end, index_loop, array_upper1, array_lower1 = list_shape[index]
+        mean_array = (array_lower1 + array_upper1) / 2
+        if do_circle_fit:
+            xc = array_xc[index]
+            yc = array_yc[index]
+            r = array_r[index]
+        else:
+            r = None
+            xc = index_end - int(loop_width / 2)
+            yc = numpy.mean(mean_array)
+
+        if artifacts != ARTIFACTS_NONE:
+            artifact_writer.submit(
+                plotCentrePin,
+                os.path.join(auto_mesh_working_dir, "shapePlot_mean_%03d.png" % omega),
+                index_loop,
+                array_upper1,
+                array_lower1,
+                mean_array,
+                xc,
+                yc,
+                # The fitted circle is only drawn in the debug plots
+                r if artifacts == ARTIFACTS_DEBUG else None,
+            )
+        # Calculate deltaZ (phiy)
+        deltaZ = int(image_size[1] / 2) - xc
+        dict_vertical[omega] = yc
+        list_horizontal.append(deltaZ)
+
+    mean_delta_x, mean_delta_y = fitVerticalOffset(dict_vertical)
+    mean_delta_z = numpy.mean(list_horizontal)
+    return mean_delta_x, mean_delta_y, mean_delta_z
+
+
+def fitCircles(list_x, list_y, iterations=50, tolerance=1e-8, halvings=30):
+    """
+    Fits a circle to each set of points (list_x[i], list_y[i]) and returns
+    the arrays of the centres x and y and of the radii. All the fits are
+    done at once by damped Newton iterations (Gauss-Newton where not
+    convex) minimising the sum of the squared differences between the
+    distances of the points to the centre and their mean, the same
+    geometric fit as circle_fit.least_squares_circle. As the cost can have
+    several minima on short noisy arcs each fit is started both from the
+    algebraic (Kasa) fit and from the centroid of the points, as
+    circle_fit does, and the lowest cost is kept; a fit ending with a higher
+    cost than the Kasa fit returns the Kasa fit. See refineCircles for
+    iterations, tolerance and halvings.
+    """
+    no_points = max(len(array_x) for array_x in list_x)
+    array_x = numpy.zeros((len(list_x), no_points))
+    array_y = numpy.zeros((len(list_x), no_points))
+    weight = numpy.zeros((len(list_x), no_points))
+    for index, (x, y) in enumerate(zip(list_x, list_y)):
+        array_x[index, : len(x)] = x
+        array_y[index, : len(y)] = y
+        weight[index, : len(x)] = 1
+    no_points = weight.sum(axis=1)
+    if numpy.any(no_points < 3):
+        raise RuntimeError("At least three points are needed to fit a circle")
+    # Relative to the centroid for the numerical precision
+    x_mean = (weight * array_x).sum(axis=1) / no_points
+    y_mean = (weight * array_y).sum(axis=1) / no_points
+    array_x = (array_x - x_mean[:, None]) * weight
+    array_y = (array_y - y_mean[:, None]) * weight
+    # Kasa fit: x**2 + y**2 + d * x + e * y + f = 0 in the least squares sense
+    design = numpy.stack([array_x, array_y, weight], axis=2)
+    target = -(array_x**2 + array_y**2)
+    try:
+        solution = numpy.linalg.solve(
+            design.transpose(0, 2, 1) @ design,
+            design.transpose(0, 2, 1) @ target[:, :, None],
+        )[:, :, 0]
+    except numpy.linalg.LinAlgError:
+        raise RuntimeError("Cannot fit a circle to aligned points")
+    xc_kasa = -solution[:, 0] / 2
+    yc_kasa = -solution[:, 1] / 2
+    cost_kasa = _circleCost(xc_kasa, yc_kasa, array_x, array_y, weight)
+    no_fits = len(list_x)
+    xc, yc, cost = refineCircles(
+        numpy.concatenate([xc_kasa, numpy.zeros(no_fits)]),
+        numpy.concatenate([yc_kasa, numpy.zeros(no_fits)]),
+        numpy.concatenate([array_x, array_x]),
+        numpy.concatenate([array_y, array_y]),
+        numpy.concatenate([weight, weight]),
+        iterations=iterations,
+        tolerance=tolerance,
+        halvings=halvings,
+    )
+    from_centroid = cost[no_fits:] < cost[:no_fits]
+    xc = numpy.where(from_centroid, xc[no_fits:], xc[:no_fits])
+    yc = numpy.where(from_centroid, yc[no_fits:], yc[:no_fits])
+    cost = numpy.where(from_centroid, cost[no_fits:], cost[:no_fits])
+    use_kasa = ~(cost <= cost_kasa)
+    xc[use_kasa] = xc_kasa[use_kasa]
+    yc[use_kasa] = yc_kasa[use_kasa]
+    distance = numpy.hypot(xc[:, None] - array_x, yc[:, None] - array_y)
+    r = (distance * weight).sum(axis=1) / no_points
+    return xc + x_mean, yc + y_mean, r
+
+
+def refineCircles(
+    xc, yc, array_x, array_y, weight, iterations=50, tolerance=1e-8, halvings=30
+):
+    """
+    Refines the centres (xc, yc) of the circle fits of fitCircles, the
+    points are relative to their centroid, padded with weight 0. Each fit
+    has its own step, halved at most halvings times until the cost
+    decreases, and stops when its centre moves by less than tolerance
+    relative to its distance to the centroid or when the cost cannot be
+    decreased. Centres further than 1e6 times the size of the set of points
+    are rejected: the cost of such nearly straight circles is dominated by
+    rounding errors. Returns the centres and their costs.
+    """
+    xc = numpy.array(xc, dtype=float)
+    yc = numpy.array(yc, dtype=float)
+    cost = _circleCost(xc, yc, array_x, array_y, weight)
+    scale = numpy.hypot(xc, yc) + 1
+    max_distance = 1e6 * numpy.sqrt(
+        (array_x**2 + array_y**2).sum(axis=1) / weight.sum(axis=1)
+    )
+    active = numpy.isfinite(cost)
+    for _ in range(iterations):
+        if not active.any():
+            break
+        index_active = numpy.flatnonzero(active)
+        step_x, step_y = _circleStep(
+            xc[index_active],
+            yc[index_active],
+            array_x[index_active],
+            array_y[index_active],
+            weight[index_active],
+        )
+        # Fits without a valid step stop here
+        valid = numpy.isfinite(step_x) & numpy.isfinite(step_y)
+        active[index_active[~valid]] = False
+        index_active = index_active[valid]
+        step_x = step_x[valid]
+        step_y = step_y[valid]
+        # Step halving until the cost decreases, separately for each fit
+        factor = numpy.ones(len(index_active))
+        pending = numpy.ones(len(index_active), dtype=bool)
+        for _ in range(halvings + 1):
+            index = index_active[pending]
+            new_xc = xc[index] - factor[pending] * step_x[pending]
+            new_yc = yc[index] - factor[pending] * step_y[pending]
+            new_cost = _circleCost(
+                new_xc, new_yc, array_x[index], array_y[index], weight[index]
+            )
+            decreased = (new_cost <= cost[index]) & (
+                numpy.hypot(new_xc, new_yc) <= max_distance[index]
+            )
+            xc[index[decreased]] = new_xc[decreased]
+            yc[index[decreased]] = new_yc[decreased]
+            cost[index[decreased]] = new_cost[decreased]
+            pending[numpy.flatnonzero(pending)[decreased]] = False
+            if not pending.any():
+                break
+            factor[pending] /= 2
+        moved = factor * numpy.hypot(step_x, step_y)
+        converged = pending | (moved <= tolerance * scale[index_active])
+        active[index_active[converged]] = False
+    return xc, yc, cost
+
+
+def _circleCost(xc, yc, array_x, array_y, weight):
+    """
+    Sum of the squared differences between the distances of the points to
+    the centres and their mean, per fit.
+    """
+    distance = numpy.hypot(xc[:, None] - array_x, yc[:, None] - array_y) * weight
+    residual = distance - distance.sum(axis=1, keepdims=True) / weight.sum(
+        axis=1, keepdims=True
+    )
+    return ((residual * weight) ** 2).sum(axis=1)
+
+
+def _circleStep(xc, yc, array_x, array_y, weight):
+    """
+    Newton step of each fit of fitCircles, Gauss-Newton step where the
+    Hessian is not positive definite, NaN where neither can be computed.
+    """
+    no_points = weight.sum(axis=1)[:, None]
+    delta_x = xc[:, None] - array_x
+    delta_y = yc[:, None] - array_y
+    distance = numpy.hypot(delta_x, delta_y)
+    distance[(weight == 0) | (distance == 0)] = 1
+    unit_x = delta_x / distance
+    unit_y = delta_y / distance
+    residual = distance * weight
+    residual -= residual.sum(axis=1, keepdims=True) / no_points
+    residual *= weight
+    jacobian_x = unit_x - (weight * unit_x).sum(axis=1, keepdims=True) / no_points
+    jacobian_x *= weight
+    jacobian_y = unit_y - (weight * unit_y).sum(axis=1, keepdims=True) / no_points
+    jacobian_y *= weight
+    curvature = residual / distance
+    gauss_a = (jacobian_x * jacobian_x).sum(axis=1)
+    gauss_b = (jacobian_x * jacobian_y).sum(axis=1)
+    gauss_c = (jacobian_y * jacobian_y).sum(axis=1)
+    a = gauss_a + (curvature * (1 - unit_x * unit_x)).sum(axis=1)
+    b = gauss_b - (curvature * unit_x * unit_y).sum(axis=1)
+    c = gauss_c + (curvature * (1 - unit_y * unit_y)).sum(axis=1)
+    determinant = a * c - b * b
+    # Not convex here, Gauss-Newton step
+    not_convex = (determinant <= 0) | (a <= 0)
+    a = numpy.where(not_convex, gauss_a, a)
+    b = numpy.where(not_convex, gauss_b, b)
+    c = numpy.where(not_convex, gauss_c, c)
+    determinant = a * c - b * b
+    determinant[determinant <= 0] = numpy.nan
+    gradient_x = (jacobian_x * residual).sum(axis=1)
+    gradient_y = (jacobian_y * residual).sum(axis=1)
+    step_x = (c * gradient_x - b * gradient_y) / determinant
+    step_y = (a * gradient_y - b * gradient_x) / determinant
+    return step_x, step_y
+
+
+def fitVerticalOffset(dict_vertical):
+    """
+    Fits y(omega) = y0 + a * cos(omega) + b * sin(omega) to the vertical
+    position of the pin at each omega (in degrees) and returns (b, -a),
+    the offsets of the pin from the rotation axis. For omega 0, 90, 180
+    and 270 this is ((y90 - y270) / 2, (y180 - y0) / 2). At least three
+    different angles are needed.
+    """
+    array_omega = numpy.radians(list(dict_vertical))
+    array_vertical = numpy.array(list(dict_vertical.values()), dtype=float)
+    # Rounded so that e.g. cos(90) is exactly zero
+    matrix = numpy.round(
+        numpy.stack(
+            [
+                numpy.ones_like(array_omega),
+                numpy.cos(array_omega),
+                numpy.sin(array_omega),
+            ],
+            axis=1,
+        ),
+        15,
+    )
+    if numpy.linalg.matrix_rank(matrix) < 3:
+        raise RuntimeError(
+            "Cannot find the centre from omega {0}".format(list(dict_vertical))
+        )
+    solution = numpy.linalg.solve(matrix.T @ matrix, matrix.T @ array_vertical)
+    _, a, b = solution
+    return b, -a
+
+
+def resolveArtifacts(artifacts, debug=False):
+    """
+    Returns the artifact policy: ARTIFACTS_NONE (no plots), ARTIFACTS_SUMMARY
+    (shape and phiz summary plots) or ARTIFACTS_DEBUG (all plots). If
+    artifacts is None the policy is given by the debug flag.
+    """
+    if artifacts is None:
+        artifacts = ARTIFACTS_DEBUG if debug else ARTIFACTS_NONE
+    if artifacts not in (ARTIFACTS_NONE, ARTIFACTS_SUMMARY, ARTIFACTS_DEBUG):
+        raise ValueError("Unknown artifact policy: {0}".format(artifacts))
+    return artifacts
+
+
+class ArtifactWriter:
+    """
+    Renders and saves the plots in background threads so that the
+    analysis results are returned before the PNG files are written.
+    """
+
+    def __init__(self, max_workers=1):
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="ArtifactWriter"
+        )
+        self._lock = threading.Lock()
+        self._futures = set()
+
+    def submit(self, function, *args, **kwargs):
+        future = self._executor.submit(self._render, function, *args, **kwargs)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._discard)
+        return future
+
+    def wait(self):
+        """
+        Waits until all the artifacts submitted so far are written.
+        """
+        with self._lock:
+            list_future = list(self._futures)
+        concurrent.futures.wait(list_future)
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown()
+
+    def _discard(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    @staticmethod
+    def _render(function, *args, **kwargs):
+        try:
+            function(*args, **kwargs)
+        except Exception:
+            logging.exception("Failed to write artifact")
+
+
+_artifact_writer = None
+_artifact_writer_lock = threading.Lock()
+
+
+def getArtifactWriter(artifact_writer=None):
+    """
+    Returns artifact_writer if not None, otherwise the module ArtifactWriter.
+    """
+    global _artifact_writer
+    if artifact_writer is not None:
+        return artifact_writer
+    with _artifact_writer_lock:
+        if _artifact_writer is None:
+            _artifact_writer = ArtifactWriter()
+        return _artifact_writer
+
+
+def waitForArtifacts(artifact_writer=None):
+    getArtifactWriter(artifact_writer).wait()
+
+
+class Metrics:
+    """
+    Collects the wall time of the analysis stages, per omega angle where
+    it applies, and a few counters (images and bytes read, including the
+    background unless it is taken from the cache, image shape).
+    Give an instance as the metrics argument of autoMesh, autoMeshFromArrays,
+    findDeltaToCentre or findDeltaToCentreFromArrays and read toDict()
+    afterwards, or give a callback and/or a json_path: at the end of each
+    run callback(metrics_dict) is called and the dictionary is written to
+    json_path.
+
+    The stages are read_background, read, fingerprint, subtract_background,
+    region_of_interest, filter, loop_exam, find_mesh, find_centre and
+    artifacts (rendering of the plots finished before the end of the run),
+    and downsample and refine in the pyramid mode (see analyseImagePyramid).
+    The metrics are not collected from images analysed in a process pool.
+    """
+
+    def __init__(self, callback=None, json_path=None):
+        self.callback = callback
+        self.json_path = json_path
+        self._lock = threading.Lock()
+        self._depth = 0
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.dict_stage = {}
+            self.dict_omega = {}
+            self.dict_counter = {}
+            self.dict_info = {}
+
+    def stage(self, name, omega=None):
+        """
+        Context manager adding the time spent in the block to the stage.
+        """
+        return _MetricsStage(self, name, omega)
+
+    def addTime(self, name, seconds, omega=None):
+        with self._lock:
+            self.dict_stage[name] = self.dict_stage.get(name, 0.0) + seconds
+            if omega is not None:
+                dict_omega_stage = self.dict_omega.setdefault(omega, {})
+                dict_omega_stage[name] = dict_omega_stage.get(name, 0.0) + seconds
+
+    def addCount(self, name, value=1):
+        with self._lock:
+            self.dict_counter[name] = self.dict_counter.get(name, 0) + value
+
+    def setInfo(self, name, value):
+        with self._lock:
+            self.dict_info[name] = value
+
+    def addImage(self, image_path):
+        """
+        Counts an image read from image_path.
+        """
+        self.addCount("images_read")
+        self.addCount("bytes_read", os.path.getsize(image_path))
+
+    def artifactWriter(self, artifact_writer):
+        """
+        Returns artifact_writer timing the plots in the artifacts stage.
+        """
+        if (
+            isinstance(artifact_writer, _TimedArtifactWriter)
+            and artifact_writer.metrics is self
+        ):
+            return artifact_writer
+        return _TimedArtifactWriter(getArtifactWriter(artifact_writer), self)
+
+    @contextlib.contextmanager
+    def run(self, name):
+        """
+        Context manager around a whole analysis, name is recorded with its
+        total time and the metrics are published at the end of the
+        outermost run.
+        """
+        with self._lock:
+            self._depth += 1
+            is_outermost = self._depth == 1
+        start_time = time.perf_counter()
+        try:
+            yield self
+        finally:
+            if is_outermost:
+                self.setInfo("run", name)
+                self.addTime("total", time.perf_counter() - start_time)
+            with self._lock:
+                self._depth -= 1
+            if is_outermost:
+                self.publish()
+
+    def toDict(self):
+        with self._lock:
+            return {
+                "stages": dict(self.dict_stage),
+                "omega": {
+                    "%d" % omega: dict(dict_omega_stage)
+                    for omega, dict_omega_stage in sorted(self.dict_omega.items())
+                },
+                "counters": dict(self.dict_counter),
+                "info": dict(self.dict_info),
+            }
+
+    def __reduce__(self):
+        # Sent to a process pool as a Metrics doing nothing
+        return (_NoMetrics, ())
+
+    def publish(self):
+        if self.callback is None and self.json_path is None:
+            return
+        dict_metrics = self.toDict()
+        if self.callback is not None:
+            self.callback(dict_metrics)
+        if self.json_path is not None:
+            with open(self.json_path, "w") as f:
+                json.dump(dict_metrics, f, indent=4)
+
+
+class _MetricsStage:
+    __slots__ = ("metrics", "name", "omega", "start_time")
+
+    def __init__(self, metrics, name, omega):
+        self.metrics = metrics
+        self.name = name
+        self.omega = omega
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+
+    def __exit__(self, *args):
+        self.metrics.addTime(
+            self.name, time.perf_counter() - self.start_time, self.omega
+        )
+
+
+class _TimedArtifactWriter:
+    def __init__(self, artifact_writer, metrics):
+        self.artifact_writer = artifact_writer
+        self.metrics = metrics
+
+    def submit(self, function, *args, **kwargs):
+        return self.artifact_writer.submit(self._timed, function, *args, **kwargs)
+
+    def _timed(self, function, *args, **kwargs):
+        with self.metrics.stage("artifacts"):
+            function(*args, **kwargs)
+
+    def wait(self):
+        self.artifact_writer.wait()
+
+
+class _NoMetrics:
+    """
+    Metrics used when none is given, does nothing.
+    """
+
+    _null_context = contextlib.nullcontext()
+
+    def stage(self, name, omega=None):
+        return self._null_context
+
+    def addTime(self, name, seconds, omega=None):
+        pass
+
+    def addCount(self, name, value=1):
+        pass
+
+    def setInfo(self, name, value):
+        pass
+
+    def addImage(self, image_path):
+        pass
+
+    def artifactWriter(self, artifact_writer):
+        return getArtifactWriter(artifact_writer)
+
+    def run(self, name):
+        return self._null_context
+
+
+NO_METRICS = _NoMetrics()
+
+
+def getMetrics(metrics=None):
+    """
+    Returns metrics if not None, otherwise NO_METRICS.
+    """
+    return NO_METRICS if metrics is None else metrics
+
+
+def analyseImage(
+    raw_img,
+    background,
+    return_images=False,
+    use_roi=True,
+    metrics=None,
+    omega=None,
+    pyramid=1,
+):
+    """
+    Per-image part of the analysis: background subtraction, filtering
+    and loop examination. Returns the loop shape as returned by loopExam,
+    if return_images is True the difference and filtered images are also
+    returned. background is an array or a BackgroundModel.
+
+    If use_roi is True the filtering and the loop examination are only
+    done inside the region returned by findRegionOfInterest, which gives
+    the same results as processing the full image. If pyramid is 2 or 4
+    the loop is first located in images downsampled by that factor, see
+    analyseImagePyramid. The time of each step is added to metrics (see
+    Metrics) for the given omega.
+    """
+    if pyramid > 1:
+        return analyseImagePyramid(
+            raw_img,
+            background,
+            factor=pyramid,
+            return_images=return_images,
+            metrics=metrics,
+            omega=omega,
+        )
+    metrics = getMetrics(metrics)
+    background = getBackgroundImage(background)
+    with metrics.stage("subtract_background", omega):
+        difference_image = subtractBackground(raw_img, background)
+    ny, nx = difference_image.shape
+    if use_roi:
+        with metrics.stage("region_of_interest", omega):
+            roi = findRegionOfInterest(difference_image)
+    else:
+        roi = (0, ny, 0, nx)
+    if roi is None:
+        loop = LoopProfile.fromColumns([], [], [])
+        filtered_image = numpy.zeros((ny, nx), dtype=bool)
+    else:
+        row_min, row_max, column_min, column_max = roi
+        with metrics.stage("filter", omega):
+            filtered_roi = filterDifferenceImage(
+                difference_image[row_min:row_max, column_min:column_max]
+            )
+        with metrics.stage("loop_exam", omega):
+            loop = loopExam(filtered_roi, x_offset=column_min, y_offset=ny - row_max)
+        if return_images:
+            filtered_image = numpy.zeros((ny, nx), dtype=bool)
+            filtered_image[row_min:row_max, column_min:column_max] = filtered_roi
+    if return_images:
+        return loop, difference_image, filtered_image
+    return loop
+
+
+def analyseImageAtOmega(
+    omega, raw_img, background, return_images=False, metrics=None, pyramid=1
+):
+    """
+    analyseImage with omega first, for mapPerOmega.
+    """
+    return analyseImage(
+        raw_img,
+        background,
+        return_images=return_images,
+        metrics=metrics,
+        omega=omega,
+        pyramid=pyramid,
+    )
+
+
+def analyseImagePyramid(
+    raw_img,
+    background,
+    factor=2,
+    return_images=False,
+    metrics=None,
+    omega=None,
+    threshold_value=30,
+    tile_width=128,
+):
+    """
+    Coarse to fine version of analyseImage. The loop is located in the
+    difference between the factor x factor block means (see blockMean) of
+    the image and of the background, filtered with a single erosion and
+    dilation. The upper and lower edges of the loop are then found at full
+    resolution, with filterDifferenceImage, only in bands around the coarse
+    edges: for each tile of tile_width columns the band goes from the
+    highest to the lowest coarse edge of the tile and of its neighbouring
+    columns, widened by 2 * factor pixels.
+
+    Error bound: the bands are filtered with a halo of four pixels, the
+    reach of filterDifferenceImage, so the full resolution edges found in
+    them are exact. The loop shape is therefore identical to the one of
+    analyseImage in every column where the full resolution edges lie
+    within 2 * factor pixels of the coarse edges of the columns within
+    2 * factor pixels. Only details the coarse images do not show can be
+    missed, e.g. a tip of the pin thinner than about 2 * factor pixels,
+    whose columns are then shorter or missing.
+
+    With return_images the filtered image only contains the bands.
+    """
+    metrics = getMetrics(metrics)
+    ny, nx = raw_img.shape
+    with metrics.stage("downsample", omega):
+        if isinstance(background, BackgroundModel):
+            coarse_background = background.blockMean(factor)
+        else:
+            coarse_background = blockMean(background, factor)
+        coarse_difference = blockMean(raw_img, factor)
+        numpy.subtract(coarse_difference, coarse_background, out=coarse_difference)
+        numpy.abs(coarse_difference, out=coarse_difference)
+    background = getBackgroundImage(background)
+    ny_coarse, nx_coarse = coarse_difference.shape
+    coarse_valid = numpy.zeros(nx_coarse, dtype=bool)
+    coarse_first = numpy.zeros(nx_coarse, dtype=numpy.intp)
+    coarse_last = numpy.zeros(nx_coarse, dtype=numpy.intp)
+    with metrics.stage("region_of_interest", omega):
+        # A pixel surviving the opening is next to a vertical pair of pixels
+        # above the threshold, isolated noise pixels are not
+        above_threshold = coarse_difference >= threshold_value
+        above_threshold = above_threshold[:-1] & above_threshold[1:]
+        array_row = numpy.flatnonzero(above_threshold.any(axis=1))
+        array_column = numpy.flatnonzero(above_threshold.any(axis=0))
+    if len(array_row) > 0:
+        roi_margin = 4
+        row_min = max(array_row[0] - roi_margin, 0)
+        row_max = min(array_row[-1] + 2 + roi_margin, ny_coarse)
+        column_min = max(array_column[0] - roi_margin, 0)
+        column_max = min(array_column[-1] + 1 + roi_margin, nx_coarse)
+        with metrics.stage("filter", omega):
+            coarse_mask = filterDifferenceImage(
+                coarse_difference[row_min:row_max, column_min:column_max],
+                threshold_value,
+                iterations=1,
+            )
+        with metrics.stage("loop_exam", omega):
+            coarse_loop = loopExam(
+                coarse_mask, x_offset=column_min, y_offset=ny_coarse - row_max
+            )
+            coarse_valid[coarse_loop.index] = True
+            coarse_first[coarse_loop.index] = ny_coarse - coarse_loop.upper
+            coarse_last[coarse_loop.index] = ny_coarse - coarse_loop.lower
+    margin = 2 * factor
+    halo = 4
+    size = 2 * -(-margin // factor) + 1
+    array_first = numpy.full(nx, ny, dtype=numpy.intp)
+    array_last = numpy.full(nx, -1, dtype=numpy.intp)
+    if return_images:
+        filtered_image = numpy.zeros((ny, nx), dtype=bool)
+    with metrics.stage("refine", omega):
+        # Near the ends of the loop and of the pin the full resolution edge
+        # can be anywhere between the coarse edges, both bands then cover
+        # the whole coarse column
+        if coarse_valid.any():
+            near_end = coarse_valid & ~scipy.ndimage.minimum_filter1d(
+                coarse_valid, size, mode="constant", cval=False
+            )
+            list_coarse_band = [
+                (coarse_first, numpy.where(near_end, coarse_last, coarse_first)),
+                (numpy.where(near_end, coarse_first, coarse_last), coarse_last),
+            ]
+        else:
+            list_coarse_band = []
+        for coarse_row_top, coarse_row_bottom in list_coarse_band:
+            # Highest and lowest coarse edge of the neighbouring columns
+            coarse_row_min = scipy.ndimage.minimum_filter1d(
+                numpy.where(coarse_valid, coarse_row_top, ny_coarse),
+                size,
+                mode="constant",
+                cval=ny_coarse,
+            )
+            coarse_row_max = scipy.ndimage.maximum_filter1d(
+                numpy.where(coarse_valid, coarse_row_bottom, -1),
+                size,
+                mode="constant",
+                cval=-1,
+            )
+            for x_min in range(0, nx, tile_width):
+                x_max = min(x_min + tile_width, nx)
+                column_min = min(x_min // factor, nx_coarse - 1)
+                column_max = min((x_max - 1) // factor, nx_coarse - 1) + 1
+                row_max = coarse_row_max[column_min:column_max].max()
+                if row_max < 0:
+                    continue
+                row_min = coarse_row_min[column_min:column_max].min()
+                band_min = max(factor * row_min - margin, 0)
+                band_max = min(factor * (row_max + 1) + margin, ny)
+                window = (
+                    slice(max(band_min - halo, 0), min(band_max + halo, ny)),
+                    slice(max(x_min - halo, 0), min(x_max + halo, nx)),
+                )
+                window_mask = filterDifferenceImage(
+                    subtractBackground(raw_img[window], background[window]),
+                    threshold_value,
+                )
+                band_mask = window_mask[
+                    band_min - window[0].start : band_max - window[0].start,
+                    x_min - window[1].start : x_max - window[1].start,
+                ]
+                if return_images:
+                    filtered_image[band_min:band_max, x_min:x_max] |= band_mask
+                array_column = numpy.flatnonzero(band_mask.any(axis=0))
+                if len(array_column) == 0:
+                    continue
+                band_mask = band_mask[:, array_column]
+                array_column += x_min
+                array_first[array_column] = numpy.minimum(
+                    array_first[array_column], band_min + band_mask.argmax(axis=0)
+                )
+                array_last[array_column] = numpy.maximum(
+                    array_last[array_column],
+                    band_max - 1 - band_mask[::-1].argmax(axis=0),
+                )
+    array_index = numpy.flatnonzero(array_last >= 0)
+    loop = LoopProfile.fromColumns(
+        array_index,
+        ny - array_first[array_index],
+        ny - array_last[array_index],
+        dtype=profileDtype(ny, nx),
+    )
+    if return_images:
+        return loop, subtractBackground(raw_img, background), filtered_image
+    return loop
+
+
+def blockMean(image, factor):
+    """
+    Returns the means of the factor x factor blocks of image as float32,
+    the last rows and columns are left out if the image size is not a
+    multiple of factor.
+    """
+    ny, nx = image.shape
+    ny -= ny % factor
+    nx -= nx % factor
+    # Sums of whole rows first, integer images are summed exactly in uint16
+    if image.dtype == numpy.uint8:
+        row_sum = image[0:ny:factor, :nx].astype(numpy.uint16)
+    else:
+        row_sum = image[0:ny:factor, :nx].astype(numpy.float32)
+    for row in range(1, factor):
+        row_sum += image[row:ny:factor, :nx]
+    block_mean = row_sum[:, 0::factor].astype(numpy.float32)
+    for column in range(1, factor):
+        block_mean += row_sum[:, column::factor]
+    block_mean /= factor * factor
+    return block_mean
+
+
+def findRegionOfInterest(difference_image, threshold_value=30):
+    """
+    Returns the bounding box (row_min, row_max, column_min, column_max) of
+    the pin and loop in the difference image, or None if the image has
+    no foreground.
+
+    The box is found from the row and column projections of a half
+    resolution image where a pixel is set if the corresponding 2x2 block
+    is above the threshold. Any pixel surviving the opening done by
+    filterDifferenceImage is within two pixels of the centre of a diamond
+    of radius two above the threshold, and such a diamond always contains
+    a complete 2x2 block. Isolated noise pixels are therefore ignored
+    while the filtered loop lies within four pixels of the box found. The
+    box is padded by eight pixels so that the morphology inside it is
+    also unaffected by the border of the box.
+    """
+    margin = 8
+    ny, nx = difference_image.shape
+    even_image = difference_image[: ny - ny % 2, : nx - nx % 2]
+    block_image = numpy.minimum(even_image[0::2, 0::2], even_image[1::2, 0::2])
+    numpy.minimum(block_image, even_image[0::2, 1::2], out=block_image)
+    numpy.minimum(block_image, even_image[1::2, 1::2], out=block_image)
+    block_image = block_image >= threshold_value
+    array_row = numpy.flatnonzero(block_image.any(axis=1))
+    if len(array_row) == 0:
+        return None
+    array_column = numpy.flatnonzero(block_image.any(axis=0))
+    row_min = max(2 * array_row[0] - margin, 0)
+    row_max = min(2 * array_row[-1] + 2 + margin, ny)
+    column_min = max(2 * array_column[0] - margin, 0)
+    column_max = min(2 * array_column[-1] + 2 + margin, nx)
+    return int(row_min), int(row_max), int(column_min), int(column_max)
+
+
+@contextlib.contextmanager
+def perOmegaExecutor(executor=None, workers=None):
+    """
+    Returns the executor to use for the per-omega analysis: the given
+    executor if any, otherwise a thread pool if workers > 1 (shut down
+    when leaving the context), otherwise None for serial execution.
+    """
+    if executor is None and workers is not None and workers > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            yield executor
+    else:
+        yield executor
+
+
+def mapPerOmega(executor, function, *iterables):
+    if executor is None:
+        return list(map(function, *iterables))
+    return list(executor.map(function, *iterables))
+
+
+def subtractBackground(image, background_image):
+    """
+    Returns the absolute difference between the image and the background.
+    Images of the same unsigned integer type are subtracted without leaving
+    that type, otherwise the difference is computed in floating point.
+    """
+    if image.dtype == background_image.dtype and image.dtype.kind == "u":
+        difference_image = numpy.maximum(image, background_image)
+        difference_image -= numpy.minimum(image, background_image)
+        return difference_image
+    return numpy.abs(background_image - image)
+
+
+class LoopProfile:
+    """
+    Shape of the loop in one image: for the columns x_start to
+    x_start + len(mask) - 1 the first (upper) and last (lower) foreground
+    rows counted from the bottom of the image, in contiguous small integer
+    arrays, and mask telling which columns contain foreground.
+
+    The columns with foreground are given by the index, upper and lower
+    arrays, and a LoopProfile can be unpacked as the (list_index,
+    list_upper, list_lower) tuples used before::
+
+        (array_index, array_upper, array_lower) = loop
+    """
+
+    __slots__ = ("x_start", "column_upper", "column_lower", "mask", "_valid")
+
+    def __init__(self, x_start, column_upper, column_lower, mask):
+        self.x_start = int(x_start)
+        self.column_upper = column_upper
+        self.column_lower = column_lower
+        self.mask = mask
+        self._valid = None
+
+    @classmethod
+    def fromColumns(cls, array_index, array_upper, array_lower, dtype=None):
+        """
+        Returns the LoopProfile of the foreground columns array_index (in
+        increasing order) with their upper and lower rows.
+        """
+        array_index = numpy.asarray(array_index, dtype=numpy.int64)
+        if dtype is None:
+            dtype = profileDtype(
+                numpy.max(array_index, initial=0), numpy.max(array_upper, initial=0)
+            )
+        if len(array_index) == 0:
+            return cls(
+                0, numpy.zeros(0, dtype), numpy.zeros(0, dtype), numpy.zeros(0, bool)
+            )
+        x_start = array_index[0]
+        columns = array_index - x_start
+        n_column = columns[-1] + 1
+        column_upper = numpy.zeros(n_column, dtype)
+        column_lower = numpy.zeros(n_column, dtype)
+        mask = numpy.zeros(n_column, bool)
+        column_upper[columns] = array_upper
+        column_lower[columns] = array_lower
+        mask[columns] = True
+        return cls(x_start, column_upper, column_lower, mask)
+
+    @property
+    def x_end(self):
+        """
+        Column after the last column of the profile.
+        """
+        return self.x_start + len(self.mask)
+
+    def _getValid(self):
+        if self._valid is None:
+            columns = numpy.flatnonzero(self.mask)
+            if len(columns) == len(self.mask):
+                # Contiguous columns, no copy needed
+                self._valid = (
+                    numpy.arange(
+                        self.x_start, self.x_end, dtype=self.column_upper.dtype
+                    ),
+                    self.column_upper,
+                    self.column_lower,
+                )
+            else:
+                self._valid = (
+                    (columns + self.x_start).astype(self.column_upper.dtype),
+                    self.column_upper[columns],
+                    self.column_lower[columns],
+                )
+        return self._valid
+
+    @property
+    def index(self):
+        return self._getValid()[0]
+
+    @property
+    def upper(self):
+        return self._getValid()[1]
+
+    @property
+    def lower(self):
+        return self._getValid()[2]
+
+    def columns(self, x_min, x_max):
+        """
+        Returns the upper, lower and mask arrays for the columns x_min to
+        x_max - 1, the columns outside the profile are masked.
+        """
+        n_column = x_max - x_min
+        column_upper = numpy.zeros(n_column, self.column_upper.dtype)
+        column_lower = numpy.zeros(n_column, self.column_lower.dtype)
+        mask = numpy.zeros(n_column, bool)
+        start = max(x_min, self.x_start)
+        end = min(x_max, self.x_end)
+        if start < end:
+            target = slice(start - x_min, end - x_min)
+            source = slice(start - self.x_start, end - self.x_start)
+            column_upper[target] = self.column_upper[source]
+            column_lower[target] = self.column_lower[source]
+            mask[target] = self.mask[source]
+        return column_upper, column_lower, mask
+
+    def __iter__(self):
+        return iter(self._getValid())
+
+    def __getitem__(self, item):
+        return self._getValid()[item]
+
+    def __eq__(self, other):
+        try:
+            list_other = list(other)
+        except TypeError:
+            return NotImplemented
+        return len(list_other) == 3 and all(
+            numpy.array_equal(array, other_array)
+            for array, other_array in zip(self, list_other)
+        )
+
+    __hash__ = None
+
+    def __getstate__(self):
+        # The valid column arrays are rebuilt after unpickling
+        return (self.x_start, self.column_upper, self.column_lower, self.mask)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __repr__(self):
+        return "LoopProfile(x_start=%d, columns=%d, valid=%d)" % (
+            self.x_start,
+            len(self.mask),
+            numpy.count_nonzero(self.mask),
+        )
+
+
+def asLoopProfile(loop):
+    """
+    Returns loop as a LoopProfile, loop can also be a (list_index,
+    list_upper, list_lower) tuple as in the dictLoop JSON files.
+    """
+    if isinstance(loop, LoopProfile):
+        return loop
+    return LoopProfile.fromColumns(*loop)
+
+
+def profileDtype(*list_max_value):
+    """
+    Smallest signed integer type (int16 or int32) for the given values,
+    leaving room for the sum of two values (e.g. upper + lower).
+    """
+    if max(list_max_value) <= numpy.iinfo(numpy.int16).max // 2:
+        return numpy.int16
+    return numpy.int32
+
+
+def loopExam(filtered_image, block_size=32, x_offset=0, y_offset=0):
+    """
+    This method examines the loop in one image.
+
+    Returns a LoopProfile with, for each column containing foreground, the
+    first and last foreground rows counted from the bottom of the image.
+    x_offset and y_offset give the position of the image in a larger one.
+    The rows are searched by blocks of block_size rows, with an argmax
+    over the blocks and then within the block found.
+    """
+    mask = numpy.asarray(filtered_image, dtype=bool)
+    ny, nx = mask.shape
+    n_block = -(-ny // block_size)
+    if n_block * block_size != ny:
+        padded_mask = numpy.zeros((n_block * block_size, nx), dtype=bool)
+        padded_mask[:ny] = mask
+        mask = padded_mask
+    blocks = mask.reshape(n_block, block_size, nx)
+    block_any = blocks.any(axis=1)
+    array_index = numpy.flatnonzero(block_any.any(axis=0))
+    block_any = block_any[:, array_index]
+    first_block = block_any.argmax(axis=0)
+    last_block = n_block - 1 - block_any[::-1].argmax(axis=0)
+    first_row = first_block * block_size + blocks[first_block, :, array_index].argmax(
+        axis=1
+    )
+    last_row = (last_block + 1) * block_size - 1
+    last_row -= blocks[last_block, ::-1, array_index].argmax(axis=1)
+    array_index += x_offset
+    array_upper = ny + y_offset - first_row
+    array_lower = ny + y_offset - last_row
+    return LoopProfile.fromColumns(
+        array_index,
+        array_upper,
+        array_lower,
+        dtype=profileDtype(ny + y_offset, nx + x_offset),
+    )
+
+
+def checkForCorrelatedImages(dict_loop):
+    # Check if all the indices are the same
+    first_loop = None
+    for loop in dict_loop.values():
+        if first_loop is None:
+            first_loop = loop
+        elif not all(
+            numpy.array_equal(first_array, array)
+            for first_array, array in zip(first_loop, loop)
+        ):
+            return False
+    return True
+
+
+def imageFingerprint(image):
+    """
+    Returns a digest of the image content, shape and type, used to detect
+    identical snapshots without analysing them.
+    """
+    image = numpy.ascontiguousarray(image)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str((image.shape, image.dtype.str)).encode())
+    digest.update(image.data)
+    return digest.hexdigest()
+
+
+def rgb2gray(rgb):
+    return numpy.dot(rgb[..., :3], [0.2989, 0.5870, 0.1140])
+
+
+def readImage(image_path, compact=False, mmap=True):
+    """
+    Reads a grey scale image. By default the image is converted to float64,
+    if compact is True it is kept in its integer type (see toCompactGray).
+    Numpy arrays (.npy) are read as stored and, if mmap is True, memory
+    mapped read only so that they are not copied. The other formats are
+    decoded by imageio.
+    """
+    if image_path.endswith(".npy"):
+        image = numpy.load(image_path, mmap_mode="r" if mmap else None)
+        # Plain array on the mapped memory, numpy.memmap results are
+        # memmap instances as well
+        image = numpy.asarray(image)
+        if compact:
+            image = toCompactGray(image)
+        elif image.ndim == 3:
+            image = rgb2gray(image)
+    elif compact:
+        image = toCompactGray(imageio.imread(image_path))
+    else:
+        image = imageio.imread(image_path, as_gray=True)
+    return image
+
+
+def readBackground(background_path, compact=False, mmap=True):
+    return readImage(background_path, compact=compact, mmap=mmap)
+
+
+def snapshotPath(snapshot_dir, prefix, omega, extension="png"):
+    return os.path.join(snapshot_dir, "%s_%03d.%s" % (prefix, omega, extension))
+
+
+def backgroundPath(snapshot_dir, prefix, extension="png"):
+    return os.path.join(snapshot_dir, "%s_background.%s" % (prefix, extension))
+
+
+_untracked_lock = threading.Lock()
+
+
+def attachSharedMemoryUntracked(name):
+    """
+    Attaches to the shared memory block name without registering it to the
+    resource tracker, which before Python 3.13 unlinks the blocks that the
+    process attached to when it exits. The registration of the process
+    which created the block, if it is this one, is left untouched.
+    """
+    register = resource_tracker.register
+    name = name.lstrip("/")
+
+    def registerOther(resource_name, resource_type):
+        if resource_type != "shared_memory" or resource_name.lstrip("/") != name:
+            register(resource_name, resource_type)
+
+    with _untracked_lock:
+        resource_tracker.register = registerOther
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+def attachSharedFrame(name, shape, dtype="uint8", offset=0):
+    """
+    Attaches to an image published by another process (e.g. the camera
+    acquisition) in the multiprocessing.shared_memory block name, starting
+    at offset bytes. Returns the SharedMemory and a read only array on its
+    buffer, the image is not copied. Close the SharedMemory once the array
+    is not used any more, the block is unlinked by the process owning it.
+    """
+    try:
+        shared_memory_block = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        shared_memory_block = attachSharedMemoryUntracked(name)
+    image = numpy.ndarray(
+        shape, dtype=dtype, buffer=shared_memory_block.buf, offset=offset
+    )
+    image.flags.writeable = False
+    return shared_memory_block, image
+
+
+@contextlib.contextmanager
+def sharedFrames(dict_frame):
+    """
+    Context manager attaching to the shared memory images described in
+    dict_frame, a dictionary key -> {"name": ..., "shape": [ny, nx],
+    "dtype": "uint8", "offset": 0} (dtype and offset are optional).
+    Yields a dictionary key -> image, see attachSharedFrame. The images
+    must not be used after the with block.
+    """
+    dict_shared_memory = {}
+    dict_image = {}
+    try:
+        for key, frame in dict_frame.items():
+            dict_shared_memory[key], dict_image[key] = attachSharedFrame(
+                frame["name"],
+                tuple(frame["shape"]),
+                dtype=frame.get("dtype", "uint8"),
+                offset=frame.get("offset", 0),
+            )
+        yield dict_image
+    finally:
+        dict_image.clear()
+        for key, shared_memory_block in dict_shared_memory.items():
+            try:
+                shared_memory_block.close()
+            except BufferError:
+                logging.warning("Shared memory frame %s still in use, not closed" % key)
+
+
+def autoMeshFromSharedMemory(
+    dict_frame, background_frame, auto_mesh_working_dir, **kwargs
+):
+    """
+    autoMeshFromArrays on snapshots and background published in shared
+    memory, dict_frame maps omega to the snapshot frames, see sharedFrames.
+    With a process pool executor the images are sent to the processes.
+    """
+    with sharedFrames(dict(dict_frame, background=background_frame)) as dict_image:
+        background = dict_image.pop("background")
+        dict_image = {int(omega): image for omega, image in dict_image.items()}
+        try:
+            return autoMeshFromArrays(
+                dict_image, background, auto_mesh_working_dir, **kwargs
+            )
+        finally:
+            # The debug plots of the raw images are written asynchronously
+            waitForArtifacts(kwargs.get("artifact_writer"))
+
+
+def findDeltaToCentreFromSharedMemory(
+    dict_frame, background_frame, auto_mesh_working_dir, **kwargs
+):
+    """
+    findDeltaToCentreFromArrays on frames in shared memory, see
+    autoMeshFromSharedMemory.
+    """
+    with sharedFrames(dict(dict_frame, background=background_frame)) as dict_image:
+        background = dict_image.pop("background")
+        dict_image = {int(omega): image for omega, image in dict_image.items()}
+        try:
+            return findDeltaToCentreFromArrays(
+                dict_image, background, auto_mesh_working_dir, **kwargs
+            )
+        finally:
+            waitForArtifacts(kwargs.get("artifact_writer"))
+
+
+def toCompactGray(image):
+    """
+    Converts an integer RGB(A) image to grey scale keeping its integer type
+    (uint8 or uint16), using the same ITU-R 601-2 luma weights as the PIL
+    "L" mode. Grey scale images are returned unchanged.
+    """
+    image = numpy.asarray(image)
+    if image.ndim == 3 and image.dtype.kind == "u":
+        gray_image = numpy.zeros(image.shape[:2], dtype=numpy.uint32)
+        for channel, weight in enumerate((299, 587, 114)):
+            gray_image += image[..., channel] * numpy.uint32(weight)
+        gray_image += 500
+        gray_image //= 1000
+        image = gray_image.astype(image.dtype)
+    return image
+
+
+class BackgroundModel:
+    """
+    Grey scale background image, decoded and converted once so that it
+    can be shared by all the snapshots of a run and by consecutive runs.
+
+    The background can also be estimated from many frames without sample
+    (fromFrames), saved to an npz file (save, load) and updated with new
+    frames between samples (update), estimate is then the float32 running
+    estimate of which image is the rounded value.
+    """
+
+    def __init__(self, image, estimate=None, no_frames=1):
+        self.image = numpy.asarray(image).view()
+        # The image is shared between runs, make sure nobody modifies it
+        self.image.flags.writeable = False
+        if estimate is not None:
+            estimate = numpy.asarray(estimate, dtype=numpy.float32).view()
+            estimate.flags.writeable = False
+        self.estimate = estimate
+        self.no_frames = no_frames
+        self._dict_block_mean = {}
+
+    @classmethod
+    def fromFrames(cls, list_image, method=BACKGROUND_MEDIAN, clip=3.0, block_rows=256):
+        """
+        Estimates the background from frames without sample: per pixel
+        median (method="median") or mean of the values within clip times
+        the robust standard deviation (1.4826 times the median absolute
+        deviation) from the median (method="robust_mean"). The image keeps
+        the type of the frames, rounded for integer frames. The frames are
+        stacked by blocks of block_rows rows to limit the memory used.
+        """
+        list_image = [numpy.asarray(image) for image in list_image]
+        if len(list_image) == 0:
+            raise ValueError("No frames for the background model")
+        if method not in (BACKGROUND_MEDIAN, BACKGROUND_ROBUST_MEAN):
+            raise ValueError("Unknown background method: {0}".format(method))
+        shape = list_image[0].shape
+        for image in list_image:
+            if image.shape != shape:
+                raise ValueError(
+                    "Background frames of different shapes: {0} and {1}".format(
+                        shape, image.shape
+                    )
+                )
+        estimate = numpy.empty(shape, dtype=numpy.float32)
+        for start in range(0, shape[0], block_rows):
+            block = numpy.stack(
+                [image[start : start + block_rows] for image in list_image]
+            ).astype(numpy.float32)
+            median = numpy.median(block, axis=0)
+            if method == BACKGROUND_MEDIAN:
+                estimate[start : start + block_rows] = median
+                continue
+            deviation = numpy.abs(block - median)
+            sigma = 1.4826 * numpy.median(deviation, axis=0)
+            mask = deviation <= clip * sigma
+            numpy.divide(
+                (block * mask).sum(axis=0),
+                mask.sum(axis=0),
+                out=median,
+                where=mask.any(axis=0),
+            )
+            estimate[start : start + block_rows] = median
+        return cls(
+            estimateImage(estimate, list_image[0].dtype),
+            estimate=estimate,
+            no_frames=len(list_image),
+        )
 
-        if debug:
-            plot_img(
-                raw_img,
-                os.path.join(auto_mesh_working_dir, "rawImage_%03d.png" % omega),
+    def update(self, image, window=20):
+        """
+        Returns a new BackgroundModel with the frame image added to the
+        running estimate: the mean of the frames as long as there are less
+        than window of them, then an exponential moving average giving the
+        weight 1 / window to the new frame. The model itself is left
+        unchanged since it can be in use by running analyses.
+        """
+        image = numpy.asarray(image)
+        if image.shape != self.shape:
+            raise ValueError(
+                "Background frame of shape {0}, the model {1}".format(
+                    image.shape, self.shape
+                )
             )
+        estimate = self.getEstimate()
+        weight = 1.0 / min(self.no_frames + 1, window)
+        estimate = estimate * numpy.float32(1 - weight)
+        estimate += image.astype(numpy.float32) * numpy.float32(weight)
+        return BackgroundModel(
+            estimateImage(estimate, self.image.dtype),
+            estimate=estimate,
+            no_frames=self.no_frames + 1,
+        )
 
-        if background_image.endswith(".npy"):
-            background = numpy.load(background_image)
-        else:
-            background = imageio.imread(background_image, as_gray=True)
+    def getEstimate(self):
+        if self.estimate is None:
+            return self.image.astype(numpy.float32)
+        return self.estimate
 
-        difference_image = numpy.abs(background - raw_img)
+    def save(self, model_path):
+        """
+        Saves the model to an npz file, see load. The file is written to a
+        temporary file renamed to model_path so that an analysis never reads
+        a partially written model.
+        """
+        model_path = os.path.abspath(model_path)
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(model_path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                numpy.savez(
+                    f,
+                    image=self.image,
+                    estimate=self.getEstimate(),
+                    no_frames=numpy.int64(self.no_frames),
+                )
+            os.replace(tmp_path, model_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
 
-        if debug:
-            plot_img(
-                difference_image,
-                plot_path=os.path.join(
-                    auto_mesh_working_dir, "differenceImage_%03d.png" % omega
-                ),
+    @classmethod
+    def load(cls, model_path):
+        with numpy.load(model_path) as data:
+            return cls(
+                data["image"],
+                estimate=data["estimate"],
+                no_frames=int(data["no_frames"]),
             )
 
-        #        print numpyImage
-        filtered_image = filterDifferenceImage(difference_image)
-        if debug:
-            plot_img(
-                filtered_image,
-                plot_path=os.path.join(
-                    auto_mesh_working_dir, "filteredImage_%03d.png" % omega
-                ),
-            )
-        (list_index, list_upper, list_lower) = loopExam(filtered_image)
-        if debug:
-            pylab.plot(list_index, list_upper, "+")
-            pylab.plot(list_index, list_lower, "+")
-            raw_img = imageio.imread(image_path, as_gray=True)
-            imgshape = raw_img.shape
-            extent = (0, imgshape[1], 0, imgshape[0])
-            pylab.axes(extent)
-            pylab.savefig(
-                os.path.join(auto_mesh_working_dir, "shapePlot_%03d.png" % omega)
-            )
-            pyplot.close()
-        dict_loop["%d" % omega] = (list_index, list_upper, list_lower)
-    are_the_same_image = checkForCorrelatedImages(dict_loop)
-    if not are_the_same_image:
-        image000_path = os.path.join(snapshot_dir, "%s_%03d.png" % (prefix, 0))
-        ny, nx = imageio.imread(image000_path, as_gray=True).shape
-        (
-            angle_min_thickness,
-            x1_pixels,
-            y1_pixels,
-            dx_pixels,
-            dy_pixels,
-            delta_phiz,
-            std_phiz,
-        ) = findOptimalMesh(
-            dict_loop,
-            snapshot_dir,
-            nx,
-            ny,
-            auto_mesh_working_dir,
-            debug=debug,
-            loop_max_width=loop_max_width,
-            loop_min_width=loop_min_width,
-            find_largest_mesh=find_largest_mesh,
-        )
-        image_path = None
-        if angle_min_thickness is not None:
-            image_path = os.path.join(
-                snapshot_dir, "%s_%03d.png" % (prefix, angle_min_thickness)
-            )
-    return (
-        angle_min_thickness,
-        x1_pixels,
-        y1_pixels,
-        dx_pixels,
-        dy_pixels,
-        delta_phiz,
-        std_phiz,
-        image_path,
-        are_the_same_image,
-    )
+    @property
+    def shape(self):
+        return self.image.shape
 
+    def blockMean(self, factor):
+        """
+        Returns blockMean of the image, computed once per factor.
+        """
+        block_mean = self._dict_block_mean.get(factor)
+        if block_mean is None:
+            block_mean = blockMean(self.image, factor)
+            block_mean.flags.writeable = False
+            self._dict_block_mean[factor] = block_mean
+        return block_mean
 
-def findDeltaToCentre(
+    @classmethod
+    def fromFile(
+        cls,
+        background_path,
+        use_cache=True,
+        cache_key="mtime",
+        compact=False,
+        metrics=None,
+    ):
+        """
+        Loads the background image, or the background model if
+        background_path is an npz file (see save). If use_cache is True the
+        decoded image is kept in a LRU cache keyed by the path and either the
+        file modification time and size (cache_key="mtime") or the file
+        content digest (cache_key="hash"), a model updated with save is thus
+        loaded again. See readImage for compact, background models are used
+        as saved. The file is counted in metrics only if it is loaded.
+        """
+        no_loads = getattr(_background_loads, "count", 0)
+        model = cls._fromFile(background_path, use_cache, cache_key, compact)
+        if getattr(_background_loads, "count", 0) > no_loads:
+            getMetrics(metrics).addImage(background_path)
+        return model
+
+    @classmethod
+    def _fromFile(cls, background_path, use_cache, cache_key, compact):
+        if not use_cache:
+            return _loadBackgroundModel(os.fspath(background_path), compact)
+        background_path = os.path.abspath(background_path)
+        if cache_key == "mtime":
+            stat = os.stat(background_path)
+            key = (background_path, stat.st_mtime_ns, stat.st_size)
+        elif cache_key == "hash":
+            with open(background_path, "rb") as f:
+                digest = hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+            key = (background_path, digest)
+        else:
+            raise ValueError("Unknown background cache key: {0}".format(cache_key))
+        return _loadCachedBackgroundModel(key, compact)
+
+
+# Number of background files loaded by each thread, to tell the cache hits
+_background_loads = threading.local()
+
+
+@functools.lru_cache(maxsize=8)
+def _loadCachedBackgroundModel(key, compact):
+    logging.debug("Loading background image %s" % key[0])
+    return _loadBackgroundModel(key[0], compact)
+
+
+def _loadBackgroundModel(background_path, compact):
+    _background_loads.count = getattr(_background_loads, "count", 0) + 1
+    if background_path.endswith(".npz"):
+        return BackgroundModel.load(background_path)
+    return BackgroundModel(readBackground(background_path, compact=compact))
+
+
+def estimateImage(estimate, dtype):
+    """
+    Returns the floating point estimate as an image of type dtype, rounded
+    and clipped for the integer types.
+    """
+    dtype = numpy.dtype(dtype)
+    if dtype.kind in "ui":
+        info = numpy.iinfo(dtype)
+        return numpy.clip(numpy.rint(estimate), info.min, info.max).astype(dtype)
+    return estimate.astype(dtype)
+
+
+def updateBackgroundModel(model_path, image, window=20):
+    """
+    Adds the background frame image (an array or an image file) to the
+    background model saved in model_path, see BackgroundModel.update, and
+    saves it again. The model is created from the frame if model_path does
+    not exist. Returns the updated model.
+    """
+    if not isinstance(image, numpy.ndarray):
+        image = readImage(os.fspath(image), compact=True)
+    if os.path.exists(model_path):
+        model = BackgroundModel.load(model_path).update(image, window=window)
+    else:
+        model = BackgroundModel.fromFrames([image])
+    model.save(model_path)
+    return model
+
+
+def clearBackgroundCache():
+    _loadCachedBackgroundModel.cache_clear()
+
+
+def getBackgroundImage(background):
+    """
+    Returns the background as a numpy array, background can be either a
+    BackgroundModel or an array.
+    """
+    if isinstance(background, BackgroundModel):
+        background = background.image
+    return background
+
+
+def getBackgroundModel(background):
+    """
+    Returns the background as a BackgroundModel, background can be either
+    a BackgroundModel or an array.
+    """
+    if not isinstance(background, BackgroundModel):
+        background = BackgroundModel(background)
+    return background
+
+
+def readSnapshots(
     snapshot_dir,
-    auto_mesh_working_dir,
+    list_omega,
     prefix="snapshot",
-    loop_width=100,
-    do_circle_fit=False,
-    debug=False,
-    is_vertical_axis=False,
+    executor=None,
+    compact=False,
+    metrics=None,
+    extension="png",
 ):
-    os.chmod(auto_mesh_working_dir, 0o755)
-    background_image = os.path.join(snapshot_dir, "%s_background.png" % prefix)
-    # Get size of image
-    background_colour = imageio.v3.imread(background_image)
-    background = rgb2gray(background_colour)
-    image_size = background.shape
-    dict_loop = {}
-    for omega in [0, 90, 180, 270]:
-        logging.info("Analysing snapshot image at omega = %d degrees" % omega)
-        image_path = os.path.join(snapshot_dir, "%s_%03d.png" % (prefix, omega))
-        raw_img = readImage(image_path)
-        if background_image.endswith(".npy"):
-            background = numpy.load(background_image)
-        else:
-            background = imageio.imread(background_image, as_gray=True)
-        difference_image = numpy.abs(background - raw_img)
-        filtered_image = filterDifferenceImage(difference_image)
-        (list_index, list_upper, list_lower) = loopExam(filtered_image)
-        dict_loop["%d" % omega] = (list_index, list_upper, list_lower)
-    # areTheSameImage = checkForCorrelatedImages(dict_loop)
-    image000_path = os.path.join(snapshot_dir, "%s_%03d.png" % (prefix, 0))
-    ny, nx, _ = imageio.v3.imread(image000_path).shape
-    delta_x, delta_y, delta_z = findCentrePin(
-        dict_loop,
-        snapshot_dir,
-        nx,
-        ny,
-        auto_mesh_working_dir,
-        do_circle_fit=do_circle_fit,
-        debug=debug,
-        isVerticalAxis=is_vertical_axis,
-        image_size=image_size,
-        loop_width=loop_width,
-    )
-    return delta_x, delta_y, delta_z
+    """
+    Reads the snapshot images <prefix>_<omega>.<extension> for the given
+    omega angles and returns a dictionary omega -> image as needed by
+    autoMeshFromArrays.
+    """
+    list_image_path = [
+        snapshotPath(snapshot_dir, prefix, omega, extension) for omega in list_omega
+    ]
+    if getMetrics(metrics) is NO_METRICS:
+        list_image = mapPerOmega(
+            executor, functools.partial(readImage, compact=compact), list_image_path
+        )
+    else:
+        list_image = mapPerOmega(
+            executor,
+            functools.partial(_readSnapshot, compact=compact, metrics=metrics),
+            list_omega,
+            list_image_path,
+        )
+    return dict(zip(list_omega, list_image))
 
 
-def findCentrePin(
-    dict_loop,
-    snapshotDir,
-    nx,
-    ny,
-    auto_mesh_working_dir,
-    loop_width=100,
-    image_size=None,
-    do_circle_fit=False,
-    debug=False,
-    isVerticalAxis=False,
-):
-    dict_vertical = {}
-    list_horizontal = []
-    for omega in [0, 90, 180, 270]:
-        str_omega1 = "%d" % omega
-        (list_index1, list_upper1, list_lower1) = dict_loop[str_omega1]
-        array_index1 = numpy.array(list_index1)
-        index_max = len(array_index1)
-        if index_max == 0:
-            raise RuntimeError("No pin found for omega {0}!".format(str_omega1))
-        index_min = index_max - int(loop_width / 3)
-        index_loop = list_index1[index_min:index_max - 1]
-        array_upper1 = numpy.array(list_upper1[index_min:index_max - 1])
-        array_lower1 = numpy.array(list_lower1[index_min:index_max - 1])
-        mean_array = (array_lower1 + array_upper1) / 2
-        pylab.plot(index_loop, array_upper1, "+", color="blue")
-        pylab.plot(index_loop, array_lower1, "+", color="blue")
+def _readSnapshot(omega, image_path, compact, metrics):
+    with metrics.stage("read", omega):
+        image = readImage(image_path, compact=compact)
+    metrics.addImage(image_path)
+    return image
+
+
+def isSnapshotStack(snapshot_path):
+    """
+    True if snapshot_path is a snapshot stack file (see saveSnapshotStack),
+    i.e. an npz file with the omega, images and background arrays, rather
+    than a snapshot directory or another npz file.
+    """
+    if not os.path.isfile(snapshot_path) or not zipfile.is_zipfile(snapshot_path):
+        return False
+    with zipfile.ZipFile(snapshot_path) as zip_file:
+        set_name = set(zip_file.namelist())
+    return all("%s.npy" % key in set_name for key in LIST_SNAPSHOT_STACK_KEY)
 
-        if do_circle_fit:
-            data = []
-            for index, x in enumerate(index_loop):
-                y1 = array_upper1[index]
-                y2 = array_lower1[index]
-                data.append([x, y1])
-                data.append([x, y2])
-            circle_x = []
-            circle_y = []
-            xc, yc, r, _ = circle_fit.least_squares_circle(data)
-            for theta in range(0, 360, 5):
-                x = xc + r * math.cos(theta)
-                y = yc + r * math.sin(theta)
-                circle_x.append(x)
-                circle_y.append(y)
-            pylab.plot(circle_x, circle_y, ".", color="red")
-        else:
-            pylab.plot(index_loop, mean_array, "+", color="green")
-            xc = list_index1[-1] - int(loop_width / 2)
-            yc = numpy.mean(mean_array)
 
-        pylab.plot([xc], [yc], "+", color="black")
-        pylab.gca().set_aspect("equal")
-        pylab.savefig(
-            os.path.join(auto_mesh_working_dir, "shapePlot_mean_%03d.png" % (omega))
+def saveSnapshotStack(stack_path, dict_image, background):
+    """
+    Saves the snapshots of a rotation (dictionary omega -> image) and the
+    background in one uncompressed npz file: the images are stacked in one
+    (no_omega, ny, nx) array in the order of omega, so that the whole
+    rotation is read with one sequential read, see readSnapshotStack.
+    """
+    list_omega = sorted(dict_image)
+    background = numpy.asarray(getBackgroundImage(background))
+    for omega in list_omega:
+        if dict_image[omega].shape != background.shape:
+            raise ValueError(
+                "Snapshot at omega {0} has shape {1}, the background {2}".format(
+                    omega, dict_image[omega].shape, background.shape
+                )
+            )
+    with open(stack_path, "wb") as f:
+        numpy.savez(
+            f,
+            omega=numpy.array(list_omega, dtype=numpy.int16),
+            images=numpy.stack([dict_image[omega] for omega in list_omega]),
+            background=background,
         )
-        pylab.close()
-        # Calculate deltaZ (phiy)
-        deltaZ = int(image_size[1] / 2) - xc
-        dict_vertical[str_omega1] = yc
-        list_horizontal.append(deltaZ)
 
-    mean_delta_x = (dict_vertical["90"] - dict_vertical["270"]) / 2
-    mean_delta_y = (dict_vertical["180"] - dict_vertical["0"]) / 2
-    mean_delta_z = numpy.mean(list_horizontal)
-    return mean_delta_x, mean_delta_y, mean_delta_z
+
+def readSnapshotStack(stack_path, compact=False, metrics=None):
+    """
+    Reads a file written by saveSnapshotStack and returns (dict_image,
+    background_image). The stacked images are read in one sequential read
+    and returned as stored, views of the stacked array; RGB images are
+    converted to grey scale as in readImage.
+    """
+    metrics = getMetrics(metrics)
+    with metrics.stage("read"):
+        with numpy.load(stack_path) as data:
+            list_omega = data["omega"].tolist()
+            images = data["images"]
+            background_image = data["background"]
+        if compact:
+            images = toCompactGray(images)
+            background_image = toCompactGray(background_image)
+        elif images.ndim == 4:
+            images = rgb2gray(images)
+            background_image = rgb2gray(background_image)
+    metrics.addImage(stack_path)
+    return dict(zip(list_omega, images)), background_image
 
 
-def subtractBackground(image, background_image):
-    return numpy.abs(image - background_image)
+def writeSnapshotImage(image_path, image):
+    """
+    Writes a snapshot image, e.g. taken from a snapshot stack, to an image
+    file. Floating point images are rounded to 8 bits, or 16 bits if their
+    values do not fit in 8 bits.
+    """
+    image = numpy.asarray(image)
+    if image.dtype.kind == "f":
+        dtype = numpy.uint8 if image.max() <= 255 else numpy.uint16
+        image = estimateImage(image, dtype)
+    imageio.imwrite(image_path, image)
+
+
+def _selectSnapshots(stack_path, dict_image, list_omega, executor=None):
+    list_missing = [omega for omega in list_omega if omega not in dict_image]
+    if len(list_missing) > 0:
+        raise RuntimeError(
+            "Omega {0} missing in snapshot stack {1}".format(list_missing, stack_path)
+        )
+    return {omega: dict_image[omega] for omega in list_omega}
 
 
-def loopExam(filtered_image):
+def openSnapshots(
+    snapshot_dir,
+    prefix="snapshot",
+    compact=False,
+    metrics=None,
+    extension="png",
+    background_extension=None,
+    background=None,
+):
     """
-    This method examines the loop in one image.
+    Returns the BackgroundModel of snapshot_dir and a function
+    read_snapshots(list_omega, executor=None) returning the dictionary
+    omega -> image of the given angles. snapshot_dir is either a directory
+    of snapshot files (see autoMesh) or a snapshot stack file, which is
+    then read entirely here. If background (a BackgroundModel, or the path
+    of a background model or image file) is given it is used instead of
+    the background of snapshot_dir.
+    """
+    metrics = getMetrics(metrics)
+    if background is not None and not isinstance(background, BackgroundModel):
+        with metrics.stage("read_background"):
+            background = BackgroundModel.fromFile(
+                background, compact=compact, metrics=metrics
+            )
+    if isSnapshotStack(snapshot_dir):
+        dict_image, background_image = readSnapshotStack(
+            snapshot_dir, compact=compact, metrics=metrics
+        )
+        if background is None:
+            background = BackgroundModel(background_image)
+        return (
+            background,
+            functools.partial(_selectSnapshots, snapshot_dir, dict_image),
+        )
+    if background is None:
+        background_image = backgroundPath(
+            snapshot_dir, prefix, background_extension or extension
+        )
+        with metrics.stage("read_background"):
+            background = BackgroundModel.fromFile(
+                background_image, compact=compact, metrics=metrics
+            )
+    return background, functools.partial(
+        readSnapshots,
+        snapshot_dir,
+        prefix=prefix,
+        compact=compact,
+        metrics=metrics,
+        extension=extension,
+    )
 
+
+def listSnapshotOmega(snapshot_dir, prefix="snapshot", extension="png"):
+    """
+    Returns the sorted omega angles of the <prefix>_<omega>.<extension>
+    files in snapshot_dir.
     """
-    ny, nx = filtered_image.shape
-    shape_list_index = []
-    shape_list_upper = []
-    shape_list_lower = []
-    for index_x in range(nx):
-        column = filtered_image[:, index_x]
-        indices = numpy.where(column)[0]
-        if len(indices) > 0:
-            shape_list_index.append(index_x)
-            shape_list_upper.append(indices[0])
-            shape_list_lower.append(indices[-1])
-    array_index = numpy.array(shape_list_index)
-    array_upper = ny - numpy.array(shape_list_upper)
-    array_lower = ny - numpy.array(shape_list_lower)
-    return (array_index.tolist(), array_upper.tolist(), array_lower.tolist())
+    pattern = re.compile(r"^%s_(\d+)\.%s$" % (re.escape(prefix), re.escape(extension)))
+    list_omega = []
+    for file_name in os.listdir(snapshot_dir):
+        match = pattern.match(file_name)
+        if match is not None:
+            list_omega.append(int(match.group(1)))
+    return sorted(list_omega)
 
 
-def checkForCorrelatedImages(dict_loop):
-    # Check if all the indices are the same
-    first_list_index = None
-    first_upper_index = None
-    first_lower_index = None
-    are_the_same = True
-    for loop_index in dict_loop:
-        list_index, list_upper, list_lower = dict_loop[loop_index]
-        if first_list_index is None:
-            first_list_index = list_index
-            first_upper_index = list_upper
-            first_lower_index = list_lower
-        elif cmp(first_list_index, list_index):
-            are_the_same = False
-            break
-        elif cmp(first_upper_index, list_upper):
-            are_the_same = False
-            break
-        elif cmp(first_lower_index, list_lower):
-            are_the_same = False
-            break
-    return are_the_same
+def convertSnapshotDir(
+    snapshot_dir,
+    stack_path,
+    list_omega=None,
+    prefix="snapshot",
+    extension="png",
+    background_extension=None,
+    compact=True,
+):
+    """
+    Converts the snapshot files of snapshot_dir (by default all the angles
+    found, see listSnapshotOmega) to a snapshot stack file. By default the
+    images are stored in their integer type, i.e. autoMesh on the stack
+    gives the same results as autoMesh with compact=True on the directory,
+    with compact=False they are stored as float64. Returns list_omega.
+    """
+    if list_omega is None:
+        list_omega = listSnapshotOmega(snapshot_dir, prefix, extension)
+    if len(list_omega) == 0:
+        raise RuntimeError("No snapshots found in {0}".format(snapshot_dir))
+    background = readBackground(
+        backgroundPath(snapshot_dir, prefix, background_extension or extension),
+        compact=compact,
+    )
+    dict_image = readSnapshots(
+        snapshot_dir, list_omega, prefix=prefix, compact=compact, extension=extension
+    )
+    saveSnapshotStack(stack_path, dict_image, background)
+    return list_omega
 
 
-def cmp(a, b):
+def saveLoopProfiles(loop_profile_path, dict_loop, nx, ny):
     """
-    Python3 doesn't have cmp, see:
-    https://codegolf.stackexchange.com/questions/49778/how-can-i-use-cmpa-b-with-python3
+    Saves the loop shapes of dict_loop and the image size to an npz file.
+    The shapes of all the angles are concatenated in three int16 arrays
+    (int32 for images larger than 16383 pixels), see loadLoopProfiles.
     """
-    return (a > b) - (a < b)
+    list_omega = sorted(int(str_omega) for str_omega in dict_loop)
+    dtype = profileDtype(nx, ny)
+    list_length = []
+    list_array = ([], [], [])
+    for omega in list_omega:
+        loop = asLoopProfile(dict_loop["%d" % omega])
+        list_length.append(len(loop.index))
+        for list_value, values in zip(list_array, loop):
+            list_value.append(numpy.asarray(values, dtype=dtype))
+    array_index, array_upper, array_lower = [
+        numpy.concatenate(list_value) if len(list_value) > 0 else numpy.zeros(0, dtype)
+        for list_value in list_array
+    ]
+    with open(loop_profile_path, "wb") as f:
+        numpy.savez_compressed(
+            f,
+            omega=numpy.array(list_omega, dtype=numpy.int16),
+            length=numpy.array(list_length, dtype=numpy.int32),
+            index=array_index,
+            upper=array_upper,
+            lower=array_lower,
+            shape=numpy.array([ny, nx], dtype=numpy.int32),
+        )
 
 
-def rgb2gray(rgb):
-    return numpy.dot(rgb[..., :3], [0.2989, 0.5870, 0.1140])
+def loadLoopProfiles(loop_profile_path):
+    """
+    Returns (dict_loop, nx, ny) from a file written by saveLoopProfiles,
+    the values of dict_loop are LoopProfile. A dict_loop JSON file (as
+    tests/data/dictLoop_1.json) can also be read, nx and ny are then None.
+    """
+    if loop_profile_path.endswith(".json"):
+        with open(loop_profile_path) as f:
+            dict_loop = json.load(f)
+        return (
+            {str_omega: asLoopProfile(loop) for str_omega, loop in dict_loop.items()},
+            None,
+            None,
+        )
+    with numpy.load(loop_profile_path) as data:
+        list_end = numpy.cumsum(data["length"]).tolist()
+        list_start = [0] + list_end[:-1]
+        list_array = [data["index"], data["upper"], data["lower"]]
+        dict_loop = {}
+        for omega, start, end in zip(data["omega"].tolist(), list_start, list_end):
+            dict_loop["%d" % omega] = LoopProfile.fromColumns(
+                *[array[start:end] for array in list_array]
+            )
+        ny, nx = data["shape"].tolist()
+    return dict_loop, nx, ny
 
 
-def readImage(image_path):
-    if image_path.endswith(".png"):
-        image = imageio.imread(image_path, as_gray=True)
-    elif image_path.endswith(".npy"):
-        image = numpy.load(image_path)
-    return image
+def replayAutoMesh(
+    loop_profile_path,
+    auto_mesh_working_dir=None,
+    loop_max_width=300,
+    loop_min_width=150,
+    find_largest_mesh=False,
+    nx=None,
+    ny=None,
+    artifacts=ARTIFACTS_NONE,
+    artifact_writer=None,
+):
+    """
+    Finds the mesh from loop shapes saved by autoMesh (see loop_profile_path
+    in autoMesh) without processing the images again. Returns the same
+    results as autoMeshFromArrays. nx and ny are only needed for the JSON
+    files, auto_mesh_working_dir only if artifacts are written.
+    """
+    dict_loop, nx_file, ny_file = loadLoopProfiles(loop_profile_path)
+    nx = nx_file if nx is None else nx
+    ny = ny_file if ny is None else ny
+    if nx is None or ny is None:
+        raise ValueError("Image size missing for {0}".format(loop_profile_path))
+    return findMeshFromLoops(
+        dict_loop,
+        nx,
+        ny,
+        auto_mesh_working_dir,
+        loop_max_width=loop_max_width,
+        loop_min_width=loop_min_width,
+        find_largest_mesh=find_largest_mesh,
+        artifacts=artifacts,
+        artifact_writer=artifact_writer,
+    )
 
 
-def filterDifferenceImage(difference_image, threshold_value=30):
+def filterDifferenceImage(
+    difference_image, threshold_value=30, output=None, iterations=2
+):
     """
     First applies a threshold of default value 30.
-    Then erodes the image twice, and then dilates the image twice.
+    Then erodes the image twice, and then dilates the image twice, i.e. a
+    binary opening with two iterations (by default) of the cross shaped
+    structuring element. The thresholded image is written into output (a
+    boolean array of the same shape) if given, and is reused for the final
+    result so only one intermediate image is allocated.
     """
-    threshold_value = 30
-    binary_image = difference_image >= threshold_value
-    filtered_image = scipy.ndimage.morphology.binary_erosion(binary_image).astype(
-        binary_image.dtype
-    )
-    filtered_image = scipy.ndimage.morphology.binary_erosion(filtered_image).astype(
-        binary_image.dtype
+    binary_image = numpy.greater_equal(difference_image, threshold_value, out=output)
+    eroded_image = scipy.ndimage.binary_erosion(binary_image, iterations=iterations)
+    scipy.ndimage.binary_dilation(
+        eroded_image, iterations=iterations, output=binary_image
     )
-    filtered_image = scipy.ndimage.morphology.binary_dilation(filtered_image).astype(
-        binary_image.dtype
-    )
-    filtered_image = scipy.ndimage.morphology.binary_dilation(filtered_image).astype(
-        binary_image.dtype
-    )
-    return filtered_image
+    return binary_image
 
 
-def findOptimalMesh(
+def findOptimalMeshVectorized(
     dict_loop,
     snapshot_dir,
     nx,
@@ -334,184 +2600,265 @@ def findOptimalMesh(
     loop_min_width=150,
     debug=False,
     find_largest_mesh=False,
+    artifacts=None,
+    artifact_writer=None,
 ):
-    array_phiz = None
-    min_thickness = None
-    angle_min_thickness = None
-    max_thickness = None
-    angle_max_thickness = None
-    mesh_xmax = None
-    std_phiz = None
+    """
+    Finds the mesh and the oscillation angle from the loop shapes of
+    dict_loop. The shapes of all the angles are stacked in (angle, column)
+    arrays with a validity mask, so that phiz and the thickness of all the
+    angles are found with a few array reductions instead of loops over the
+    angles.
+
+    The shapes of opposite angles are combined column by column: where the
+    former implementation dropped a pair of angles whose shapes do not have
+    the same number of columns, phiz is here averaged over the pairs valid
+    in each column. Both give the same results when no column is missing,
+    see tests/data/findOptimalMesh_results.json.
+    """
+    artifacts = resolveArtifacts(artifacts, debug)
+    debug = artifacts == ARTIFACTS_DEBUG
+    artifact_writer = getArtifactWriter(artifact_writer)
     loop_min_width = int(loop_min_width)
     loop_max_width = int(loop_max_width)
-    for omega in [0, 30, 60, 90, 120, 150]:
-        str_omega1 = "%d" % omega
-        str_omega2 = "%03d" % (omega + 180)
-        (list_index1, list_upper1, list_lower1) = dict_loop[str_omega1]
-        (list_index2, list_upper2, list_lower2) = dict_loop[str_omega2]
-        array_index1 = numpy.array(list_index1)
-        array_index2 = numpy.array(list_index2)
+    list_omega = sorted(int(str_omega) for str_omega in dict_loop)
+    list_loop = [asLoopProfile(dict_loop["%d" % omega]) for omega in list_omega]
+    # Pairs of opposite angles, as rows of the stacked arrays
+    list_row_pair = [
+        (row, list_omega.index(omega + 180))
+        for row, omega in enumerate(list_omega)
+        if omega < 180 and omega + 180 in list_omega
+    ]
+    mesh_xmax = None
+    for row1, row2 in list_row_pair:
+        array_index1 = list_loop[row1].index
+        array_index2 = list_loop[row2].index
         if len(array_index1) == 0 or len(array_index2) == 0:
             break
-        if mesh_xmax is None:
-            mesh_xmax = numpy.max(array_index1)
-        elif mesh_xmax > numpy.max(array_index1):
-            mesh_xmax = numpy.max(array_index1)
-        if mesh_xmax > numpy.max(array_index2):
-            mesh_xmax = numpy.max(array_index2)
+        x_last = min(array_index1[-1], array_index2[-1])
+        if mesh_xmax is None or mesh_xmax > x_last:
+            mesh_xmax = x_last
     if mesh_xmax is None:
         mesh_xmax = loop_max_width
     mesh_xmin = mesh_xmax - loop_max_width
-    n_phi = 0
-    for omega in [0, 30, 60, 90, 120, 150]:
-        str_omega1 = "%d" % omega
-        str_omega2 = "%03d" % (omega + 180)
-        (array_index1, array_upper1, array_lower1) = dict_loop[str_omega1]
-        (array_index2, array_upper2, array_lower2) = dict_loop[str_omega2]
-        array_index = numpy.arange(mesh_xmin, mesh_xmax - 1)
-        # Exclude region in horizontal center
-        x_exclud_min = numpy.float64(nx / 2 - 20)
-        x_exclud_max = numpy.float64(nx / 2 + 20)
-        indices1 = numpy.where(
-            ((array_index1 > mesh_xmin) & (array_index1 < x_exclud_min))
-            | ((array_index1 < mesh_xmax) & (array_index1 > x_exclud_max))
-        )
-        indices2 = numpy.where(
-            ((array_index2 > mesh_xmin) & (array_index2 < x_exclud_min))
-            | ((array_index2 < mesh_xmax) & (array_index2 > x_exclud_max))
-        )
-        array_upper1 = numpy.array(array_upper1)[indices1]
-        array_upper2 = numpy.array(array_upper2)[indices2]
-        array_lower1 = numpy.array(array_lower1)[indices1]
-        array_lower2 = numpy.array(array_lower2)[indices2]
-        if True:
-            pylab.plot(array_upper1, "+", color="red")
-            pylab.plot(array_upper2, "+", color="blue")
-            pylab.plot(array_lower1, "+", color="red")
-            pylab.plot(array_lower2, "+", color="blue")
-            pylab.savefig(
-                os.path.join(
-                    auto_mesh_working_dir,
-                    "shapePlot_%03d_%03d.png" % (omega, omega + 180),
-                )
-            )
-            pylab.close()
-        phiz = None
-        if (array_upper1.shape == array_lower2.shape) and (
-            array_upper2.shape == array_lower1.shape
-        ):
-            phiz1 = (array_upper1 + array_lower2) / 2.0
-            phiz2 = (array_upper2 + array_lower1) / 2.0
-            phiz = (phiz1 + phiz2) / 2.0
-        elif array_upper1.shape == array_lower2.shape:
-            phiz = (array_upper1 + array_lower2) / 2.0
-        elif array_upper2.shape == array_lower1.shape:
-            phiz = (array_upper2 + array_lower1) / 2.0
-        if phiz is not None:
-            if debug:
-                pylab.plot(phiz, "+")
-                pylab.savefig(
+    # Phiz, excluding the region in the horizontal center
+    x_exclud_min = numpy.float64(nx / 2 - 20)
+    x_exclud_max = numpy.float64(nx / 2 + 20)
+    x_first = int(min(mesh_xmin, numpy.floor(x_exclud_max))) + 1
+    x_end = int(max(mesh_xmax, numpy.ceil(x_exclud_min)))
+    stack_upper, stack_lower, stack_mask = stackLoopProfiles(list_loop, x_first, x_end)
+    array_x = numpy.arange(x_first, max(x_end, x_first))
+    column_mask = ((array_x > mesh_xmin) & (array_x < x_exclud_min)) | (
+        (array_x < mesh_xmax) & (array_x > x_exclud_max)
+    )
+    stack_mask &= column_mask
+    array_phiz = None
+    delta_phiz = None
+    std_phiz = None
+    if len(list_row_pair) > 0:
+        array_row1, array_row2 = numpy.array(list_row_pair).T
+        pair_mask = stack_mask[array_row1] & stack_mask[array_row2]
+        phiz1 = (stack_upper[array_row1] + stack_lower[array_row2]) / 2.0
+        phiz2 = (stack_upper[array_row2] + stack_lower[array_row1]) / 2.0
+        pair_phiz = (phiz1 + phiz2) / 2.0
+        pair_count = numpy.count_nonzero(pair_mask, axis=0)
+        column_phiz = numpy.where(pair_mask, pair_phiz, 0.0).sum(axis=0)
+        if numpy.any(pair_count > 0):
+            array_phiz = column_phiz[pair_count > 0] / pair_count[pair_count > 0]
+        if artifacts != ARTIFACTS_NONE:
+            for index_pair, (row1, row2) in enumerate(list_row_pair):
+                omega = list_omega[row1]
+                mask1 = stack_mask[row1]
+                mask2 = stack_mask[row2]
+                artifact_writer.submit(
+                    plotShapePair,
                     os.path.join(
                         auto_mesh_working_dir,
-                        "phiz_%03d_%03d.png" % (omega, omega + 180),
-                    )
+                        "shapePlot_%03d_%03d.png" % (omega, omega + 180),
+                    ),
+                    stack_upper[row1][mask1],
+                    stack_upper[row2][mask2],
+                    stack_lower[row1][mask1],
+                    stack_lower[row2][mask2],
                 )
-                pylab.close()
-            if array_phiz is None:
-                array_phiz = numpy.array(phiz)
-                n_phi += 1
-            else:
-                if array_phiz.shape == phiz.shape:
-                    array_phiz += phiz
-                    n_phi += 1
-    if n_phi > 0:
-        array_phiz /= n_phi
+                if debug:
+                    artifact_writer.submit(
+                        plotArrays,
+                        os.path.join(
+                            auto_mesh_working_dir,
+                            "phiz_%03d_%03d.png" % (omega, omega + 180),
+                        ),
+                        [(pair_phiz[index_pair][pair_mask[index_pair]], "+")],
+                    )
+    if array_phiz is not None:
         # Cut off 20 points from each side of array
         # in order to remove artifacts at end points
         array_phiz = array_phiz[20:-20]
-        # arrayIndexPhiz = array_index[20:-20]
-        if True:
-            pylab.plot(array_phiz, "+")
+        if artifacts != ARTIFACTS_NONE:
             phiz_path = os.path.join(auto_mesh_working_dir, "phiz.png")
-            pylab.savefig(phiz_path)
-            pylab.close()
+            artifact_writer.submit(plotArrays, phiz_path, [(array_phiz, "+")])
         average_phiz = numpy.mean(array_phiz)
         std_phiz = numpy.std(array_phiz)
         delta_phiz = ny / 2 - average_phiz
+    # Sample thickness: minimum between loop_min_width and loop_max_width
+    # columns from the right of each shape
+    stack_upper, stack_lower, stack_mask = stackLoopProfiles(
+        list_loop, mesh_xmin + 1, mesh_xmax
+    )
+    stack_thickness = stack_upper.astype(numpy.int32) - stack_lower
+    stack_rank = numpy.cumsum(stack_mask, axis=1) - 1
+    array_count = stack_rank[:, -1] + 1 if stack_mask.shape[1] > 0 else 0
+    array_count = numpy.broadcast_to(array_count, (len(list_loop),))
+    # Python slice [-loop_max_width:-loop_min_width] of each shape
+    if loop_max_width > 0:
+        array_start = numpy.maximum(array_count - loop_max_width, 0)
+    else:
+        array_start = numpy.zeros_like(array_count)
+    if loop_min_width > 0:
+        array_stop = numpy.maximum(array_count - loop_min_width, 0)
+    else:
+        array_stop = numpy.zeros_like(array_count)
+    crop_mask = (
+        stack_mask
+        & (stack_rank >= array_start[:, numpy.newaxis])
+        & (stack_rank < array_stop[:, numpy.newaxis])
+    )
+    has_crop = crop_mask.any(axis=1)
+    column_min = numpy.argmin(
+        numpy.where(crop_mask, stack_thickness, numpy.iinfo(numpy.int32).max), axis=1
+    )
+    # As in the former implementation the minimum is given as an index in
+    # the shape arrays, which is the column if the shape starts at the first
+    # column
+    array_before = numpy.array(
+        [
+            numpy.count_nonzero(loop.mask[: max(0, mesh_xmin + 1 - loop.x_start)])
+            for loop in list_loop
+        ],
+        dtype=int,
+    )
+    if stack_mask.shape[1] > 0:
+        array_index_min = (
+            array_before + stack_rank[numpy.arange(len(list_loop)), column_min]
+        )
     else:
-        average_phiz = None
-        delta_phiz = None
-    # Sample thickness
-    list_thickness_index = []
-    for omega in [0, 30, 60, 90, 120, 150, 180, 210, 270, 300, 330]:
-        str_omega = "%d" % omega
-        (array_index, array_upper, array_lower) = dict_loop[str_omega]
-        indices = numpy.where((array_index > mesh_xmin) & (array_index < mesh_xmax))
-        array_upper = numpy.array(array_upper)[indices]
-        array_lower = numpy.array(array_lower)[indices]
-        array_thickness = array_upper - array_lower
-        # Look for a minima between 100 and 300 pixels from the right:
-        array_thickness_crop = array_thickness[-loop_max_width:-loop_min_width]
-        indices_thickness_crop = indices[0][-loop_max_width:-loop_min_width]
-        if debug:
-            pylab.plot(array_upper, "-")
-            pylab.plot(array_lower, "*")
-            pylab.plot(array_thickness_crop, "+")
-            phiz_path = os.path.join(
-                auto_mesh_working_dir, "thickness_%s.png" % str_omega
-            )
-            pylab.savefig(phiz_path)
-            pylab.close()
-        if len(array_thickness_crop) > 0:
-            tmp_min = numpy.argmin(array_thickness_crop)
-            #            if tmpMin > 75:
-            #                tmpMin = 75
-            index_min = indices_thickness_crop[tmp_min]
-            # Minimum mesh length: 150 pixels
-            list_thickness_index.append(index_min)
-            logging.debug("Index min: %d for omega = %d" % (index_min, omega))
+        array_index_min = array_before
+    list_thickness_index = array_index_min[has_crop].tolist()
+    if debug:
+        for row, omega in enumerate(list_omega):
+            mask = stack_mask[row]
+            artifact_writer.submit(
+                plotArrays,
+                os.path.join(auto_mesh_working_dir, "thickness_%d.png" % omega),
+                [
+                    (stack_upper[row][mask], "-"),
+                    (stack_lower[row][mask], "*"),
+                    (stack_thickness[row][crop_mask[row]], "+"),
+                ],
+            )
     logging.debug("List of thicknesses: %r" % list_thickness_index)
     if not find_largest_mesh and len(list_thickness_index) > 0:
-        max_index_thickness = max(list_thickness_index)
-        mesh_xmin = max_index_thickness
-        logging.debug("Max index for thickess: %d" % max_index_thickness)
+        mesh_xmin = max(list_thickness_index)
     else:
-        mesh_xmin = mesh_xmax - loop_max_width
-        if mesh_xmin < 0:
-            mesh_xmin = 0
+        mesh_xmin = max(mesh_xmax - loop_max_width, 0)
     logging.debug("mesh_xmin: %d" % mesh_xmin)
-    min_thickness_mesh_ymin = None
-    min_thickness_mesh_ymax = None
-    max_thickness_mesh_ymin = None
-    max_thickness_mesh_ymax = None
-    for omega in [0, 30, 60, 90, 120, 150, 180, 210, 270, 300, 330]:
-        str_omega = "%d" % omega
-        (array_index, array_upper, array_lower) = dict_loop[str_omega]
-        indices = numpy.where((array_index > mesh_xmin) & (array_index < mesh_xmax))
-        array_upper = numpy.array(array_upper)[indices]
-        array_lower = numpy.array(array_lower)[indices]
-        if len(array_lower) == 0 or len(array_upper) == 0:
-            break
-        max_thick = numpy.max(array_upper) - numpy.min(array_lower)
-        if max_thick > 400:
-            # Ignored
-            pass
-        else:
-            array_index = numpy.arange(mesh_xmin, mesh_xmax - 1)
-            if min_thickness is None or min_thickness > max_thick:
-                min_thickness = max_thick
-                angle_min_thickness = omega
-                min_thickness_mesh_ymin = numpy.min(array_lower)
-                min_thickness_mesh_ymax = numpy.max(array_upper)
-            #             if True:
-            #                 pylab.plot(array_upper, '+')
-            #                 pylab.plot(array_lower, '+')
-            #                 pylab.show()
-            if max_thickness is None or max_thickness < max_thick:
-                max_thickness = max_thick
-                angle_max_thickness = omega
-                max_thickness_mesh_ymin = numpy.min(array_lower)
-                max_thickness_mesh_ymax = numpy.max(array_upper)
+    # Thinnest and thickest views between mesh_xmin and mesh_xmax, the
+    # angles after the first one without loop are not used
+    stack_upper, stack_lower, stack_mask = stackLoopProfiles(
+        list_loop, mesh_xmin + 1, mesh_xmax
+    )
+    is_used = numpy.cumprod(stack_mask.any(axis=1)).astype(bool)
+    array_ymax = numpy.max(
+        numpy.where(stack_mask, stack_upper, numpy.iinfo(stack_upper.dtype).min),
+        axis=1,
+        initial=numpy.iinfo(stack_upper.dtype).min,
+    )
+    array_ymin = numpy.min(
+        numpy.where(stack_mask, stack_lower, numpy.iinfo(stack_lower.dtype).max),
+        axis=1,
+        initial=numpy.iinfo(stack_lower.dtype).max,
+    )
+    array_max_thick = array_ymax.astype(numpy.int32) - array_ymin
+    is_candidate = is_used & (array_max_thick <= 400)
+    min_thickness_info = (None, None, None, None)
+    max_thickness_info = (None, None, None, None)
+    if is_candidate.any():
+        row_min = numpy.argmin(numpy.where(is_candidate, array_max_thick, numpy.inf))
+        row_max = numpy.argmax(numpy.where(is_candidate, array_max_thick, -numpy.inf))
+        min_thickness_info = (
+            array_max_thick[row_min],
+            list_omega[row_min],
+            array_ymin[row_min],
+            array_ymax[row_min],
+        )
+        max_thickness_info = (
+            array_max_thick[row_max],
+            list_omega[row_max],
+            array_ymin[row_max],
+            array_ymax[row_max],
+        )
+    return _optimalMeshResult(
+        nx,
+        ny,
+        mesh_xmin,
+        mesh_xmax,
+        delta_phiz,
+        std_phiz,
+        find_largest_mesh,
+        min_thickness_info,
+        max_thickness_info,
+    )
+
+
+# Name of the function before the vectorized implementation
+findOptimalMesh = findOptimalMeshVectorized
+
+
+def stackLoopProfiles(list_loop, x_min, x_max):
+    """
+    Returns the upper, lower and mask arrays of the LoopProfile in list_loop
+    for the columns x_min to x_max - 1 as (angle, column) arrays.
+    """
+    x_min = int(x_min)
+    x_max = max(int(x_max), x_min)
+    list_columns = [loop.columns(x_min, x_max) for loop in list_loop]
+    if len(list_columns) == 0:
+        empty = numpy.zeros((0, x_max - x_min), numpy.int16)
+        return empty, empty.copy(), empty.astype(bool)
+    stack_upper, stack_lower, stack_mask = [
+        numpy.stack(list_array) for list_array in zip(*list_columns)
+    ]
+    return stack_upper, stack_lower, stack_mask
+
+
+def _optimalMeshResult(
+    nx,
+    ny,
+    mesh_xmin,
+    mesh_xmax,
+    delta_phiz,
+    std_phiz,
+    find_largest_mesh,
+    min_thickness_info,
+    max_thickness_info,
+):
+    """
+    Last part of findOptimalMeshVectorized: the mesh and angle in pixels
+    from the (thickness, angle, ymin, ymax) of the thinnest and thickest
+    views.
+    """
+    (
+        min_thickness,
+        angle_min_thickness,
+        min_thickness_mesh_ymin,
+        min_thickness_mesh_ymax,
+    ) = min_thickness_info
+    (
+        max_thickness,
+        angle_max_thickness,
+        max_thickness_mesh_ymin,
+        max_thickness_mesh_ymax,
+    ) = max_thickness_info
     mesh_xmin -= 50
     logging.debug(
         "Max thickness = %r pxiels at omega %r" % (max_thickness, angle_max_thickness)
@@ -535,8 +2882,10 @@ def findOptimalMesh(
     else:
         logging.warning("Delta phiz could not be determined!")
 
-    x1_pixels = mesh_xmin - nx / 2
-    dx_pixels = mesh_xmax - mesh_xmin
+    # Plain Python numbers, the loop profiles can be int16 arrays in which
+    # the callers' arithmetic would overflow
+    x1_pixels = float(mesh_xmin - nx / 2)
+    dx_pixels = int(mesh_xmax) - int(mesh_xmin)
     y1_pixels = None
     dy_pixels = None
     angle = None
@@ -547,12 +2896,12 @@ def findOptimalMesh(
         and (max_thickness_mesh_ymax is not None)
     ):
         if find_largest_mesh:
-            y1_pixels = max_thickness_mesh_ymin - ny / 2
-            dy_pixels = max_thickness_mesh_ymax - max_thickness_mesh_ymin
+            y1_pixels = float(max_thickness_mesh_ymin - ny / 2)
+            dy_pixels = int(max_thickness_mesh_ymax) - int(max_thickness_mesh_ymin)
             angle = angle_max_thickness
         else:
-            y1_pixels = min_thickness_mesh_ymin - ny / 2
-            dy_pixels = min_thickness_mesh_ymax - min_thickness_mesh_ymin
+            y1_pixels = float(min_thickness_mesh_ymin - ny / 2)
+            dy_pixels = int(min_thickness_mesh_ymax) - int(min_thickness_mesh_ymin)
             angle = angle_min_thickness
     debug_message = f"angle={angle}"
     debug_message += f" x1_pixels={x1_pixels}, y1_pixels={y1_pixels}"
@@ -562,17 +2911,80 @@ def findOptimalMesh(
     return (angle, x1_pixels, y1_pixels, dx_pixels, dy_pixels, delta_phiz, std_phiz)
 
 
+def newFigure(figsize=None):
+    """
+    Returns a matplotlib Figure with its own Agg canvas. The figure doesn't
+    use the global pyplot state so figures can be made in several threads.
+    """
+    import matplotlib.figure
+    import matplotlib.backends.backend_agg
+
+    figure = matplotlib.figure.Figure(figsize=figsize)
+    matplotlib.backends.backend_agg.FigureCanvasAgg(figure)
+    return figure
+
+
 def plot_img(img, plot_path):
     imgshape = img.shape
     extent = (0, imgshape[1], 0, imgshape[0])
-    _ = pyplot.imshow(img, extent=extent)
-    pyplot.gray()
-    pyplot.colorbar()
-    pyplot.savefig(plot_path)
-    pyplot.close()
+    figure = newFigure()
+    axes = figure.add_subplot()
+    axes_image = axes.imshow(img, extent=extent, cmap="gray")
+    figure.colorbar(axes_image, ax=axes)
+    figure.savefig(plot_path)
     return
 
 
+def plotLoopShape(plot_path, list_index, list_upper, list_lower, imgshape):
+    figure = newFigure()
+    axes = figure.add_subplot()
+    axes.plot(list_index, list_upper, "+")
+    axes.plot(list_index, list_lower, "+")
+    axes.set_xlim([0, imgshape[1]])
+    axes.set_ylim([0, imgshape[0]])
+    figure.savefig(plot_path)
+
+
+def plotShapePair(plot_path, array_upper1, array_upper2, array_lower1, array_lower2):
+    figure = newFigure()
+    axes = figure.add_subplot()
+    axes.plot(array_upper1, "+", color="red")
+    axes.plot(array_upper2, "+", color="blue")
+    axes.plot(array_lower1, "+", color="red")
+    axes.plot(array_lower2, "+", color="blue")
+    figure.savefig(plot_path)
+
+
+def plotArrays(plot_path, list_array_format):
+    figure = newFigure()
+    axes = figure.add_subplot()
+    for array, plot_format in list_array_format:
+        axes.plot(array, plot_format)
+    figure.savefig(plot_path)
+
+
+def plotCentrePin(
+    plot_path, index_loop, array_upper, array_lower, mean_array, xc, yc, r=None
+):
+    figure = newFigure()
+    axes = figure.add_subplot()
+    axes.plot(index_loop, array_upper, "+", color="blue")
+    axes.plot(index_loop, array_lower, "+", color="blue")
+    if r is not None:
+        array_theta = numpy.radians(numpy.arange(0, 360, 5))
+        axes.plot(
+            xc + r * numpy.cos(array_theta),
+            yc + r * numpy.sin(array_theta),
+            ".",
+            color="red",
+        )
+    else:
+        axes.plot(index_loop, mean_array, "+", color="green")
+    axes.plot([xc], [yc], "+", color="black")
+    axes.set_aspect("equal")
+    figure.savefig(plot_path)
+
+
 def plotMesh(
     image_path,
     grid_info,
@@ -585,11 +2997,21 @@ def plotMesh(
     (x1_pixels, y1_pixels, dx_pixels, dy_pixels) = gridInfoToPixels(
         grid_info, pixels_per_mm
     )
+    import matplotlib.figure
+
     img = imageio.imread(image_path, as_gray=True)
     imgshape = img.shape
     extent = (0, imgshape[1], 0, imgshape[0])
-    pylab.matshow(img / numpy.max(img), extent=extent)
-    pylab.gray()
+    figsize = matplotlib.figure.figaspect(img)
+    if show_plot:
+        # Only an interactive plot needs the global pyplot state
+        import matplotlib.pyplot as pyplot
+
+        figure = pyplot.figure(figsize=figsize)
+    else:
+        figure = newFigure(figsize=figsize)
+    axes = figure.add_axes((0.15, 0.09, 0.775, 0.775))
+    axes.matshow(img / numpy.max(img), extent=extent, cmap="gray")
     ny, nx = imgshape
     if sign_phiy < 0:
         mesh_xmin = nx / 2 - x1_pixels
@@ -598,18 +3020,17 @@ def plotMesh(
     mesh_ymin = ny / 2 - y1_pixels
     mesh_xmax = mesh_xmin + dx_pixels
     mesh_ymax = mesh_ymin - dy_pixels
-    pylab.plot([mesh_xmin, mesh_xmin], [mesh_ymin, mesh_ymax], color="red", linewidth=2)
-    pylab.plot([mesh_xmax, mesh_xmax], [mesh_ymin, mesh_ymax], color="red", linewidth=2)
-    pylab.plot([mesh_xmin, mesh_xmax], [mesh_ymin, mesh_ymin], color="red", linewidth=2)
-    pylab.plot([mesh_xmin, mesh_xmax], [mesh_ymax, mesh_ymax], color="red", linewidth=2)
+    axes.plot([mesh_xmin, mesh_xmin], [mesh_ymin, mesh_ymax], color="red", linewidth=2)
+    axes.plot([mesh_xmax, mesh_xmax], [mesh_ymin, mesh_ymax], color="red", linewidth=2)
+    axes.plot([mesh_xmin, mesh_xmax], [mesh_ymin, mesh_ymin], color="red", linewidth=2)
+    axes.plot([mesh_xmin, mesh_xmax], [mesh_ymax, mesh_ymax], color="red", linewidth=2)
     mesh_snap_shot_path = os.path.join(destination_dir, file_name)
-    axes = pyplot.gca()
     axes.set_xlim([0, imgshape[1]])
     axes.set_ylim([0, imgshape[0]])
-    pylab.savefig(mesh_snap_shot_path, bbox_inches="tight")
+    figure.savefig(mesh_snap_shot_path, bbox_inches="tight")
     if show_plot:
-        pylab.show()
-    pylab.close()
+        pyplot.show()
+        pyplot.close(figure)
     return mesh_snap_shot_path
 
 
@@ -621,7 +3042,12 @@ def gridInfoToPixels(grid_info, pixels_per_mm):
     return (x1_pixels, y1_pixels, dx_pixels, dy_pixels)
 
 
+# Interactive helpers, these use the global pyplot state
+
+
 def plotImage(image):
+    import matplotlib.pyplot as pyplot
+
     imgshape = image.shape
     extent = (0, imgshape[1], 0, imgshape[0])
     pyplot.imshow(image, extent=extent)
@@ -629,6 +3055,8 @@ def plotImage(image):
 
 
 def plotLoopExam(image, listIndex, listLower, listUpper):
+    import matplotlib.pyplot as pyplot
+
     pyplot.plot(listIndex, listUpper, "+")
     pyplot.plot(listIndex, listLower, "+")
     pyplot.show()
@@ -23,10 +23,19 @@
 # ############################################################################*/
 
 import os
+import sys
 import json
+import pickle
 import shutil
 import unittest
 import tempfile
+import subprocess
+import unittest.mock
+import concurrent.futures
+from multiprocessing import shared_memory
+
+import numpy
+import scipy.ndimage
 
 import lib_auto_mesh
 
@@ -41,6 +50,7 @@ class Test(unittest.TestCase):
         os.chmod(self.working_dir, 0o755)
 
     def tearDown(self) -> None:
+        lib_auto_mesh.waitForArtifacts()
         shutil.rmtree(self.working_dir)
 
     def test_checkForCorrelatedImages(self):
@@ -79,6 +89,24 @@ class Test(unittest.TestCase):
         )
         self.assertTrue(are_the_same_image)
 
+    def test_autoMesh_identicalImages_notAnalysed(self):
+        kwargs = dict(
+            workflow_working_dir=self.working_dir,
+            auto_mesh_working_dir=self.working_dir,
+            loop_max_width=330,
+            loop_min_width=250,
+        )
+        for snapshot_dir, no_calls in [
+            (os.path.join(self.test_data_directory, "snapshots_sameimage_1"), 0),
+            (os.path.join(self.test_data_directory, "snapshots_20141128-084026"), 12),
+        ]:
+            with unittest.mock.patch.object(
+                lib_auto_mesh, "analyseImage", wraps=lib_auto_mesh.analyseImage
+            ) as analyse_image:
+                result = lib_auto_mesh.autoMesh(snapshot_dir, **kwargs)
+            self.assertEqual(analyse_image.call_count, no_calls)
+            self.assertEqual(result[8], no_calls == 0)
+
     @unittest.skipIf(
         not os.path.exists(
             os.path.join(SCISOFT_DIR, "snapshots_20151013-152805_jhp9cH")
@@ -234,6 +262,930 @@ class Test(unittest.TestCase):
         # os.system("display %s" % result_image_path)
         self.assertTrue(os.path.exists(result_image_path))
 
+    def test_autoMesh_debug(self):
+        snapshot_dir = os.path.join(
+            self.test_data_directory, "snapshots_20141128-084026"
+        )
+        kwargs = dict(loop_max_width=0.35 * 608, loop_min_width=0.5 * 608)
+        result = lib_auto_mesh.autoMesh(
+            snapshot_dir, self.working_dir, self.working_dir, **kwargs
+        )
+        debug_dir = tempfile.mkdtemp(prefix="debug_", dir=self.working_dir)
+        result_debug = lib_auto_mesh.autoMesh(
+            snapshot_dir, debug_dir, debug_dir, debug=True, **kwargs
+        )
+        lib_auto_mesh.waitForArtifacts()
+        self.assertEqual(result_debug, result)
+        self.assertTrue(os.path.exists(os.path.join(debug_dir, "rawImage_000.png")))
+        self.assertTrue(os.path.exists(os.path.join(debug_dir, "shapePlot_330.png")))
+
+    def test_autoMeshFromArrays(self):
+        snapshot_dir = os.path.join(
+            self.test_data_directory, "snapshots_20141128-084026"
+        )
+        list_omega = [0, 30, 60, 90, 120, 150, 180, 210, 240, 270, 300, 330]
+        dict_image = lib_auto_mesh.readSnapshots(snapshot_dir, list_omega)
+        background = lib_auto_mesh.readBackground(
+            os.path.join(snapshot_dir, "snapshot_background.png")
+        )
+        result_arrays = lib_auto_mesh.autoMeshFromArrays(
+            dict_image,
+            background,
+            self.working_dir,
+            loop_max_width=0.35 * 608,
+            loop_min_width=0.5 * 608,
+            find_largest_mesh=True,
+        )
+        result_dir = lib_auto_mesh.autoMesh(
+            snapshot_dir,
+            self.working_dir,
+            self.working_dir,
+            loop_max_width=0.35 * 608,
+            loop_min_width=0.5 * 608,
+            find_largest_mesh=True,
+        )
+        self.assertEqual(result_arrays, result_dir[:7] + result_dir[8:])
+
+    def test_autoMesh_npy(self):
+        snapshot_dir = os.path.join(
+            self.test_data_directory, "snapshots_20141128-084026"
+        )
+        npy_dir = os.path.join(self.working_dir, "snapshots")
+        os.mkdir(npy_dir)
+        list_omega = lib_auto_mesh.LIST_OMEGA_MESH
+        for omega, image in lib_auto_mesh.readSnapshots(
+            snapshot_dir, list_omega, compact=True
+        ).items():
+            numpy.save(os.path.join(npy_dir, "snapshot_%03d.npy" % omega), image)
+        kwargs = dict(loop_max_width=0.35 * 608, loop_min_width=0.5 * 608)
+        result = lib_auto_mesh.autoMesh(
+            snapshot_dir,
+            self.working_dir,
+            self.working_dir,
+            compact=True,
+            **kwargs
+        )
+        # The background stays a PNG file
+        shutil.copy(os.path.join(snapshot_dir, "snapshot_background.png"), npy_dir)
+        result_npy = lib_auto_mesh.autoMesh(
+            npy_dir,
+            self.working_dir,
+            self.working_dir,
+            extension="npy",
+            background_extension="png",
+            compact=True,
+            **kwargs
+        )
+        self.assertEqual(result_npy[:7], result[:7])
+        self.assertEqual(
+            result_npy[7],
+            os.path.join(npy_dir, "snapshot_%03d.npy" % result_npy[0]),
+        )
+        image = lib_auto_mesh.readImage(
+            os.path.join(npy_dir, "snapshot_000.npy"), compact=True
+        )
+        self.assertIs(type(image), numpy.ndarray)
+        self.assertIsInstance(image.base, numpy.memmap)
+        self.assertFalse(image.flags.writeable)
+
+    def test_autoMesh_snapshotStack(self):
+        snapshot_dir = os.path.join(
+            self.test_data_directory, "snapshots_20141128-084026"
+        )
+        stack_path = os.path.join(self.working_dir, "snapshots.npz")
+        list_omega = lib_auto_mesh.convertSnapshotDir(snapshot_dir, stack_path)
+        self.assertEqual(list_omega, list(lib_auto_mesh.LIST_OMEGA_MESH))
+        self.assertTrue(lib_auto_mesh.isSnapshotStack(stack_path))
+        self.assertFalse(lib_auto_mesh.isSnapshotStack(snapshot_dir))
+        dict_image, background_image = lib_auto_mesh.readSnapshotStack(stack_path)
+        self.assertEqual(sorted(dict_image), list_omega)
+        self.assertEqual(background_image.dtype, numpy.uint8)
+        self.assertTrue(
+            numpy.array_equal(
+                dict_image[90],
+                lib_auto_mesh.readImage(
+                    os.path.join(snapshot_dir, "snapshot_090.png"), compact=True
+                ),
+            )
+        )
+        kwargs = dict(loop_max_width=0.35 * 608, loop_min_width=0.5 * 608)
+        result = lib_auto_mesh.autoMesh(
+            snapshot_dir, self.working_dir, self.working_dir, compact=True, **kwargs
+        )
+        metrics = lib_auto_mesh.Metrics()
+        result_stack = lib_auto_mesh.autoMesh(
+            stack_path, self.working_dir, self.working_dir, metrics=metrics, **kwargs
+        )
+        self.assertEqual(result_stack[:7], result[:7])
+        # The snapshot at the best omega is written out as an image
+        self.assertEqual(
+            result_stack[7],
+            os.path.join(self.working_dir, "snapshot_%03d.png" % result_stack[0]),
+        )
+        numpy.testing.assert_array_equal(
+            lib_auto_mesh.readImage(result_stack[7], compact=True),
+            dict_image[result_stack[0]],
+        )
+        # One bulk read for the whole rotation and the background
+        self.assertEqual(metrics.toDict()["counters"]["images_read"], 1)
+        with self.assertRaises(RuntimeError):
+            lib_auto_mesh.autoMesh(
+                stack_path,
+                self.working_dir,
+                self.working_dir,
+                list_omega=[0, 45, 90],
+                **kwargs
+            )
+
+    def test_autoMeshFromSharedMemory(self):
+        snapshot_dir = os.path.join(
+            self.test_data_directory, "snapshots_20141128-084026"
+        )
+        list_omega = lib_auto_mesh.LIST_OMEGA_MESH
+        dict_image = lib_auto_mesh.readSnapshots(snapshot_dir, list_omega, compact=True)
+        background = lib_auto_mesh.readBackground(
+            os.path.join(snapshot_dir, "snapshot_background.png"), compact=True
+        )
+        # All the frames in one block, as published by an acquisition process
+        frame_size = background.nbytes
+        block = shared_memory.SharedMemory(
+            create=True, size=frame_size * (len(list_omega) + 1)
+        )
+        try:
+            dict_frame = {}
+            for index, omega in enumerate([None] + list(list_omega)):
+                image = background if omega is None else dict_image[omega]
+                frame = numpy.ndarray(
+                    image.shape,
+                    dtype=image.dtype,
+                    buffer=block.buf,
+                    offset=index * frame_size,
+                )
+                frame[:] = image
+                del frame
+                dict_frame[omega] = {
+                    "name": block.name,
+                    "shape": list(image.shape),
+                    "dtype": image.dtype.str,
+                    "offset": index * frame_size,
+                }
+            background_frame = dict_frame.pop(None)
+            kwargs = dict(loop_max_width=0.35 * 608, loop_min_width=0.5 * 608)
+            result = lib_auto_mesh.autoMeshFromArrays(
+                dict_image, background, self.working_dir, **kwargs
+            )
+            result_shared = lib_auto_mesh.autoMeshFromSharedMemory(
+                {str(omega): frame for omega, frame in dict_frame.items()},
+                background_frame,
+                self.working_dir,
+                **kwargs
+            )
+            self.assertEqual(result_shared, result)
+            with lib_auto_mesh.sharedFrames(dict_frame) as dict_shared_image:
+                image = dict_shared_image[0]
+                self.assertFalse(image.flags.writeable)
+                numpy.testing.assert_array_equal(image, dict_image[0])
+                del image
+            # The block is still owned by its creator
+            shared_memory.SharedMemory(name=block.name).close()
+        finally:
+            block.close()
+            block.unlink()
+
+    def test_attachSharedFrame_otherProcess(self):
+        image = numpy.arange(12, dtype=numpy.uint8).reshape(3, 4)
+        block = shared_memory.SharedMemory(create=True, size=image.nbytes)
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(lib_auto_mesh.__file__))
+        try:
+            numpy.ndarray(image.shape, dtype=image.dtype, buffer=block.buf)[:] = image
+            # Attached by a separate process, e.g. the analysis service
+            code = (
+                "import lib_auto_mesh\n"
+                "frame = {{'name': '{0}', 'shape': [3, 4]}}\n"
+                "with lib_auto_mesh.sharedFrames({{0: frame}}) as dict_image:\n"
+                "    print(int(dict_image[0].sum()))".format(block.name)
+            )
+            output = subprocess.run(
+                [sys.executable, "-c", code],
+                env=env,
+                check=True,
+                capture_output=True,
+                text=True,
+            )
+            self.assertEqual(output.stdout.strip(), str(image.sum()))
+            self.assertEqual(output.stderr, "")
+            # The block is not unlinked when the attaching process exits
+            other_block = shared_memory.SharedMemory(name=block.name)
+            other_block.close()
+        finally:
+            block.close()
+            block.unlink()
+        # Attaching to a block created by the same process must not remove
+        # the registration that its unlink relies on
+        code = (
+            "from multiprocessing import shared_memory; import lib_auto_mesh; "
+            "block = shared_memory.SharedMemory(create=True, size=12); "
+            "shared, image = lib_auto_mesh.attachSharedFrame(block.name, (3, 4)); "
+            "del image; shared.close(); block.close(); block.unlink()"
+        )
+        output = subprocess.run(
+            [sys.executable, "-c", code],
+            env=env,
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        self.assertEqual(output.stderr, "")
+
+    def test_BackgroundModel_cache(self):
+        background_path = os.path.join(self.working_dir, "snapshot_background.png")
+        shutil.copy(
+            os.path.join(
+                self.test_data_directory,
+                "snapshots_20141128-084026",
+                "snapshot_background.png",
+            ),
+            background_path,
+        )
+        lib_auto_mesh.clearBackgroundCache()
+        background1 = lib_auto_mesh.BackgroundModel.fromFile(background_path)
+        background2 = lib_auto_mesh.BackgroundModel.fromFile(background_path)
+        self.assertIs(background1, background2)
+        self.assertFalse(background1.image.flags.writeable)
+        self.assertEqual(background1.shape, (493, 659))
+        # A modified file must be read again
+        stat = os.stat(background_path)
+        os.utime(background_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        background3 = lib_auto_mesh.BackgroundModel.fromFile(background_path)
+        self.assertIsNot(background1, background3)
+        background4 = lib_auto_mesh.BackgroundModel.fromFile(
+            background_path, cache_key="hash"
+        )
+        background5 = lib_auto_mesh.BackgroundModel.fromFile(
+            background_path, cache_key="hash"
+        )
+        self.assertIs(background4, background5)
+
+    def test_BackgroundModel_fromFrames(self):
+        rng = numpy.random.default_rng(0)
+        background_image = rng.integers(50, 200, size=(300, 40), dtype=numpy.uint8)
+        list_frame = [
+            numpy.clip(
+                background_image + rng.normal(0, 2, background_image.shape), 0, 255
+            ).astype(numpy.uint8)
+            for _ in range(9)
+        ]
+        # A frame with a bright spot, e.g. a passing reflection
+        list_frame[3][100:120, 10:20] = 255
+        for method in [
+            lib_auto_mesh.BACKGROUND_MEDIAN,
+            lib_auto_mesh.BACKGROUND_ROBUST_MEAN,
+        ]:
+            model = lib_auto_mesh.BackgroundModel.fromFrames(
+                list_frame, method=method, block_rows=64
+            )
+            self.assertEqual(model.image.dtype, numpy.uint8)
+            self.assertEqual(model.no_frames, 9)
+            difference = model.image.astype(int) - background_image
+            self.assertLessEqual(numpy.abs(difference).max(), 4)
+            self.assertLess(numpy.abs(model.estimate - background_image).mean(), 1)
+        with self.assertRaises(ValueError):
+            lib_auto_mesh.BackgroundModel.fromFrames(list_frame, method="mode")
+        # Running mean of the first frames, then moving average
+        model = lib_auto_mesh.BackgroundModel.fromFrames([numpy.zeros((2, 2))])
+        model2 = model.update(numpy.full((2, 2), 2.0), window=3)
+        self.assertEqual(model2.image.tolist(), [[1, 1], [1, 1]])
+        model3 = model2.update(numpy.full((2, 2), 4.0), window=3)
+        self.assertEqual(model3.image.tolist(), [[2, 2], [2, 2]])
+        model4 = model3.update(numpy.full((2, 2), 5.0), window=3)
+        self.assertEqual(model4.image.tolist(), [[3, 3], [3, 3]])
+        self.assertEqual(model4.no_frames, 4)
+        self.assertEqual(model.image.tolist(), [[0, 0], [0, 0]])
+        model_path = os.path.join(self.working_dir, "background.npz")
+        model4.save(model_path)
+        self.assertEqual(os.listdir(self.working_dir), ["background.npz"])
+        model5 = lib_auto_mesh.BackgroundModel.fromFile(model_path)
+        self.assertEqual(model5.no_frames, 4)
+        self.assertTrue(numpy.array_equal(model5.image, model4.image))
+        self.assertTrue(numpy.array_equal(model5.estimate, model4.estimate))
+        model6 = lib_auto_mesh.updateBackgroundModel(
+            model_path, numpy.full((2, 2), 9.0), window=3
+        )
+        self.assertEqual(model6.image.tolist(), [[5, 5], [5, 5]])
+        self.assertEqual(lib_auto_mesh.BackgroundModel.load(model_path).no_frames, 5)
+
+    def test_autoMesh_backgroundModel(self):
+        snapshot_dir = os.path.join(
+            self.test_data_directory, "snapshots_20141128-084026"
+        )
+        # Snapshots without background
+        sample_dir = os.path.join(self.working_dir, "sample")
+        os.mkdir(sample_dir)
+        for omega in lib_auto_mesh.LIST_OMEGA_MESH:
+            shutil.copy(
+                lib_auto_mesh.snapshotPath(snapshot_dir, "snapshot", omega), sample_dir
+            )
+        background_image = lib_auto_mesh.readBackground(
+            os.path.join(snapshot_dir, "snapshot_background.png"), compact=True
+        )
+        model_path = os.path.join(self.working_dir, "background.npz")
+        lib_auto_mesh.BackgroundModel.fromFrames([background_image] * 3).save(
+            model_path
+        )
+        kwargs = dict(loop_max_width=0.35 * 608, loop_min_width=0.5 * 608)
+        result = lib_auto_mesh.autoMesh(
+            snapshot_dir, self.working_dir, self.working_dir, compact=True, **kwargs
+        )
+        result_model = lib_auto_mesh.autoMesh(
+            sample_dir,
+            self.working_dir,
+            self.working_dir,
+            compact=True,
+            background=model_path,
+            **kwargs
+        )
+        self.assertEqual(result_model[:7], result[:7])
+        delta = lib_auto_mesh.findDeltaToCentre(
+            snapshot_dir, self.working_dir, compact=True, loop_width=100
+        )
+        delta_model = lib_auto_mesh.findDeltaToCentre(
+            sample_dir,
+            self.working_dir,
+            compact=True,
+            loop_width=100,
+            background=lib_auto_mesh.BackgroundModel.load(model_path),
+        )
+        self.assertEqual(delta_model, delta)
+
+    def test_loopExam(self):
+        def loopExamPerColumn(filtered_image):
+            ny, nx = filtered_image.shape
+            list_index, list_upper, list_lower = [], [], []
+            for index_x in range(nx):
+                indices = numpy.where(filtered_image[:, index_x])[0]
+                if len(indices) > 0:
+                    list_index.append(index_x)
+                    list_upper.append(ny - indices[0])
+                    list_lower.append(ny - indices[-1])
+            return (list_index, list_upper, list_lower)
+
+        snapshot_dir = os.path.join(
+            self.test_data_directory, "snapshots_20141128-084026"
+        )
+        background = lib_auto_mesh.readBackground(
+            os.path.join(snapshot_dir, "snapshot_background.png")
+        )
+        list_image = []
+        for omega in [0, 90, 180, 270]:
+            raw_img = lib_auto_mesh.readImage(
+                os.path.join(snapshot_dir, "snapshot_%03d.png" % omega)
+            )
+            list_image.append(
+                lib_auto_mesh.filterDifferenceImage(
+                    lib_auto_mesh.subtractBackground(raw_img, background)
+                )
+            )
+        rng = numpy.random.default_rng(0)
+        for _ in range(50):
+            shape = tuple(rng.integers(1, 100, size=2))
+            list_image.append(rng.random(shape) > rng.random())
+        list_image.append(numpy.zeros((40, 30), dtype=bool))
+        for image in list_image:
+            self.assertEqual(lib_auto_mesh.loopExam(image), loopExamPerColumn(image))
+
+    def test_autoMesh_parallel(self):
+        snapshot_dir = os.path.join(
+            self.test_data_directory, "snapshots_20141128-084026"
+        )
+        kwargs = dict(
+            loop_max_width=0.35 * 608,
+            loop_min_width=0.5 * 608,
+            find_largest_mesh=True,
+        )
+        result_serial = lib_auto_mesh.autoMesh(
+            snapshot_dir, self.working_dir, self.working_dir, **kwargs
+        )
+        result_threads = lib_auto_mesh.autoMesh(
+            snapshot_dir, self.working_dir, self.working_dir, workers=4, **kwargs
+        )
+        self.assertEqual(result_serial, result_threads)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=2) as executor:
+            result_processes = lib_auto_mesh.autoMesh(
+                snapshot_dir,
+                self.working_dir,
+                self.working_dir,
+                executor=executor,
+                **kwargs
+            )
+        self.assertEqual(result_serial, result_processes)
+
+    def test_concurrent_calls(self):
+        snapshot_dir = os.path.join(
+            self.test_data_directory, "snapshots_20141128-084026"
+        )
+        centre_dir = os.path.join(self.test_data_directory, "tungsten")
+        kwargs = dict(loop_max_width=0.35 * 608, loop_min_width=0.5 * 608)
+        result_mesh = lib_auto_mesh.autoMesh(
+            snapshot_dir, self.working_dir, self.working_dir, **kwargs
+        )
+        result_centre = lib_auto_mesh.findDeltaToCentre(
+            centre_dir, self.working_dir, loop_width=10.24
+        )
+
+        def runAutoMesh(index):
+            working_dir = tempfile.mkdtemp(dir=self.working_dir)
+            artifact_writer = lib_auto_mesh.ArtifactWriter(max_workers=2)
+            result = lib_auto_mesh.autoMesh(
+                snapshot_dir,
+                working_dir,
+                working_dir,
+                artifacts=lib_auto_mesh.ARTIFACTS_SUMMARY,
+                artifact_writer=artifact_writer,
+                **kwargs
+            )
+            artifact_writer.close()
+            return result
+
+        def runFindDeltaToCentre(index):
+            working_dir = tempfile.mkdtemp(dir=self.working_dir)
+            return lib_auto_mesh.findDeltaToCentre(
+                centre_dir,
+                working_dir,
+                loop_width=10.24,
+                artifacts=lib_auto_mesh.ARTIFACTS_SUMMARY,
+            )
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            future_mesh = [executor.submit(runAutoMesh, index) for index in range(4)]
+            future_centre = [
+                executor.submit(runFindDeltaToCentre, index) for index in range(4)
+            ]
+            for future in future_mesh:
+                self.assertEqual(future.result(), result_mesh)
+            for future in future_centre:
+                self.assertEqual(future.result(), result_centre)
+
+    def test_filterDifferenceImage(self):
+        snapshot_dir = os.path.join(
+            self.test_data_directory, "snapshots_20141128-084026"
+        )
+        background = lib_auto_mesh.readBackground(
+            os.path.join(snapshot_dir, "snapshot_background.png")
+        )
+        for omega in [0, 90, 180, 270]:
+            raw_img = lib_auto_mesh.readImage(
+                os.path.join(snapshot_dir, "snapshot_%03d.png" % omega)
+            )
+            difference_image = lib_auto_mesh.subtractBackground(raw_img, background)
+            for threshold_value in [30, 60]:
+                expected_image = difference_image >= threshold_value
+                for _ in range(2):
+                    expected_image = scipy.ndimage.binary_erosion(expected_image)
+                for _ in range(2):
+                    expected_image = scipy.ndimage.binary_dilation(expected_image)
+                output = numpy.empty(difference_image.shape, dtype=bool)
+                filtered_image = lib_auto_mesh.filterDifferenceImage(
+                    difference_image, threshold_value=threshold_value, output=output
+                )
+                self.assertIs(filtered_image, output)
+                self.assertTrue(numpy.array_equal(filtered_image, expected_image))
+
+    def test_autoMesh_compact(self):
+        snapshot_dir = os.path.join(
+            self.test_data_directory, "snapshots_20141128-084026"
+        )
+        image = lib_auto_mesh.readImage(
+            os.path.join(snapshot_dir, "snapshot_000.png"), compact=True
+        )
+        self.assertEqual(image.dtype, numpy.uint8)
+        self.assertEqual(image.ndim, 2)
+        difference_image = lib_auto_mesh.subtractBackground(
+            image, numpy.full_like(image, 200)
+        )
+        self.assertEqual(difference_image.dtype, numpy.uint8)
+        self.assertEqual(
+            difference_image.max(), max(200 - int(image.min()), int(image.max()) - 200)
+        )
+        kwargs = dict(loop_max_width=0.35 * 608, loop_min_width=0.5 * 608)
+        result = lib_auto_mesh.autoMesh(
+            snapshot_dir, self.working_dir, self.working_dir, **kwargs
+        )
+        result_compact = lib_auto_mesh.autoMesh(
+            snapshot_dir, self.working_dir, self.working_dir, compact=True, **kwargs
+        )
+        # Same mesh, the grey scale conversion only differs by rounding
+        self.assertEqual(result_compact[:5], result[:5])
+        self.assertAlmostEqual(result_compact[5], result[5], places=2)
+        self.assertEqual(result_compact[7:], result[7:])
+
+    def test_analyseImage_roi(self):
+        snapshot_dir = os.path.join(
+            self.test_data_directory, "snapshots_20141128-084026"
+        )
+        background = lib_auto_mesh.readBackground(
+            os.path.join(snapshot_dir, "snapshot_background.png")
+        )
+        list_case = []
+        for omega in [0, 90, 180, 270]:
+            raw_img = lib_auto_mesh.readImage(
+                os.path.join(snapshot_dir, "snapshot_%03d.png" % omega)
+            )
+            list_case.append((raw_img, background))
+        rng = numpy.random.default_rng(0)
+        for _ in range(100):
+            shape = tuple(rng.integers(5, 100, size=2))
+            raw_img = (rng.random(shape) > rng.random()) * 100.0
+            list_case.append((raw_img, numpy.zeros(shape)))
+        for raw_img, background in list_case:
+            loop_roi, _, filtered_roi = lib_auto_mesh.analyseImage(
+                raw_img, background, return_images=True
+            )
+            loop_full, _, filtered_full = lib_auto_mesh.analyseImage(
+                raw_img, background, return_images=True, use_roi=False
+            )
+            self.assertEqual(loop_roi, loop_full)
+            self.assertTrue(numpy.array_equal(filtered_roi, filtered_full))
+
+    def test_analyseImagePyramid(self):
+        for snapshot_name in ["snapshots_20141128-084026", "tungsten"]:
+            snapshot_dir = os.path.join(self.test_data_directory, snapshot_name)
+            background = lib_auto_mesh.BackgroundModel.fromFile(
+                os.path.join(snapshot_dir, "snapshot_background.png")
+            )
+            dict_image = lib_auto_mesh.readSnapshots(
+                snapshot_dir, lib_auto_mesh.LIST_OMEGA_CENTRE
+            )
+            for raw_img in dict_image.values():
+                loop = lib_auto_mesh.analyseImage(raw_img, background)
+                for pyramid in [2, 4]:
+                    self.assertEqual(
+                        lib_auto_mesh.analyseImage(
+                            raw_img, background, pyramid=pyramid
+                        ),
+                        loop,
+                    )
+        loop, difference_image, filtered_image = lib_auto_mesh.analyseImage(
+            raw_img, background, pyramid=4, return_images=True
+        )
+        self.assertEqual(filtered_image.shape, raw_img.shape)
+        self.assertTrue(filtered_image[:, loop.index].any(axis=0).all())
+        # Images smaller than the blocks
+        rng = numpy.random.default_rng(0)
+        for _ in range(20):
+            shape = tuple(rng.integers(2, 40, size=2))
+            raw_img = (rng.random(shape) > rng.random()) * 100.0
+            lib_auto_mesh.analyseImage(raw_img, numpy.zeros(shape), pyramid=4)
+        snapshot_dir = os.path.join(
+            self.test_data_directory, "snapshots_20141128-084026"
+        )
+        kwargs = dict(loop_max_width=0.35 * 608, loop_min_width=0.5 * 608)
+        result = lib_auto_mesh.autoMesh(
+            snapshot_dir, self.working_dir, self.working_dir, **kwargs
+        )
+        result_pyramid = lib_auto_mesh.autoMesh(
+            snapshot_dir, self.working_dir, self.working_dir, pyramid=2, **kwargs
+        )
+        self.assertEqual(result_pyramid, result)
+
+    def test_blockMean(self):
+        image = numpy.arange(30, dtype=numpy.uint8).reshape(5, 6)
+        block_mean = lib_auto_mesh.blockMean(image, 2)
+        self.assertEqual(block_mean.dtype, numpy.float32)
+        self.assertEqual(block_mean.tolist(), [[3.5, 5.5, 7.5], [15.5, 17.5, 19.5]])
+        self.assertTrue(
+            numpy.allclose(
+                lib_auto_mesh.blockMean(image.astype(float), 2), block_mean
+            )
+        )
+
+    def test_autoMeshFromArrays_identicalImages(self):
+        snapshot_dir = os.path.join(self.test_data_directory, "snapshots_sameimage_1")
+        list_omega = [0, 30, 60, 90, 120, 150, 180, 210, 240, 270, 300, 330]
+        dict_image = lib_auto_mesh.readSnapshots(snapshot_dir, list_omega)
+        background = lib_auto_mesh.readBackground(
+            os.path.join(snapshot_dir, "snapshot_background.png")
+        )
+        self.assertNotEqual(
+            lib_auto_mesh.imageFingerprint(dict_image[0]),
+            lib_auto_mesh.imageFingerprint(dict_image[0].astype(numpy.float64)),
+        )
+        # The identical images must not be analysed at all
+        with unittest.mock.patch.object(
+            lib_auto_mesh, "analyseImage", side_effect=AssertionError
+        ):
+            result = lib_auto_mesh.autoMeshFromArrays(
+                dict_image, background, self.working_dir
+            )
+        self.assertEqual(result, (None,) * 7 + (True,))
+
+    def test_AutoMeshAnalyser(self):
+        snapshot_dir = os.path.join(
+            self.test_data_directory, "snapshots_20141128-084026"
+        )
+        list_omega = [0, 30, 60, 90, 120, 150, 180, 210, 240, 270, 300, 330]
+        dict_image = lib_auto_mesh.readSnapshots(snapshot_dir, list_omega)
+        background = lib_auto_mesh.readBackground(
+            os.path.join(snapshot_dir, "snapshot_background.png")
+        )
+        kwargs = dict(loop_max_width=0.35 * 608, loop_min_width=0.5 * 608)
+        result = lib_auto_mesh.autoMeshFromArrays(
+            dict_image, background, self.working_dir, **kwargs
+        )
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            for analyser_executor in [None, executor]:
+                analyser = lib_auto_mesh.AutoMeshAnalyser(
+                    background, self.working_dir, executor=analyser_executor, **kwargs
+                )
+                with self.assertRaises(RuntimeError):
+                    analyser.getResult()
+                with self.assertRaises(ValueError):
+                    analyser.addImage(45, dict_image[0])
+                list_omega_acquisition = list_omega[1::2] + list_omega[0::2]
+                for omega in list_omega_acquisition[:-1]:
+                    self.assertFalse(analyser.addImage(omega, dict_image[omega]))
+                self.assertEqual(analyser.getMissingOmegas(), [300])
+                self.assertTrue(analyser.addImage(300, dict_image[300]))
+                self.assertTrue(analyser.isComplete())
+                self.assertEqual(analyser.result, result)
+                self.assertEqual(analyser.getResult(), result)
+
+    def test_autoMesh_listOmega(self):
+        snapshot_dir = os.path.join(
+            self.test_data_directory, "snapshots_20141128-084026"
+        )
+        kwargs = dict(loop_max_width=0.35 * 608, loop_min_width=0.5 * 608)
+        result = lib_auto_mesh.autoMesh(
+            snapshot_dir, self.working_dir, self.working_dir, **kwargs
+        )
+        list_omega = [0, 60, 120, 180, 240, 300]
+        result_subset = lib_auto_mesh.autoMesh(
+            snapshot_dir,
+            self.working_dir,
+            self.working_dir,
+            list_omega=list_omega,
+            **kwargs
+        )
+        self.assertIn(result_subset[0], list_omega)
+        self.assertEqual(result_subset[:5], result[:5])
+        self.assertAlmostEqual(result_subset[5], result[5], delta=1.0)
+        # The thinnest view is ambiguous from the four coarse angles only
+        result_adaptive = lib_auto_mesh.autoMesh(
+            snapshot_dir, self.working_dir, self.working_dir, adaptive=True, **kwargs
+        )
+        self.assertEqual(result_adaptive, result)
+
+    def test_AutoMeshAnalyser_adaptive(self):
+        snapshot_dir = os.path.join(
+            self.test_data_directory, "snapshots_20141128-084026"
+        )
+        background = lib_auto_mesh.readBackground(
+            os.path.join(snapshot_dir, "snapshot_background.png"), compact=True
+        )
+        # Synthetic loop, clearly thinnest at 90 and 270 degrees
+        dict_image = {}
+        for omega in lib_auto_mesh.LIST_OMEGA_MESH:
+            half_width = int(10 + 40 * abs(numpy.cos(numpy.radians(omega))))
+            image = background.copy()
+            image[250 - half_width : 250 + half_width, :400] //= 4
+            dict_image[omega] = image
+        kwargs = dict(loop_max_width=200, loop_min_width=300)
+        result = lib_auto_mesh.autoMeshFromArrays(
+            dict_image, background, self.working_dir, **kwargs
+        )
+        list_request = []
+
+        def getImages(list_omega):
+            list_request.append(list_omega)
+            return dict_image
+
+        analyser = lib_auto_mesh.AutoMeshAnalyser(
+            background, self.working_dir, adaptive=True, **kwargs
+        )
+        result_coarse = analyser.analyseImages(getImages)
+        # The coarse angles are enough, the others are never requested
+        self.assertEqual(list_request, [[0, 90, 180, 270]])
+        self.assertEqual(analyser.list_omega, [0, 90, 180, 270])
+        self.assertEqual(result_coarse, result)
+        self.assertIn(result_coarse[0], [90, 270])
+
+    def test_isThicknessAmbiguous(self):
+        list_index = list(range(100))
+        dict_loop = {
+            "0": (list_index, [60] * 100, [40] * 100),
+            "90": (list_index, [80] * 100, [20] * 100),
+        }
+        self.assertFalse(lib_auto_mesh.isThicknessAmbiguous(dict_loop))
+        dict_loop["90"] = (list_index, [62] * 100, [40] * 100)
+        self.assertTrue(lib_auto_mesh.isThicknessAmbiguous(dict_loop))
+        del dict_loop["90"]
+        self.assertTrue(lib_auto_mesh.isThicknessAmbiguous(dict_loop))
+
+    def test_lazy_imports(self):
+        # The plotting modules must not be imported with lib_auto_mesh,
+        # see benchmarks/bench_import.py
+        code = (
+            "import sys; import lib_auto_mesh; "
+            "print([name for name in sys.modules "
+            "if name.split('.')[0] in ('matplotlib', 'pylab')])"
+        )
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(lib_auto_mesh.__file__))
+        output = subprocess.run(
+            [sys.executable, "-c", code],
+            env=env,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        self.assertEqual(output.strip(), "[]")
+
+    def test_Metrics(self):
+        snapshot_dir = os.path.join(
+            self.test_data_directory, "snapshots_20141128-084026"
+        )
+        list_metrics = []
+        json_path = os.path.join(self.working_dir, "metrics.json")
+        metrics = lib_auto_mesh.Metrics(
+            callback=list_metrics.append, json_path=json_path
+        )
+        kwargs = dict(loop_max_width=0.35 * 608, loop_min_width=0.5 * 608)
+        result = lib_auto_mesh.autoMesh(
+            snapshot_dir, self.working_dir, self.working_dir, **kwargs
+        )
+        lib_auto_mesh.clearBackgroundCache()
+        result_metrics = lib_auto_mesh.autoMesh(
+            snapshot_dir,
+            self.working_dir,
+            self.working_dir,
+            workers=4,
+            metrics=metrics,
+            **kwargs
+        )
+        self.assertEqual(result_metrics, result)
+        self.assertEqual(len(list_metrics), 1)
+        dict_metrics = list_metrics[0]
+        with open(json_path) as f:
+            self.assertEqual(json.load(f), dict_metrics)
+        list_omega = lib_auto_mesh.LIST_OMEGA_MESH
+        self.assertEqual(
+            sorted(dict_metrics["omega"]), sorted("%d" % omega for omega in list_omega)
+        )
+        for stage in ["read_background", "read", "loop_exam", "find_mesh", "total"]:
+            self.assertIn(stage, dict_metrics["stages"])
+        # The snapshots and the background
+        self.assertEqual(dict_metrics["counters"]["images_read"], len(list_omega) + 1)
+        bytes_snapshots = sum(
+            os.path.getsize(os.path.join(snapshot_dir, "snapshot_%03d.png" % omega))
+            for omega in list_omega
+        )
+        bytes_background = os.path.getsize(
+            os.path.join(snapshot_dir, "snapshot_background.png")
+        )
+        self.assertEqual(
+            dict_metrics["counters"]["bytes_read"], bytes_snapshots + bytes_background
+        )
+        # The background is now taken from the cache
+        metrics = lib_auto_mesh.Metrics()
+        lib_auto_mesh.autoMesh(
+            snapshot_dir, self.working_dir, self.working_dir, metrics=metrics, **kwargs
+        )
+        dict_counter = metrics.toDict()["counters"]
+        self.assertEqual(dict_counter["images_read"], len(list_omega))
+        self.assertEqual(dict_counter["bytes_read"], bytes_snapshots)
+        self.assertEqual(dict_metrics["info"]["image_shape"], [493, 659])
+        self.assertEqual(dict_metrics["info"]["run"], "autoMesh")
+
+    def test_replayAutoMesh(self):
+        snapshot_dir = os.path.join(
+            self.test_data_directory, "snapshots_20141128-084026"
+        )
+        loop_profile_path = os.path.join(self.working_dir, "loops.npz")
+        kwargs = dict(loop_max_width=0.35 * 608, loop_min_width=0.5 * 608)
+        result = lib_auto_mesh.autoMesh(
+            snapshot_dir,
+            self.working_dir,
+            self.working_dir,
+            loop_profile_path=loop_profile_path,
+            **kwargs
+        )
+        dict_loop, nx, ny = lib_auto_mesh.loadLoopProfiles(loop_profile_path)
+        self.assertEqual((nx, ny), (659, 493))
+        self.assertEqual(
+            sorted(dict_loop, key=int),
+            ["%d" % omega for omega in lib_auto_mesh.LIST_OMEGA_MESH],
+        )
+        self.assertEqual(
+            lib_auto_mesh.replayAutoMesh(loop_profile_path, **kwargs),
+            result[:7] + result[8:],
+        )
+        # No int16 from the profiles in the results
+        self.assertEqual(
+            [type(value) for value in result[1:5]], [float, float, int, int]
+        )
+        # Round trip of the archived JSON profiles
+        test_data_path = os.path.join(self.test_data_directory, "dictLoop_1.json")
+        dict_loop, nx, ny = lib_auto_mesh.loadLoopProfiles(test_data_path)
+        self.assertIsNone(nx)
+        lib_auto_mesh.saveLoopProfiles(loop_profile_path, dict_loop, 659, 493)
+        dict_loop_npz, nx, ny = lib_auto_mesh.loadLoopProfiles(loop_profile_path)
+        self.assertEqual(
+            {
+                key: [list(value) for value in loop]
+                for key, loop in dict_loop_npz.items()
+            },
+            dict_loop,
+        )
+        self.assertEqual(
+            lib_auto_mesh.replayAutoMesh(loop_profile_path, **kwargs),
+            lib_auto_mesh.replayAutoMesh(test_data_path, nx=659, ny=493, **kwargs),
+        )
+        # Nothing is saved if the loop shapes are all the same
+        same_loop_profile_path = os.path.join(self.working_dir, "same_loops.npz")
+        result_same = lib_auto_mesh.findMeshFromLoops(
+            dict_loop,
+            659,
+            493,
+            self.working_dir,
+            loop_profile_path=same_loop_profile_path,
+            **kwargs
+        )
+        self.assertTrue(result_same[7])
+        self.assertFalse(os.path.exists(same_loop_profile_path))
+
+    def test_LoopProfile(self):
+        loop = lib_auto_mesh.LoopProfile.fromColumns(
+            [10, 11, 13], [50, 52, 51], [40, 41, 45]
+        )
+        self.assertEqual(loop.x_start, 10)
+        self.assertEqual(loop.x_end, 14)
+        self.assertEqual(loop.mask.tolist(), [True, True, False, True])
+        self.assertEqual(loop.column_upper.dtype, numpy.int16)
+        (array_index, array_upper, array_lower) = loop
+        self.assertEqual(array_index.tolist(), [10, 11, 13])
+        self.assertEqual(array_upper.tolist(), [50, 52, 51])
+        self.assertEqual(loop.lower.tolist(), [40, 41, 45])
+        self.assertEqual(loop, ([10, 11, 13], [50, 52, 51], [40, 41, 45]))
+        self.assertNotEqual(loop, ([10, 11, 13], [50, 52, 51], [40, 41, 44]))
+        column_upper, column_lower, mask = loop.columns(8, 12)
+        self.assertEqual(column_upper.tolist(), [0, 0, 50, 52])
+        self.assertEqual(column_lower.tolist(), [0, 0, 40, 41])
+        self.assertEqual(mask.tolist(), [False, False, True, True])
+        self.assertEqual(pickle.loads(pickle.dumps(loop)), loop)
+        empty_loop = lib_auto_mesh.LoopProfile.fromColumns([], [], [])
+        self.assertEqual(len(empty_loop.index), 0)
+        self.assertFalse(empty_loop.columns(0, 4)[2].any())
+
+    def test_findOptimalMeshVectorized(self):
+        # Results of the former implementation, one loop over the angles
+        with open(
+            os.path.join(self.test_data_directory, "findOptimalMesh_results.json")
+        ) as f:
+            dict_expected = json.load(f)
+        dict_case = {}
+        for index in [1, 2]:
+            dict_loop, _, _ = lib_auto_mesh.loadLoopProfiles(
+                os.path.join(self.test_data_directory, "dictLoop_%d.json" % index)
+            )
+            dict_case["dictLoop_%d" % index] = (dict_loop, 659, 493, index == 1)
+        snapshot_dir = os.path.join(
+            self.test_data_directory, "snapshots_20141128-084026"
+        )
+        background = lib_auto_mesh.readBackground(
+            os.path.join(snapshot_dir, "snapshot_background.png")
+        )
+        dict_image = lib_auto_mesh.readSnapshots(
+            snapshot_dir, lib_auto_mesh.LIST_OMEGA_MESH
+        )
+        dict_loop = {
+            "%d" % omega: lib_auto_mesh.analyseImage(dict_image[omega], background)
+            for omega in lib_auto_mesh.LIST_OMEGA_MESH
+        }
+        dict_case["snapshots_20141128-084026"] = (
+            dict_loop,
+            background.shape[1],
+            background.shape[0],
+            True,
+        )
+        for name, (dict_loop, nx, ny, same_phiz) in dict_case.items():
+            self.assertEqual(len(dict_expected[name]), 18)
+            for expected in dict_expected[name]:
+                result = expected["result"]
+                result_vectorized = lib_auto_mesh.findOptimalMeshVectorized(
+                    dict_loop,
+                    None,
+                    nx,
+                    ny,
+                    None,
+                    loop_max_width=expected["loop_max_width"],
+                    loop_min_width=expected["loop_min_width"],
+                    find_largest_mesh=expected["find_largest_mesh"],
+                )
+                self.assertEqual(list(result_vectorized[:5]), result[:5])
+                if same_phiz:
+                    # The phiz of the profiles with missing columns are
+                    # averaged on aligned columns, see findOptimalMeshVectorized
+                    self.assertAlmostEqual(result_vectorized[5], result[5], places=9)
+                    self.assertAlmostEqual(result_vectorized[6], result[6], places=9)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,229 @@
+# coding: utf-8
+# /*##########################################################################
+# Copyright (C) 2017 European Synchrotron Radiation Facility
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+# ############################################################################*/
+import io
+import os
+import json
+import shutil
+import unittest
+import unittest.mock
+import tempfile
+
+import numpy
+
+import lib_auto_mesh
+import auto_mesh_batch
+import auto_mesh_convert
+import auto_mesh_background
+
+
+def crashingProcessSample(snapshot_dir, working_dir, **kwargs):
+    # Stands for a worker killed while processing the sample
+    if snapshot_dir == "crash":
+        os._exit(1)
+    return {"snapshot_dir": snapshot_dir, "status": "ok"}
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        path = os.path.abspath(__file__)
+        self.test_data_directory = os.path.join(os.path.dirname(path), "data")
+        self.working_dir = tempfile.mkdtemp(prefix="autoMesh_")
+        os.chmod(self.working_dir, 0o755)
+
+    def tearDown(self) -> None:
+        lib_auto_mesh.waitForArtifacts()
+        shutil.rmtree(self.working_dir)
+
+    def test_batchAutoMesh(self):
+        snapshot_dir = os.path.join(
+            self.test_data_directory, "snapshots_20141128-084026"
+        )
+        empty_dir = tempfile.mkdtemp(prefix="empty_", dir=self.working_dir)
+        list_snapshot_dir = auto_mesh_batch.listSnapshotDirs(
+            [snapshot_dir, os.path.join(self.working_dir, "empty_*"), snapshot_dir]
+        )
+        self.assertEqual(list_snapshot_dir, [snapshot_dir, empty_dir])
+        kwargs = dict(loop_max_width=0.35 * 608, loop_min_width=0.5 * 608)
+        result = lib_auto_mesh.autoMesh(
+            snapshot_dir, self.working_dir, self.working_dir, **kwargs
+        )
+        batch_dir = tempfile.mkdtemp(prefix="batch_", dir=self.working_dir)
+        for processes in [1, 2]:
+            output = io.StringIO()
+            summary = auto_mesh_batch.batchAutoMesh(
+                list_snapshot_dir,
+                batch_dir,
+                output=output,
+                processes=processes,
+                **kwargs
+            )
+            self.assertEqual(summary["samples"], 2)
+            self.assertEqual(summary["errors"], 1)
+            self.assertGreater(summary["samples_per_second"], 0)
+            dict_record = {}
+            for line in output.getvalue().splitlines():
+                record = json.loads(line)
+                dict_record[record["snapshot_dir"]] = record
+            self.assertEqual(dict_record[empty_dir]["status"], "error")
+            record = dict_record[snapshot_dir]
+            self.assertEqual(record["status"], "ok")
+            self.assertEqual(record["result"]["angle_min_thickness"], result[0])
+            self.assertAlmostEqual(record["result"]["delta_phiz"], result[5])
+
+    def test_runBatch_brokenPool(self):
+        list_snapshot_dir = ["a", "b", "crash", "c", "d", "e", "f"]
+        with unittest.mock.patch.object(
+            auto_mesh_batch, "processSample", crashingProcessSample
+        ):
+            list_record = list(
+                auto_mesh_batch.runBatch(
+                    list_snapshot_dir, self.working_dir, processes=2, max_pending=2
+                )
+            )
+        dict_record = {record["snapshot_dir"]: record for record in list_record}
+        self.assertEqual(len(list_record), len(list_snapshot_dir))
+        self.assertEqual(sorted(dict_record), sorted(list_snapshot_dir))
+        self.assertEqual(dict_record["crash"]["status"], "error")
+        self.assertIn("BrokenProcessPool", dict_record["crash"]["error"])
+        # At most the other sample in flight is lost with the crashed one,
+        # the samples after it go to a new pool
+        list_error = [record for record in list_record if record["status"] == "error"]
+        self.assertLessEqual(len(list_error), 2)
+
+    def test_main_centre(self):
+        snapshot_dir = os.path.join(self.test_data_directory, "tungsten")
+        output_path = os.path.join(self.working_dir, "results.jsonl")
+        exit_code = auto_mesh_batch.main(
+            [
+                snapshot_dir,
+                "--working-dir",
+                os.path.join(self.working_dir, "batch"),
+                "--mode",
+                "centre",
+                "--loop-width",
+                "10.24",
+                "--processes",
+                "1",
+                "--output",
+                output_path,
+            ]
+        )
+        self.assertEqual(exit_code, 0)
+        with open(output_path) as f:
+            list_record = [json.loads(line) for line in f]
+        self.assertEqual(len(list_record), 1)
+        delta = lib_auto_mesh.findDeltaToCentre(
+            snapshot_dir, self.working_dir, loop_width=10.24
+        )
+        self.assertEqual(
+            [
+                list_record[0]["result"][key]
+                for key in ["delta_x", "delta_y", "delta_z"]
+            ],
+            [float(value) for value in delta],
+        )
+
+    def test_convertSnapshotDirs(self):
+        snapshot_dir = os.path.join(self.test_data_directory, "tungsten")
+        empty_dir = tempfile.mkdtemp(prefix="empty_", dir=self.working_dir)
+        stack_dir = os.path.join(self.working_dir, "stacks")
+        exit_code = auto_mesh_convert.main(
+            [snapshot_dir, empty_dir, "--output-dir", stack_dir]
+        )
+        # No snapshots in empty_dir
+        self.assertEqual(exit_code, 1)
+        stack_path = os.path.join(stack_dir, "tungsten.npz")
+        self.assertEqual(os.listdir(stack_dir), ["tungsten.npz"])
+        # Other npz files next to the stacks are not taken for stacks
+        lib_auto_mesh.BackgroundModel.fromFrames([numpy.zeros((4, 4))]).save(
+            os.path.join(stack_dir, "background.npz")
+        )
+        lib_auto_mesh.saveLoopProfiles(
+            os.path.join(stack_dir, "loops.npz"), {"0": [[1, 2], [3, 4], [5, 6]]}, 8, 8
+        )
+        self.assertEqual(
+            auto_mesh_batch.listSnapshotDirs([os.path.join(stack_dir, "*")]),
+            [stack_path],
+        )
+        record = auto_mesh_batch.processSample(
+            stack_path,
+            self.working_dir,
+            mode=auto_mesh_batch.MODE_CENTRE,
+            loop_width=10.24,
+        )
+        self.assertEqual(record["status"], "ok")
+        delta = lib_auto_mesh.findDeltaToCentre(
+            snapshot_dir, self.working_dir, loop_width=10.24, compact=True
+        )
+        self.assertEqual(
+            [record["result"][key] for key in auto_mesh_batch.LIST_CENTRE_KEY],
+            [float(value) for value in delta],
+        )
+
+    def test_backgroundModel(self):
+        snapshot_dir = os.path.join(self.test_data_directory, "tungsten")
+        background_path = os.path.join(snapshot_dir, "snapshot_background.png")
+        model_path = os.path.join(self.working_dir, "background.npz")
+        exit_code = auto_mesh_background.main(
+            [background_path, background_path, "--output", model_path]
+        )
+        self.assertEqual(exit_code, 0)
+        exit_code = auto_mesh_background.main(
+            [background_path, "--output", model_path, "--update"]
+        )
+        self.assertEqual(exit_code, 0)
+        model = lib_auto_mesh.BackgroundModel.load(model_path)
+        self.assertEqual(model.no_frames, 3)
+        output_path = os.path.join(self.working_dir, "results.jsonl")
+        exit_code = auto_mesh_batch.main(
+            [
+                snapshot_dir,
+                "--working-dir",
+                os.path.join(self.working_dir, "batch"),
+                "--mode",
+                "centre",
+                "--loop-width",
+                "10.24",
+                "--processes",
+                "1",
+                "--background",
+                model_path,
+                "--output",
+                output_path,
+            ]
+        )
+        self.assertEqual(exit_code, 0)
+        with open(output_path) as f:
+            record = json.loads(f.readline())
+        delta = lib_auto_mesh.findDeltaToCentre(
+            snapshot_dir, self.working_dir, loop_width=10.24, compact=True
+        )
+        self.assertEqual(
+            [record["result"][key] for key in auto_mesh_batch.LIST_CENTRE_KEY],
+            [float(value) for value in delta],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,147 @@
+# coding: utf-8
+# /*##########################################################################
+# Copyright (C) 2017 European Synchrotron Radiation Facility
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+# ############################################################################*/
+import os
+import shutil
+import unittest
+import tempfile
+import threading
+from multiprocessing import shared_memory
+
+import numpy
+
+import lib_auto_mesh
+import auto_mesh_service
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        path = os.path.abspath(__file__)
+        self.test_data_directory = os.path.join(os.path.dirname(path), "data")
+        self.working_dir = tempfile.mkdtemp(prefix="autoMesh_")
+        os.chmod(self.working_dir, 0o755)
+
+    def tearDown(self) -> None:
+        lib_auto_mesh.waitForArtifacts()
+        shutil.rmtree(self.working_dir)
+
+    def test_service(self):
+        snapshot_dir = os.path.join(
+            self.test_data_directory, "snapshots_20141128-084026"
+        )
+        kwargs = dict(loop_max_width=0.35 * 608, loop_min_width=0.5 * 608)
+        result = lib_auto_mesh.autoMesh(
+            snapshot_dir, self.working_dir, self.working_dir, **kwargs
+        )
+        socket_path = os.path.join(self.working_dir, "auto_mesh.sock")
+        service = auto_mesh_service.AutoMeshService(workers=2)
+        thread = threading.Thread(target=service.serveSocket, args=(socket_path,))
+        thread.start()
+        try:
+            while not os.path.exists(socket_path):
+                thread.join(0.01)
+            with auto_mesh_service.AutoMeshClient(socket_path) as client:
+                self.assertEqual(client.ping(), {})
+                for _ in range(2):
+                    result_service = client.autoMesh(
+                        snapshot_dir=snapshot_dir,
+                        workflow_working_dir=self.working_dir,
+                        auto_mesh_working_dir=self.working_dir,
+                        **kwargs
+                    )
+                    self.assertEqual(
+                        list(result_service.values()),
+                        [
+                            value.item() if hasattr(value, "item") else value
+                            for value in result
+                        ],
+                    )
+                with self.assertRaises(RuntimeError):
+                    client.findDeltaToCentre(
+                        snapshot_dir=self.working_dir,
+                        auto_mesh_working_dir=self.working_dir,
+                    )
+                client.shutdown()
+        finally:
+            service.shutdown_event.set()
+            thread.join()
+            service.close()
+
+    def test_client_subprocess(self):
+        snapshot_dir = os.path.join(self.test_data_directory, "tungsten")
+        delta = lib_auto_mesh.findDeltaToCentre(
+            snapshot_dir, self.working_dir, loop_width=10.24
+        )
+        with auto_mesh_service.AutoMeshClient(workers=1) as client:
+            result = client.findDeltaToCentre(
+                snapshot_dir=snapshot_dir,
+                auto_mesh_working_dir=self.working_dir,
+                loop_width=10.24,
+            )
+        self.assertEqual(list(result.values()), [float(value) for value in delta])
+
+    def test_client_sharedMemory(self):
+        snapshot_dir = os.path.join(self.test_data_directory, "tungsten")
+        list_omega = lib_auto_mesh.LIST_OMEGA_CENTRE
+        dict_image = lib_auto_mesh.readSnapshots(snapshot_dir, list_omega, compact=True)
+        background = lib_auto_mesh.readBackground(
+            os.path.join(snapshot_dir, "snapshot_background.png"), compact=True
+        )
+        delta = lib_auto_mesh.findDeltaToCentreFromArrays(
+            dict_image, background, self.working_dir, loop_width=10.24
+        )
+        dict_image["background"] = background
+        list_block = []
+        try:
+            dict_frame = {}
+            for key, image in dict_image.items():
+                block = shared_memory.SharedMemory(create=True, size=image.nbytes)
+                list_block.append(block)
+                numpy.ndarray(image.shape, dtype=image.dtype, buffer=block.buf)[
+                    :
+                ] = image
+                dict_frame[key] = {
+                    "name": block.name,
+                    "shape": image.shape,
+                    "dtype": image.dtype.str,
+                }
+            background_frame = dict_frame.pop("background")
+            with auto_mesh_service.AutoMeshClient(workers=1) as client:
+                result = client.findDeltaToCentreFromSharedMemory(
+                    dict_frame=dict_frame,
+                    background_frame=background_frame,
+                    auto_mesh_working_dir=self.working_dir,
+                    loop_width=10.24,
+                )
+            self.assertEqual(list(result.values()), [float(value) for value in delta])
+            # The service must not unlink the blocks when it exits
+            for block in list_block:
+                shared_memory.SharedMemory(name=block.name).close()
+        finally:
+            for block in list_block:
+                block.close()
+                block.unlink()
+
+
+if __name__ == "__main__":
+    unittest.main()
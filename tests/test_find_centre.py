@@ -28,8 +28,14 @@ import pathlib
 import unittest
 import tempfile
 
+import numpy
+
 import lib_auto_mesh
 
+try:
+    import circle_fit
+except ImportError:
+    circle_fit = None
 
 
 class Test(unittest.TestCase):
@@ -39,6 +45,7 @@ class Test(unittest.TestCase):
         os.chmod(self.working_dir, 0o755)
 
     def tearDown(self) -> None:
+        lib_auto_mesh.waitForArtifacts()
         shutil.rmtree(self.working_dir)
 
     def test_tungsten(self):
@@ -60,6 +67,130 @@ class Test(unittest.TestCase):
         print(deltaX, deltaY, deltaZ)
         print(deltaX / pixelPerMm, deltaY / pixelPerMm)
 
+    def test_findDeltaToCentreFromArrays(self):
+        snapshot_dir = self.test_data_directory / "tungsten"
+        dict_image = lib_auto_mesh.readSnapshots(str(snapshot_dir), [0, 90, 180, 270])
+        background = lib_auto_mesh.readBackground(
+            str(snapshot_dir / "snapshot_background.png")
+        )
+        delta_arrays = lib_auto_mesh.findDeltaToCentreFromArrays(
+            dict_image, background, self.working_dir, loop_width=10.24
+        )
+        delta_dir = lib_auto_mesh.findDeltaToCentre(
+            snapshot_dir, self.working_dir, loop_width=10.24
+        )
+        self.assertEqual(delta_arrays, delta_dir)
+
+    def test_findDeltaToCentre_artifacts(self):
+        snapshot_dir = self.test_data_directory / "tungsten"
+        for artifacts, list_expected in [
+            (lib_auto_mesh.ARTIFACTS_NONE, []),
+            (
+                lib_auto_mesh.ARTIFACTS_SUMMARY,
+                ["shapePlot_mean_%03d.png" % omega for omega in [0, 90, 180, 270]],
+            ),
+        ]:
+            working_dir = tempfile.mkdtemp(prefix="artifacts_", dir=self.working_dir)
+            lib_auto_mesh.findDeltaToCentre(
+                snapshot_dir, working_dir, loop_width=10.24, artifacts=artifacts
+            )
+            lib_auto_mesh.waitForArtifacts()
+            self.assertEqual(sorted(os.listdir(working_dir)), list_expected)
+        with self.assertRaises(ValueError):
+            lib_auto_mesh.resolveArtifacts("everything")
+
+    def test_fitVerticalOffset(self):
+        # Pin at 3 pixels along x and -2 along y from the axis at 100
+        for list_omega in [[0, 90, 180, 270], [0, 60, 120], [10, 45, 200, 300]]:
+            dict_vertical = {
+                omega: 100
+                + 3 * numpy.sin(numpy.radians(omega))
+                - 2 * numpy.cos(numpy.radians(omega))
+                for omega in list_omega
+            }
+            delta_x, delta_y = lib_auto_mesh.fitVerticalOffset(dict_vertical)
+            self.assertAlmostEqual(delta_x, 3)
+            self.assertAlmostEqual(delta_y, 2)
+        with self.assertRaises(RuntimeError):
+            lib_auto_mesh.fitVerticalOffset({0: 100, 180: 104})
+
+    def test_fitCircles(self):
+        rng = numpy.random.default_rng(0)
+        list_x = []
+        list_y = []
+        list_expected = []
+        for no_points in [3, 10, 40]:
+            xc, yc = rng.uniform(-500, 500, size=2)
+            r = rng.uniform(5, 100)
+            theta = rng.uniform(0, numpy.pi, size=no_points)
+            list_x.append(xc + r * numpy.cos(theta))
+            list_y.append(yc + r * numpy.sin(theta))
+            list_expected.append((xc, yc, r))
+        array_xc, array_yc, array_r = lib_auto_mesh.fitCircles(list_x, list_y)
+        for index, (xc, yc, r) in enumerate(list_expected):
+            self.assertAlmostEqual(array_xc[index], xc)
+            self.assertAlmostEqual(array_yc[index], yc)
+            self.assertAlmostEqual(array_r[index], r)
+        with self.assertRaises(RuntimeError):
+            lib_auto_mesh.fitCircles([[0, 1, 2]], [[0, 1, 2]])
+
+    @unittest.skipIf(circle_fit is None, "circle_fit not installed")
+    def test_fitCircles_noisyArcs(self):
+        rng = numpy.random.default_rng(0)
+        list_x = []
+        list_y = []
+        for _ in range(300):
+            no_points = rng.integers(5, 40)
+            xc, yc = rng.uniform(-500, 500, size=2)
+            r = rng.uniform(5, 100)
+            theta = rng.uniform(0, rng.uniform(0.5, numpy.pi), size=no_points)
+            list_x.append(
+                xc + r * numpy.cos(theta) + rng.normal(0, 0.05 * r, no_points)
+            )
+            list_y.append(
+                yc + r * numpy.sin(theta) + rng.normal(0, 0.05 * r, no_points)
+            )
+        array_xc, array_yc, array_r = lib_auto_mesh.fitCircles(list_x, list_y)
+        self.assertTrue(numpy.all(numpy.isfinite(array_r)))
+
+        def cost(x, y, xc, yc):
+            distance = numpy.hypot(x - xc, y - yc)
+            return ((distance - distance.mean()) ** 2).sum()
+
+        no_same = 0
+        for index, (x, y) in enumerate(zip(list_x, list_y)):
+            xc, yc, r, _ = circle_fit.least_squares_circle(numpy.c_[x, y])
+            # Same minimum, or a lower one where circle_fit stops in a local
+            # minimum or runs away to a huge radius
+            self.assertLessEqual(
+                cost(x, y, array_xc[index], array_yc[index]),
+                cost(x, y, xc, yc) * (1 + 1e-6),
+            )
+            if numpy.hypot(array_xc[index] - xc, array_yc[index] - yc) < 1e-3 * r:
+                no_same += 1
+        self.assertGreater(no_same, 270)
+
+    def test_findDeltaToCentre_circleFit(self):
+        snapshot_dir = self.test_data_directory / "tungsten"
+        delta = lib_auto_mesh.findDeltaToCentre(
+            snapshot_dir, self.working_dir, loop_width=10.24, do_circle_fit=True
+        )
+        # Results of circle_fit.least_squares_circle
+        for value, expected in zip(delta, [18.5, -10.25, 53.875]):
+            self.assertAlmostEqual(value, expected, places=6)
+
+    def test_findDeltaToCentre_snapshotStack(self):
+        snapshot_dir = self.test_data_directory / "tungsten"
+        stack_path = pathlib.Path(self.working_dir) / "tungsten.npz"
+        lib_auto_mesh.convertSnapshotDir(str(snapshot_dir), stack_path)
+        delta_stack = lib_auto_mesh.findDeltaToCentre(
+            stack_path, self.working_dir, loop_width=10.24
+        )
+        delta_dir = lib_auto_mesh.findDeltaToCentre(
+            snapshot_dir, self.working_dir, loop_width=10.24, compact=True
+        )
+        self.assertEqual(delta_stack, delta_dir)
+
 
 if __name__ == "__main__":
     unittest.main()